@@ -1,33 +1,179 @@
 # app_enhanced_v1.py - Enhanced Streamlit App Generator
 
 import streamlit as st
-import google.generativeai as genai
 import os
 from pathlib import Path
+import atexit
+import collections
+import contextlib
+import hashlib
 import json
+import re
+import shutil
 import time
-from dotenv import load_dotenv
+import zlib
 import subprocess # Needed to run other Streamlit apps (the preview)
 import socket    # Needed to find an open network port for the preview
+import sqlite3   # Persistent chat message store
+import uuid
 import sys       # Needed to get the path to the current Python executable
+import threading # Guards the shared pool of pre-warmed preview interpreters
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import signal
+try:
+    import resource # POSIX only: per-preview CPU/memory rlimits
+except ImportError:
+    resource = None
+import urllib.request # Needed to probe the preview server's health endpoint
+import urllib.error
+import code_validation # Static checks for workspace files; also run by validation_worker.py
+import generation # UI-independent core: prompts, offline model, response parsing, command execution
+import symbol_index # Outlines of workspace files for relevant-context prompting
 
 # --- UI Components ---
+# streamlit_ace and streamlit_antd_components are imported by the Workspace tab, which is
+# the only place they are used; later reruns find them in sys.modules.
 from streamlit_option_menu import option_menu
-from streamlit_ace import st_ace
-import streamlit_antd_components as sac
 
 # --- Configuration ---
 st.set_page_config(
     layout="wide",
     page_title="GenieCraft AI" # Creative Name Example
 )
-load_dotenv() # Load API keys from a file named .env in the same directory
+
+@st.cache_resource
+def _load_dotenv_once():
+    """Loads API keys from a .env file in the same directory, once per process instead of on every rerun."""
+    from dotenv import load_dotenv
+    return load_dotenv()
+
+_load_dotenv_once()
+
+# --- Performance Instrumentation ---
+METRICS_ENABLED = os.getenv("GENIECRAFT_METRICS", "1") == "1"
+METRICS_LOG_PATH = Path(os.getenv("GENIECRAFT_METRICS_LOG", ".geniecraft_cache/metrics.jsonl"))
+METRICS_TAB_ENABLED = os.getenv("GENIECRAFT_SHOW_METRICS", "0") == "1" # Or open the app with ?metrics=1
+METRICS_LOG_MAX_BYTES = 10 * 1024 * 1024 # Size at which the metrics log is rotated (one backup is kept)
+METRICS_TAB_MAX_RECORDS = 5000 # Most recent runs summarized in the Metrics tab
+
+class PerfRecorder:
+    """Timings and counters for one script run, appended to METRICS_LOG_PATH as a JSON line.
+
+    The log is rotated to `<name>.1` once it grows past METRICS_LOG_MAX_BYTES, so it stays
+    bounded on a long-running server.
+
+    A run that ends in st.rerun()/st.stop() never reaches the end of the script, so each run
+    flushes the previous run's recorder first; `flush` is idempotent. AI requests get a
+    recorder of their own (kind "ai_request"), flushed when the request is finished: that
+    usually happens in a fragment rerun, after the last full run flushed its recorder.
+    """
+
+    def __init__(self, kind="run"):
+        self.kind = kind
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.phases = {}   # phase name -> [total seconds, calls]
+        self.counters = {} # e.g. prompt/response token counts
+        self.flushed = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            totals = self.phases.setdefault(name, [0.0, 0])
+            totals[0] += time.perf_counter() - phase_started
+            totals[1] += 1
+
+    def add(self, name, seconds):
+        """Adds time measured elsewhere (e.g. on a worker thread) to a phase."""
+        totals = self.phases.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_record(self):
+        return {
+            "kind": self.kind,
+            "ts": round(self.started_at, 3),
+            "run_seconds": round(time.perf_counter() - self._started, 6),
+            "phases": {name: round(total, 6) for name, (total, _) in self.phases.items()},
+            "counters": self.counters,
+        }
+
+    def flush(self):
+        if self.flushed:
+            return None
+        self.flushed = True
+        record = self.to_record()
+        if METRICS_ENABLED:
+            try:
+                METRICS_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+                f = open(METRICS_LOG_PATH, "a", encoding="utf-8")
+                if f.tell() > METRICS_LOG_MAX_BYTES:
+                    f.close()
+                    os.replace(METRICS_LOG_PATH, METRICS_LOG_PATH.with_name(METRICS_LOG_PATH.name + ".1"))
+                    f = open(METRICS_LOG_PATH, "a", encoding="utf-8")
+                with f:
+                    f.write(json.dumps(record) + "\n") # One small O_APPEND write per run
+            except OSError:
+                pass # Metrics must never break the app
+        return record
+
+def start_perf_run():
+    previous_run = st.session_state.get("perf_current_run")
+    if previous_run is not None and not previous_run.flushed:
+        st.session_state.perf_last_record = previous_run.flush()
+    recorder = PerfRecorder()
+    st.session_state.perf_current_run = recorder
+    return recorder
+
+def load_metrics_records(max_records=METRICS_TAB_MAX_RECORDS):
+    """Most recent run records from the current metrics log (not its `.1` backup), oldest first."""
+    try:
+        with open(METRICS_LOG_PATH, "r", encoding="utf-8") as f:
+            lines = collections.deque(f, maxlen=max_records) # Streams the file, keeps only the tail
+    except OSError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue # Torn line from a concurrent writer
+    return records
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+def summarize_metrics(records, key):
+    """Per-name count/p50/p90/p99/max rows over the `key` dict ("phases" or "counters") of each record."""
+    values_by_name = collections.defaultdict(list)
+    for record in records:
+        for name, value in (record.get(key) or {}).items():
+            values_by_name[name].append(value)
+    rows = []
+    for name, values in sorted(values_by_name.items()):
+        values.sort()
+        rows.append({
+            "name": name,
+            "runs": len(values),
+            "p50": _percentile(values, 0.50),
+            "p90": _percentile(values, 0.90),
+            "p99": _percentile(values, 0.99),
+            "max": values[-1],
+            "total": sum(values),
+        })
+    return rows
+
+perf = start_perf_run()
 
 # --- Custom CSS for Notion-like Design ---
-def load_custom_css():
-    """Loads custom CSS for an enhanced Notion-like minimalistic design."""
-    st.markdown("""
-    <style>
+_CUSTOM_CSS = """
         /* --- Global --- */
         body {
             font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol";
@@ -185,59 +331,377 @@ def load_custom_css():
             border: 1px solid #EDEDED;
         }
 
-    </style>
-    """, unsafe_allow_html=True)
+"""
 
-load_custom_css() # Apply the styles
+@st.cache_resource
+def _custom_css_markup():
+    """The page CSS, minified once per process; it is re-sent to the browser on every rerun."""
+    css = re.sub(r"/\*.*?\*/", "", _CUSTOM_CSS, flags=re.DOTALL)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r"\s+", " ", css).strip()
+    return f"<style>{css}</style>"
+
+def load_custom_css():
+    """Loads custom CSS for an enhanced Notion-like minimalistic design."""
+    st.markdown(_custom_css_markup(), unsafe_allow_html=True)
+
+with perf.phase("css_load"):
+    load_custom_css() # Apply the styles
 
 # --- Constants ---
-WORKSPACE_DIR = Path("workspace_st_apps")
-WORKSPACE_DIR.mkdir(exist_ok=True)
+WORKSPACE_ROOT = Path("workspace_st_apps")
+SESSION_WORKSPACES = os.getenv("GENIECRAFT_SESSION_WORKSPACES", "1") == "1" # Each session works in WORKSPACE_ROOT/<session id>
+# The random id in `?session=` is the only thing that separates one session's chat and
+# workspace from another's: anyone with the URL has full access. Treat it as a credential.
+SESSION_ID_RE = re.compile(r"[0-9a-f]{32}")
+SESSION_IDLE_TTL_HOURS = int(os.getenv("GENIECRAFT_SESSION_TTL_HOURS", "0")) # Delete sessions unused this long (0 = keep them, the default)
+SESSION_CLEANUP_INTERVAL_SECONDS = 3600 # How often idle sessions are looked for
+SESSION_TOUCH_INTERVAL_SECONDS = 300    # How often a session's last use is written to the message store
+
+CHAT_EAGER_MESSAGES = 12 # Sidebar renders this many recent messages; older ones load on demand
 
 ACE_DEFAULT_THEME = "github" # Changed to GitHub theme
 ACE_DEFAULT_KEYBINDING = "vscode"
 
-GEMINI_MODEL_NAME = "gemini-1.5-pro-latest" # Using a generally available and capable model
-
-# Updated Instructions for the Google AI model
-GEMINI_SYSTEM_PROMPT = f"""
-You are an AI assistant helping create Streamlit applications.
-Your goal is to manage Python files in a workspace based on user requests.
-Respond *only* with a valid JSON array containing commands. Do not add any explanations before or after the JSON array.
-
-Available commands:
-1.  `{{"action": "create_update", "filename": "app_name.py", "content": "FULL_PYTHON_CODE_HERE"}}`
-    - Use this to create a new Python file or completely overwrite an existing one.
-    - The "content" MUST be a complete, runnable Streamlit Python script.
-    - ALWAYS include necessary import statements (e.g., `import streamlit as st`, `import pandas as pd`, `import plotly.express as px`, `from PIL import Image`).
-    - If the generated app needs its own API keys (e.g., for a weather API), it should ask the user for them using `st.text_input(type='password')` within its own code.
-    - For Pygame, generate code that draws to a Pygame surface, then converts it to bytes (`io.BytesIO()`) and displays it using `st.image()`. Avoid `pygame.display.set_mode()` or `pygame.display.flip()` for direct display.
-    - Ensure newlines in "content" are `\\n`, and escape backslashes (`\\\\`) and double quotes (`\\"`).
-    - Do *not* include ```python markdown blocks or shebangs (`#!/usr/bin/env python`) in the "content".
-2.  `{{"action": "delete", "filename": "old_app.py"}}`
-    - Use this to delete a Python file from the workspace.
-3.  `{{"action": "chat", "content": "Your message here."}}`
-    - Use this *only* if you need to ask for clarification, report an issue you can't fix with file actions, or confirm understanding.
-
-Current Python files in workspace: {', '.join([f.name for f in WORKSPACE_DIR.iterdir() if f.is_file() and f.suffix == '.py']) if WORKSPACE_DIR.exists() else 'None'}
-
-Example Interaction:
-User: Create a simple hello world app called hello.py that also imports pandas.
-AI: `[{{"action": "create_update", "filename": "hello.py", "content": "import streamlit as st\\nimport pandas as pd\\n\\nst.title('Hello World!')\\nst.write('This is a simple app with pandas imported.')\\ndf = pd.DataFrame({{'col1': [1, 2], 'col2': [3, 4]}})\\nst.write(df)"}}]`
-
-Ensure your entire response is *only* the JSON array `[...]`.
-"""
+PREVIEW_WORKER_SCRIPT = Path(__file__).with_name("preview_worker.py")
+PREVIEW_POOL_SIZE = int(os.getenv("GENIECRAFT_PREVIEW_POOL_SIZE", "2")) # Pre-warmed preview interpreters (0 disables the pool)
+PREVIEW_PRELOAD_MODULES = [ # Imported by each warm interpreter before it is handed a script
+    name.strip() for name in os.getenv("GENIECRAFT_PREVIEW_PRELOAD", "pandas,numpy,plotly.express").split(",") if name.strip()
+]
+PREVIEW_HOT_RELOAD = True # Running previews rerun in place when their file is saved, instead of restarting
+PREVIEW_LOG_MAX_BYTES = 512 * 1024 # In-memory log buffer per preview; oldest lines are dropped beyond this
+PREVIEW_LOG_SPILL_DIR = os.getenv("GENIECRAFT_PREVIEW_LOG_DIR") # Optional: also write preview logs to rotating files here
+PREVIEW_LOG_SPILL_MAX_BYTES = 5 * 1024 * 1024 # Size at which a spilled log file is rotated (one backup is kept)
+PREVIEW_MAX_CONCURRENT = int(os.getenv("GENIECRAFT_PREVIEW_MAX_CONCURRENT", "3")) # Previews kept running per session
+PREVIEW_MAX_TOTAL_RSS_MB = int(os.getenv("GENIECRAFT_PREVIEW_MAX_RSS_MB", "2048"))  # Combined memory of those previews
+# RLIMIT_CPU per preview (0 = none, the default). It caps the total CPU time over the preview's
+# whole life, not its rate: even an idle preview's file watcher uses it up eventually, so it only
+# suits short-lived previews. Runaway loops are stopped by the PREVIEW_CPU_BUDGET_* monitor below.
+PREVIEW_CPU_TIME_LIMIT_SECONDS = int(os.getenv("GENIECRAFT_PREVIEW_CPU_SECONDS", "0"))
+PREVIEW_ADDRESS_SPACE_LIMIT_MB = int(os.getenv("GENIECRAFT_PREVIEW_AS_MB", "0"))       # RLIMIT_AS per preview (0 = none)
+PREVIEW_RSS_BUDGET_MB = int(os.getenv("GENIECRAFT_PREVIEW_RSS_BUDGET_MB", "1024"))    # Stop a preview whose RSS exceeds this
+PREVIEW_CPU_BUDGET_PERCENT = 95       # Stop a preview that stays above this CPU usage...
+PREVIEW_CPU_BUDGET_SECONDS = 60       # ...for this long (a runaway loop)
+PREVIEW_SAMPLE_INTERVAL_SECONDS = 1.0 # How often each preview's /proc stats are sampled
+PREVIEW_SAMPLE_HISTORY = 120          # Samples kept per preview for the sparklines
+PREVIEW_STARTUP_HISTORY = 50          # Recent preview startup times kept per session
+PREVIEW_GLOBAL_MAX_CONCURRENT = int(os.getenv("GENIECRAFT_PREVIEW_GLOBAL_MAX", "16")) # Previews across all sessions
+PREVIEW_HEARTBEAT_INTERVAL_SECONDS = 30  # How often an open tab with previews reports that it is still there
+PREVIEW_HEARTBEAT_TIMEOUT_SECONDS = int(os.getenv("GENIECRAFT_PREVIEW_HEARTBEAT_TIMEOUT", "120")) # Then its previews are reaped
+PREVIEW_IDLE_TIMEOUT_SECONDS = int(os.getenv("GENIECRAFT_PREVIEW_IDLE_TIMEOUT", "1800")) # Reap previews nobody viewed for this long
+PREVIEW_REAP_INTERVAL_SECONDS = 10
+VALIDATION_WORKER_SCRIPT = Path(__file__).with_name("validation_worker.py")
+VALIDATION_MAX_WORKERS = min(4, os.cpu_count() or 1) # Worker processes used by "Validate workspace"
+VALIDATION_CACHE_MAX_ENTRIES = 1000 # Results kept, keyed by file content hash
+VALIDATION_INLINE_MAX_BYTES = 256 * 1024 # Larger files are validated by a worker process without blocking the save
+SYMBOL_INDEX_MAX_ENTRIES = 1000 # File outlines kept, keyed by file content hash
+SYMBOL_INDEX_MAX_BYTES = 256 * 1024 # Larger files are not outlined (and never offered as context)
+SNAPSHOT_DIR = Path(os.getenv("GENIECRAFT_SNAPSHOT_DIR", ".geniecraft_cache/snapshots")) # Workspace history (undo)
+SNAPSHOT_MAX_COUNT = 200 # Oldest snapshots, and blobs only they reference, are pruned beyond this
+
+PREVIEW_PORT_RANGE = (8600, 8999) # Dedicated range, outside the OS ephemeral ports used for outgoing connections
+PREVIEW_STARTUP_TIMEOUT_SECONDS = 60 # Upper bound for a preview server to start answering health checks
+PREVIEW_PORT_ATTEMPTS = 3 # Ports tried when another program takes the allocated one before the preview binds it
+PREVIEW_HEALTH_POLL_INITIAL_DELAY = 0.05 # Seconds; doubled after each failed probe...
+PREVIEW_HEALTH_POLL_MAX_DELAY = 0.5      # ...up to this cap
+
+GEMINI_HISTORY_TOKEN_BUDGET = 120_000 # Upper bound on (estimated) prompt tokens sent per request
+GEMINI_HISTORY_VERBATIM_MESSAGES = 4  # Most recent chat messages are always sent unchanged
+GEMINI_CHARS_PER_TOKEN = 4            # Local token estimate; avoids an API round trip per turn
+GEMINI_CONTEXT_TOKEN_BUDGET = int(os.getenv("GENIECRAFT_CONTEXT_TOKENS", "6000")) # Workspace code sent with a request (0 = file names only)
+GEMINI_CONTEXT_FULL_FILE_TOKENS = 1500 # Relevant files up to this size are sent whole; larger ones as excerpts
+GEMINI_CONTEXT_SNIPPET_MAX_LINES = 80 # Longer functions/classes are cut to their first lines
+GEMINI_COUNT_TOKENS_REMOTELY = False  # Use model.count_tokens for the final prompt size instead
+GEMINI_STREAM_RESPONSES = os.getenv("GENIECRAFT_STREAM_RESPONSES", "1") == "1" # Apply file commands as soon as each one arrives in the stream
+AI_JOB_POLL_INTERVAL_SECONDS = 0.5 # How often the chat panel checks on a running AI request
+GEMINI_PLANNER_DEFAULT = os.getenv("GENIECRAFT_PLANNER", "0") == "1" # Initial state of the sidebar's planner toggle
+GEMINI_PLANNER_MAX_FILES = 8 # Longer plans are cut to this many files
+GEMINI_PLANNER_MAX_WORKERS = int(os.getenv("GENIECRAFT_PLANNER_WORKERS", "4")) # Concurrent per-file generation calls
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GENIECRAFT_REQUESTS_PER_MINUTE", "60")) # Shared by every model call (0 = no limit)
+GEMINI_USE_FAKE_MODEL = os.getenv("GENIECRAFT_FAKE_MODEL", "0") == "1" # Offline stand-in, no API key needed
+
+RESPONSE_CACHE_ENABLED = os.getenv("GENIECRAFT_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_DIR = Path(os.getenv("GENIECRAFT_RESPONSE_CACHE_DIR", ".geniecraft_cache/responses"))
+RESPONSE_CACHE_MAX_ENTRIES = 200
+RESPONSE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+MESSAGE_STORE_PATH = Path(os.getenv("GENIECRAFT_MESSAGE_DB", ".geniecraft_cache/messages.sqlite3"))
+MESSAGE_INLINE_MAX_CHARS = 1024  # Longer command fields (generated code, diffs) are stored as blobs
+MESSAGE_BLOB_CACHE_ENTRIES = 32  # Recently loaded blobs kept in memory, shared by all sessions
+
+# --- Response Cache ---
+class ResponseCache:
+    """Content-addressed on-disk cache of raw model responses.
+
+    Keys hash the model name, the prepared request history and the workspace file list, so
+    a replayed prompt against the same workspace state skips the model call. Entries expire
+    after `ttl_seconds`; the least recently used ones are evicted past `max_entries` or
+    `max_bytes` (file mtimes double as the LRU clock).
+    """
+
+    def __init__(self, directory, max_entries, max_bytes, ttl_seconds):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, request_history, workspace_files):
+        payload = json.dumps(
+            {"model": model_name, "history": request_history, "files": sorted(workspace_files)},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                if time.time() - entry["created_at"] > self.ttl_seconds:
+                    path.unlink(missing_ok=True)
+                    self.evictions += 1
+                    raise FileNotFoundError(path)
+                os.utime(path) # Mark as recently used
+            except (FileNotFoundError, KeyError, ValueError, OSError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["text"]
+
+    def put(self, key, text):
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with self._lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"created_at": time.time(), "model": generation.GEMINI_MODEL_NAME, "text": text}, f)
+                os.replace(tmp_path, path)
+            except OSError:
+                tmp_path.unlink(missing_ok=True)
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry_path in self.directory.glob("*.json"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries.sort() # Oldest (least recently used) first
+        remaining = len(entries)
+        total_bytes = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, entry_path in entries:
+            if remaining <= self.max_entries and total_bytes <= self.max_bytes and now - mtime <= self.ttl_seconds:
+                break
+            entry_path.unlink(missing_ok=True)
+            remaining -= 1
+            total_bytes -= size
+            self.evictions += 1
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide response cache; None unless GENIECRAFT_RESPONSE_CACHE=1."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    return ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS)
+
+# --- Message Store ---
+_MESSAGE_BLOB_REF_RE = re.compile(r'"blob": "([0-9a-f]{64})"') # Blob references inside stored message bodies
+
+class MessageStore:
+    """Append-only, persistent chat history in SQLite, shared by every session.
+
+    Session state only holds lightweight messages: a command's `content` or `diff` longer
+    than `inline_max_chars` (generated code, diffs, raw responses) is replaced by
+    `<field>_ref: {"blob", "chars", "lines"}` and its text stored once as a zlib-compressed
+    blob keyed by SHA-256. Blobs are loaded back lazily with `load_text`. Sessions are
+    keyed by the `?session=` query parameter, so a chat survives reloads and restarts;
+    `touch` records when each was last used, for SessionJanitor.
+    """
+
+    OUT_OF_LINE_FIELDS = ("content", "diff")
+
+    def __init__(self, path, inline_max_chars=MESSAGE_INLINE_MAX_CHARS, cache_entries=MESSAGE_BLOB_CACHE_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.inline_max_chars = inline_max_chars
+        self.cache_entries = cache_entries
+        self._lock = threading.Lock()
+        self._blob_cache = collections.OrderedDict()
+        self._db = sqlite3.connect(self.path, check_same_thread=False) # Serialized by self._lock
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, body TEXT NOT NULL, PRIMARY KEY (session_id, seq))"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+
+    def _put_blob_locked(self, text):
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        self._db.execute("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)", (digest, zlib.compress(data)))
+        return digest
+
+    def _externalize_locked(self, message):
+        content = message.get("content")
+        if not isinstance(content, list):
+            return dict(message)
+        light_commands = []
+        for command in content:
+            if isinstance(command, dict):
+                command = dict(command)
+                for field in self.OUT_OF_LINE_FIELDS:
+                    value = command.get(field)
+                    if isinstance(value, str) and len(value) > self.inline_max_chars:
+                        del command[field]
+                        command[f"{field}_ref"] = {
+                            "blob": self._put_blob_locked(value), "chars": len(value), "lines": value.count("\n") + 1,
+                        }
+            light_commands.append(command)
+        return {**message, "content": light_commands}
+
+    def append(self, session_id, message):
+        """Persists a message. Returns its lightweight form for session state."""
+        with self._lock, self._db:
+            light_message = self._externalize_locked(message)
+            self._db.execute(
+                "INSERT INTO messages (session_id, seq, created_at, body) VALUES "
+                "(?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE session_id = ?), ?, ?)",
+                (session_id, session_id, time.time(), json.dumps(light_message)),
+            )
+        return light_message
+
+    def load(self, session_id):
+        """The session's lightweight messages, oldest first."""
+        with self._lock:
+            rows = self._db.execute("SELECT body FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [json.loads(body) for (body,) in rows]
+
+    def touch(self, session_id):
+        """Records that the session is in use now."""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO sessions (session_id, last_seen) VALUES (?, ?)", (session_id, time.time()))
+
+    def last_seen(self):
+        """{session id: time of its last use or message} for every session in the store."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT session_id, MAX(ts) FROM (SELECT session_id, last_seen AS ts FROM sessions UNION ALL "
+                "SELECT session_id, MAX(created_at) FROM messages GROUP BY session_id) GROUP BY session_id"
+            ).fetchall()
+        return dict(rows)
+
+    def delete_sessions(self, session_ids):
+        """Deletes the sessions' messages, and the blobs no remaining message refers to."""
+        with self._lock, self._db:
+            for session_id in session_ids:
+                self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            referenced = set()
+            for (body,) in self._db.execute("SELECT body FROM messages"):
+                referenced.update(_MESSAGE_BLOB_REF_RE.findall(body))
+            stale = [digest for (digest,) in self._db.execute("SELECT hash FROM blobs").fetchall() if digest not in referenced]
+            self._db.executemany("DELETE FROM blobs WHERE hash = ?", [(digest,) for digest in stale])
+            for digest in stale:
+                self._blob_cache.pop(digest, None)
+
+    def load_text(self, digest):
+        """Text of a blob, or None if it is missing."""
+        with self._lock:
+            text = self._blob_cache.get(digest)
+            if text is not None:
+                self._blob_cache.move_to_end(digest)
+                return text
+            row = self._db.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            text = zlib.decompress(row[0]).decode("utf-8")
+            self._blob_cache[digest] = text
+            while len(self._blob_cache) > self.cache_entries:
+                self._blob_cache.popitem(last=False)
+            return text
+
+@st.cache_resource
+def get_message_store():
+    return MessageStore(MESSAGE_STORE_PATH)
+
+def _command_text(command, field):
+    """A command field's text, loaded from the message store if it was stored out of line."""
+    if field in command:
+        return command[field]
+    ref = command.get(f"{field}_ref")
+    if ref is None:
+        return None
+    text = get_message_store().load_text(ref["blob"])
+    return text if text is not None else f"<{ref['chars']:,} characters no longer available>"
+
+def _command_has_text(command, field):
+    return bool(command.get(field)) or f"{field}_ref" in command
+
+def _command_text_size(command, field):
+    """(characters, lines) of a command field without loading it."""
+    ref = command.get(f"{field}_ref")
+    if ref is not None:
+        return ref["chars"], ref["lines"]
+    text = command.get(field) or ""
+    return len(text), text.count("\n") + 1
+
+def _hydrate_command(command):
+    """Copy of a command with every out-of-line field loaded back in."""
+    if not isinstance(command, dict) or not any(key.endswith("_ref") for key in command):
+        return command
+    hydrated = {}
+    for key, value in command.items():
+        if key.endswith("_ref") and isinstance(value, dict) and "blob" in value:
+            field = key[:-len("_ref")]
+            hydrated[field] = _command_text(command, field)
+        else:
+            hydrated[key] = value
+    return hydrated
+
+def append_chat_message(message):
+    """Adds a message to the session's chat, persisting it and keeping only its light form in memory."""
+    try:
+        message = get_message_store().append(st.session_state.session_id, message)
+    except (sqlite3.Error, OSError) as e:
+        st.warning(f"Chat message could not be saved to the message store ({e}); it is kept in memory only.")
+    st.session_state.messages.append(message)
 
 # --- API Client Setup ---
-try:
-    google_api_key = os.getenv("GOOGLE_API_KEY")
-    if not google_api_key:
-        st.error("🔴 Google API Key not found. Please set `GOOGLE_API_KEY` in a `.env` file or as an environment variable.")
+@st.cache_resource
+def get_generative_model():
+    """The model client, created once per process on first use.
+
+    google.generativeai is only imported by this first call, so runs that never talk
+    to the model (browsing files, previews) do not pay for it.
+    """
+    return generation.create_generative_model(fake=GEMINI_USE_FAKE_MODEL)
+
+def _generative_model():
+    try:
+        return get_generative_model()
+    except Exception as e: # Not cached, so the next request tries again
+        st.error(f"🔴 Failed to set up Google AI: {e}")
         st.stop()
-    genai.configure(api_key=google_api_key)
-    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-except Exception as e:
-    st.error(f"🔴 Failed to set up Google AI: {e}")
+
+if not GEMINI_USE_FAKE_MODEL and not os.getenv("GOOGLE_API_KEY"):
+    st.error("🔴 Google API Key not found. Please set `GOOGLE_API_KEY` in a `.env` file or as an environment variable.")
     st.stop()
 
 # --- Session State ---
@@ -245,32 +709,206 @@ def initialize_session_state():
     state_defaults = {
         "messages": [],
         "selected_file": None,
-        "file_content_on_load": "",
-        "preview_process": None,
-        "preview_port": None,
-        "preview_url": None,
-        "preview_file": None,
-        "editor_unsaved_content": "",
-        "last_saved_content": "",
+        "preview_manager": None,   # This session's PreviewManager (owned by the PreviewSupervisor)
+        "active_preview": None,    # Filename of the preview shown in the Live Preview tab
+        "editor_content": "",      # Editor buffer: seeds st_ace and tracks its latest returned text
+        "editor_saved_hash": None, # Hash of the content last loaded from / saved to disk
+        "editor_version": 0,       # Bumped when the buffer is replaced from outside the editor
+        "history_stats": None,
+        "ai_job": None,            # AIRequestJob for the request in flight, if any
+        "json_repair_counts": {},  # Repair name -> number of responses it was needed for
+        "chat_visible_count": CHAT_EAGER_MESSAGES,
+        "chat_render_cache": {},
+        "preview_log_cursors": {}, # filename -> sequence number of the first log line not yet shown
+        "preview_startup_history": collections.deque(maxlen=PREVIEW_STARTUP_HISTORY),
     }
     for key, default_value in state_defaults.items():
         if key not in st.session_state:
             st.session_state[key] = default_value
+    if "session_id" not in st.session_state:
+        # The chat lives in the message store under this id; keeping it in the URL lets a
+        # reload or a server restart pick the conversation up again.
+        # The id is random and unguessable, since the URL is all it takes to open the session.
+        session_id = st.query_params.get("session")
+        if not session_id or not SESSION_ID_RE.fullmatch(session_id):
+            session_id = uuid.uuid4().hex
+            st.query_params["session"] = session_id
+        st.session_state.session_id = session_id
+        try:
+            stored_messages = get_message_store().load(session_id)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            st.warning(f"Could not load the saved chat: {e}")
+            stored_messages = []
+        if stored_messages:
+            st.session_state.messages = stored_messages
+    st.session_state.workspace_snapshot = None # File list shared by every caller during this rerun
 
-initialize_session_state()
+def _record_session_use():
+    """Keeps the session's last use in the message store current, so SessionJanitor leaves it alone."""
+    now = time.time()
+    if now - st.session_state.get("session_seen_at", 0.0) < SESSION_TOUCH_INTERVAL_SECONDS:
+        return
+    st.session_state.session_seen_at = now
+    try:
+        get_message_store().touch(st.session_state.session_id)
+    except (sqlite3.Error, OSError):
+        pass # Only matters for idle-session cleanup
+
+with perf.phase("session_init"):
+    initialize_session_state()
+    _record_session_use()
+
+# Script globals are rebuilt on every run of every session, so this is per-session state.
+WORKSPACE_ID = st.session_state.session_id if SESSION_WORKSPACES else "shared"
+WORKSPACE_DIR = WORKSPACE_ROOT / st.session_state.session_id if SESSION_WORKSPACES else WORKSPACE_ROOT
+WORKSPACE_DIR.mkdir(parents=True, exist_ok=True)
+
+# --- Editor State ---
+def _content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+def _load_editor_buffer(content):
+    """Replaces the editor buffer with on-disk content (file selected, AI write, deletion)."""
+    st.session_state.editor_content = content
+    st.session_state.editor_saved_hash = _content_hash(content)
+    st.session_state.editor_version += 1 # New widget key so st_ace remounts with this content
+
+def _editor_widget_key(filename):
+    return f"ace_editor_{filename}_{st.session_state.editor_version}"
+
+def _save_editor_buffer(filename, widget_key):
+    """Save button callback; runs before the script so the rerun already shows the saved state."""
+    editor_text = st.session_state.get(widget_key)
+    if editor_text is None:
+        editor_text = st.session_state.editor_content
+    if save_file(filename, editor_text):
+        st.session_state.editor_content = editor_text
+        st.session_state.editor_saved_hash = _content_hash(editor_text)
 
 # --- File System Functions (largely unchanged from provided code, with minor error handling improvements) ---
+class WorkspaceIndex:
+    """Cached listing of a workspace's Python files with size, mtime and content hash.
+
+    The directory is only rescanned when its mtime changes (a file was added, removed or
+    renamed) or after `invalidate`, which the app calls on its own writes and deletes.
+    Per-file metadata is re-stat'ed on request and the hash recomputed only when the size
+    or mtime moved.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.scans = 0 # Directory scans performed, for diagnostics
+        self._lock = threading.Lock()
+        self._dir_mtime_ns = None
+        self._names = []
+        self._metadata = {} # filename -> {"size", "mtime_ns", "sha256"}
+
+    def _refresh_locked(self):
+        try:
+            dir_mtime_ns = self.root.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._dir_mtime_ns, self._names, self._metadata = None, [], {}
+            return
+        if dir_mtime_ns == self._dir_mtime_ns:
+            return
+        metadata = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(".py") and entry.is_file():
+                    stat = entry.stat()
+                    previous = self._metadata.get(entry.name)
+                    unchanged = previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns
+                    metadata[entry.name] = {
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "sha256": previous["sha256"] if unchanged else None, # Hashed lazily
+                    }
+        self._names = sorted(metadata)
+        self._metadata = metadata
+        self._dir_mtime_ns = dir_mtime_ns
+        self.scans += 1
+
+    def file_names(self):
+        with self._lock:
+            self._refresh_locked()
+            return list(self._names)
+
+    def metadata(self, filename):
+        """Returns {"size", "mtime_ns", "sha256"} for a workspace file, or None if it is gone."""
+        with self._lock:
+            self._refresh_locked()
+            cached = self._metadata.get(filename)
+            if cached is None:
+                return None
+            try:
+                stat = (self.root / filename).stat()
+            except FileNotFoundError:
+                self._dir_mtime_ns = None
+                return None
+            if cached["sha256"] is None or cached["size"] != stat.st_size or cached["mtime_ns"] != stat.st_mtime_ns:
+                with open(self.root / filename, "rb") as f:
+                    cached.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=hashlib.sha256(f.read()).hexdigest())
+            return dict(cached)
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            self._dir_mtime_ns = None
+            if filename:
+                self._metadata.pop(filename, None)
+
+class SessionResources:
+    """Per-workspace objects shared across reruns and sessions, keyed by directory.
+
+    Held here rather than as per-argument st.cache_resource entries, which can only be
+    cleared all at once: SessionJanitor drops just the objects of the sessions it deletes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._indexes = {} # workspace directory -> WorkspaceIndex
+        self._stores = {}  # snapshot directory -> SnapshotStore
+
+    def workspace_index(self, root):
+        with self._lock:
+            index = self._indexes.get(root)
+            if index is None:
+                index = self._indexes[root] = WorkspaceIndex(root)
+            return index
+
+    def snapshot_store(self, root, workspace_root):
+        with self._lock:
+            store = self._stores.get(root)
+            if store is None: # Opening the store recovers interrupted transactions
+                store = self._stores[root] = SnapshotStore(root, self.workspace_index(workspace_root))
+            return store
+
+    def forget(self, workspace_root, snapshot_root):
+        with self._lock:
+            self._indexes.pop(workspace_root, None)
+            self._stores.pop(snapshot_root, None)
+
+@st.cache_resource
+def get_session_resources():
+    return SessionResources()
+
+def get_workspace_index(root):
+    """One index per workspace directory, shared across reruns and sessions."""
+    return get_session_resources().workspace_index(root)
+
+def _invalidate_workspace_files(filename=None):
+    get_workspace_index(str(WORKSPACE_DIR)).invalidate(filename)
+    st.session_state.workspace_snapshot = None
+
 def get_workspace_python_files():
-    if not WORKSPACE_DIR.is_dir():
-        return []
+    if st.session_state.get("workspace_snapshot") is not None:
+        return list(st.session_state.workspace_snapshot)
     try:
-        python_files = sorted([
-            f.name for f in WORKSPACE_DIR.iterdir() if f.is_file() and f.suffix == '.py'
-        ])
-        return python_files
+        python_files = get_workspace_index(str(WORKSPACE_DIR)).file_names()
     except Exception as e:
         st.error(f"Error reading workspace directory: {e}")
         return []
+    st.session_state.workspace_snapshot = python_files
+    return list(python_files)
 
 def read_file(filename):
     if not filename:
@@ -297,9 +935,14 @@ def save_file(filename, content):
         return False
     filepath = WORKSPACE_DIR / filename
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(content)
+        generation.atomic_write_bytes(filepath, content.encode("utf-8"))
+        _invalidate_workspace_files(filename)
         st.toast(f"Saved: {filename}", icon="💾") # Moved toast here for immediate feedback
+        problems = validate_workspace_file(filename, content)
+        if problems:
+            st.toast(f"{filename}: {len(problems)} problem(s) found", icon="⚠️")
+        if PREVIEW_HOT_RELOAD and get_preview_manager().get(filename):
+            st.toast(f"Live preview reloading: {filename}", icon="🔄") # The preview server watches this file
         return True
     except Exception as e:
         st.error(f"Error saving file '{filename}': {e}")
@@ -315,14 +958,13 @@ def delete_file_from_workspace(filename): # Renamed for clarity
     try:
         if filepath.is_file():
             os.remove(filepath)
+            _invalidate_workspace_files(filename)
             st.toast(f"Deleted: {filename}", icon="🗑️")
-            if st.session_state.preview_file == filename:
-                stop_preview()
+            if get_preview_manager().get(filename):
+                stop_preview(filename, rerun=False)
             if st.session_state.selected_file == filename:
                 st.session_state.selected_file = None
-                st.session_state.file_content_on_load = ""
-                st.session_state.editor_unsaved_content = ""
-                st.session_state.last_saved_content = ""
+                _load_editor_buffer("")
             return True
         else:
             st.warning(f"Could not delete: File '{filename}' not found.")
@@ -331,126 +973,1723 @@ def delete_file_from_workspace(filename): # Renamed for clarity
         st.error(f"Error deleting file '{filename}': {e}")
         return False
 
-# --- AI Interaction Functions (largely unchanged, minor logging/error improvements) ---
-def _clean_ai_response_text(ai_response_text):
-    text = ai_response_text.strip()
-    if text.startswith("```json"):
-        text = text[7:-3].strip()
-    elif text.startswith("```"):
-        text = text[3:-3].strip()
-    return text
-
-def parse_and_execute_ai_commands(ai_response_text):
-    cleaned_text = _clean_ai_response_text(ai_response_text)
-    executed_commands_list = []
-    try:
-        commands = json.loads(cleaned_text)
-        if not isinstance(commands, list):
-            st.error("AI response was valid JSON, but not a list of commands.")
-            return [{"action": "chat", "content": f"AI Error: Response was not a list. Response: {cleaned_text}"}]
-
-        for command_data in commands:
-            if not isinstance(command_data, dict):
-                st.warning(f"AI sent an invalid command format (not a dict): {command_data}")
-                executed_commands_list.append({"action": "chat", "content": f"AI Error: Invalid command format: {command_data}"})
+# --- Workspace Snapshots ---
+class SnapshotStore:
+    """Content-addressed history of workspace states, used for undo.
+
+    File contents are stored once per distinct version as zlib-compressed blobs named by
+    their SHA-256, so a snapshot costs one small manifest plus blobs for the files that
+    changed. Each AI response runs as a transaction: `begin` snapshots the workspace and
+    leaves a journal entry, `record_change` adds each file the response is about to write
+    or delete, `commit` snapshots the result and clears the entry. `rollback` puts back the
+    base version of the journaled files only, and only where a file still holds what the
+    transaction wrote, so edits saved by the user meanwhile are kept. Entries left behind
+    by a crashed process are rolled back the same way when the store is opened. `restore`
+    only rewrites files whose content differs from the target.
+    """
+
+    def __init__(self, root, workspace_index, max_snapshots=SNAPSHOT_MAX_COUNT):
+        self.root = Path(root)
+        self.workspace_index = workspace_index
+        self.workspace_dir = workspace_index.root
+        self.max_snapshots = max_snapshots
+        self.blob_dir = self.root / "blobs"
+        self.manifest_dir = self.root / "manifests"
+        self.journal_dir = self.root / "pending"
+        for directory in (self.blob_dir, self.manifest_dir, self.journal_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self.recovered_transactions = self._recover_interrupted()
+
+    def _blob_path(self, digest):
+        return self.blob_dir / digest[:2] / digest[2:]
+
+    def _put_blob(self, filename, digest):
+        """Stores the file's content unless a blob with this hash exists. Returns the stored hash."""
+        if digest and self._blob_path(digest).exists():
+            return digest
+        with open(self.workspace_dir / filename, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest() # The file may have changed since it was indexed
+        blob_path = self._blob_path(digest)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(exist_ok=True)
+            generation.atomic_write_bytes(blob_path, zlib.compress(data))
+        return digest
+
+    def read_blob(self, digest):
+        with open(self._blob_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def _manifest_paths(self):
+        return sorted(self.manifest_dir.glob("*.json"))
+
+    def manifest(self, snapshot_id):
+        with open(self.manifest_dir / f"{snapshot_id}.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def snapshots(self):
+        """Every snapshot manifest, oldest first."""
+        manifests = []
+        for path in self._manifest_paths():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    manifests.append(json.load(f))
+            except (OSError, ValueError):
                 continue
-            executed_commands_list.append(command_data)
-            action = command_data.get("action")
-            filename = command_data.get("filename")
-            content = command_data.get("content")
-
-            if action == "create_update":
-                if filename and content is not None:
-                    success = save_file(filename, content)
-                    if success:
-                        # st.toast already in save_file
-                        if st.session_state.selected_file == filename:
-                            st.session_state.file_content_on_load = content
-                            st.session_state.last_saved_content = content
-                            st.session_state.editor_unsaved_content = content # Important to sync editor
-                    else:
-                        # Error already shown by save_file
-                        executed_commands_list.append({"action": "chat", "content": f"Error: Failed saving {filename}"})
-                else:
-                    st.warning("AI 'create_update' command missing filename or content.")
-                    executed_commands_list.append({"action": "chat", "content": "AI Warning: Invalid create_update"})
-            elif action == "delete":
-                if filename:
-                    success = delete_file_from_workspace(filename) # Use renamed function
-                    if not success:
-                         # Error already shown by delete_file_from_workspace
-                         executed_commands_list.append({"action": "chat", "content": f"Error: Failed deleting {filename}"})
-                else:
-                    st.warning("AI 'delete' command missing filename.")
-                    executed_commands_list.append({"action": "chat", "content": "AI Warning: Invalid delete"})
-            elif action == "chat":
-                pass # Chat message already in list
-            else:
-                st.warning(f"AI sent unknown action: '{action}'.")
-                executed_commands_list.append({"action": "chat", "content": f"AI Warning: Unknown action '{action}'"})
-        return executed_commands_list
-    except json.JSONDecodeError:
-        st.error(f"AI response was not valid JSON.\nRaw response:\n```\n{cleaned_text}\n```")
-        return [{"action": "chat", "content": f"AI Error: Invalid JSON received. Response: {ai_response_text}"}]
-    except Exception as e:
-        st.error(f"Error processing AI commands: {e}")
-        return [{"action": "chat", "content": f"Error processing commands: {e}"}]
-
-def _prepare_gemini_history(chat_history, system_prompt_with_context):
-    gemini_history = []
-    gemini_history.append({"role": "user", "parts": [{"text": system_prompt_with_context}]})
-    gemini_history.append({"role": "model", "parts": [{"text": json.dumps([{"action": "chat", "content": "Understood. I will respond only with JSON commands."}])}]})
-    for msg in chat_history:
-        role = msg["role"]
-        content = msg["content"]
-        api_role = "model" if role == "assistant" else "user"
-        if role == "assistant" and isinstance(content, list):
+        return manifests
+
+    def snapshot(self, label):
+        """Records the current workspace. Returns the snapshot id (the latest one if nothing changed)."""
+        with self._lock:
+            files = {}
+            for filename in self.workspace_index.file_names():
+                metadata = self.workspace_index.metadata(filename)
+                if metadata is None:
+                    continue
+                try:
+                    files[filename] = self._put_blob(filename, metadata["sha256"])
+                except FileNotFoundError:
+                    continue # Deleted while the snapshot was taken
+            paths = self._manifest_paths()
+            if paths:
+                latest = self.manifest(paths[-1].stem)
+                if latest["files"] == files:
+                    return latest["id"]
+            snapshot_id = f"{int(paths[-1].stem) + 1 if paths else 1:08d}"
+            manifest = {"id": snapshot_id, "created_at": time.time(), "label": label, "files": files}
+            generation.atomic_write_bytes(self.manifest_dir / f"{snapshot_id}.json", json.dumps(manifest).encode("utf-8"))
+            self._prune()
+            return snapshot_id
+
+    def _prune(self):
+        paths = self._manifest_paths()
+        if len(paths) <= self.max_snapshots:
+            return
+        for path in paths[:len(paths) - self.max_snapshots]:
+            path.unlink(missing_ok=True)
+        referenced = {digest for manifest in self.snapshots() for digest in manifest["files"].values()}
+        for blob_path in self.blob_dir.glob("*/*"):
+            if blob_path.parent.name + blob_path.name not in referenced:
+                blob_path.unlink(missing_ok=True)
+
+    def restore(self, snapshot_id):
+        """Makes the workspace match a snapshot. Returns (written filenames, deleted filenames)."""
+        with self._lock:
+            target = self.manifest(snapshot_id)["files"]
+            written, deleted = [], []
+            for filename, digest in target.items():
+                metadata = self.workspace_index.metadata(filename)
+                if metadata is None or metadata["sha256"] != digest:
+                    generation.atomic_write_bytes(self.workspace_dir / filename, self.read_blob(digest))
+                    written.append(filename)
+            for filename in self.workspace_index.file_names():
+                if filename not in target:
+                    (self.workspace_dir / filename).unlink(missing_ok=True)
+                    deleted.append(filename)
+            self.workspace_index.invalidate()
+            return written, deleted
+
+    def begin(self, label):
+        """Starts a transaction. Returns (transaction id, base snapshot id)."""
+        base_id = self.snapshot(label)
+        transaction_id = f"{time.time_ns()}_{os.getpid()}_{threading.get_ident()}"
+        generation.atomic_write_bytes(self.journal_dir / f"{transaction_id}.json", json.dumps({"base": base_id}).encode("utf-8"))
+        return transaction_id, base_id
+
+    def _read_journal(self, transaction_id):
+        with open(self.journal_dir / f"{transaction_id}.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def record_change(self, transaction_id, filename, digest):
+        """Journals that the transaction is about to write `filename` with content `digest` (None: delete it).
+
+        Recorded before the change: if the process dies before the write, the file's hash
+        does not match and recovery leaves it alone.
+        """
+        with self._lock:
+            journal = self._read_journal(transaction_id)
+            journal.setdefault("files", {})[filename] = digest
+            generation.atomic_write_bytes(self.journal_dir / f"{transaction_id}.json", json.dumps(journal).encode("utf-8"))
+
+    def _undo_changes(self, base_id, changes):
+        """Puts back the base version of each file in `changes` ({filename: hash written, or None if
+        deleted}) that still holds what was written. Returns (written filenames, deleted filenames)."""
+        with self._lock:
+            base_files = self.manifest(base_id)["files"]
+            self.workspace_index.invalidate()
+            written, deleted = [], []
+            for filename, digest in changes.items():
+                metadata = self.workspace_index.metadata(filename)
+                if (metadata["sha256"] if metadata else None) != digest:
+                    continue # Changed again since (e.g. saved from the editor): keep it
+                if filename in base_files:
+                    generation.atomic_write_bytes(self.workspace_dir / filename, self.read_blob(base_files[filename]))
+                    written.append(filename)
+                elif metadata is not None:
+                    (self.workspace_dir / filename).unlink(missing_ok=True)
+                    deleted.append(filename)
+            self.workspace_index.invalidate()
+            return written, deleted
+
+    def commit(self, transaction_id, label):
+        """Ends a transaction, keeping its changes. Returns the resulting snapshot id."""
+        snapshot_id = self.snapshot(label)
+        (self.journal_dir / f"{transaction_id}.json").unlink(missing_ok=True)
+        return snapshot_id
+
+    def rollback(self, transaction_id, base_id):
+        """Ends a transaction, undoing the changes it journaled. Returns (written filenames, deleted filenames)."""
+        changes = self._undo_changes(base_id, self._read_journal(transaction_id).get("files", {}))
+        (self.journal_dir / f"{transaction_id}.json").unlink(missing_ok=True)
+        return changes
+
+    def _recover_interrupted(self):
+        """Rolls back transactions a previous process never finished, newest first."""
+        journal_paths = sorted(self.journal_dir.glob("*.json"), reverse=True)
+        for path in journal_paths:
             try:
-                content_str = json.dumps(content)
-            except Exception: content_str = str(content)
+                journal = self._read_journal(path.stem)
+                self._undo_changes(journal["base"], journal.get("files", {}))
+            except (OSError, ValueError, KeyError):
+                pass # Unreadable entry or pruned base snapshot: nothing left to roll back to
+            path.unlink(missing_ok=True)
+        return len(journal_paths)
+
+def get_snapshot_store(root, workspace_root):
+    """One store per workspace, shared by every session; opening it recovers interrupted transactions."""
+    return get_session_resources().snapshot_store(root, workspace_root)
+
+def _workspace_snapshot_store():
+    return get_snapshot_store(str(SNAPSHOT_DIR / WORKSPACE_ID), str(WORKSPACE_DIR))
+
+def restore_workspace_snapshot(snapshot_id, description):
+    """Button callback: rolls the workspace back to a snapshot, after snapshotting the current state."""
+    if st.session_state.ai_job is not None: # Would undo the running request's transaction underneath it
+        st.warning("Wait for the AI request to finish (or cancel it) before undoing.")
+        return
+    store = _workspace_snapshot_store()
+    try:
+        store.snapshot(f"Before restoring {description}") # Keeps the restore itself undoable
+        written, deleted = store.restore(snapshot_id)
+    except (OSError, ValueError, KeyError) as e:
+        st.error(f"Could not restore the workspace: {e}")
+        return
+    _sync_workspace_after_restore(written, deleted)
+    st.toast(f"Restored {description}: {len(written)} file(s) rewritten, {len(deleted)} removed", icon="↩️")
+
+def _sync_workspace_after_restore(written, deleted):
+    _invalidate_workspace_files()
+    for filename in deleted:
+        if get_preview_manager().get(filename):
+            stop_preview(filename, rerun=False)
+    selected = st.session_state.selected_file
+    if selected in deleted:
+        st.session_state.selected_file = None
+        _load_editor_buffer("")
+    elif selected in written:
+        _load_editor_buffer(read_file(selected) or "")
+
+# --- Static Validation ---
+class ValidationCache:
+    """Process-wide validation results keyed by file content hash (LRU-bounded)."""
+
+    def __init__(self, max_entries=VALIDATION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()
+        self._pending = {} # content hash -> Future of a background validation
+
+    def get(self, content_hash):
+        with self._lock:
+            result = self._results.get(content_hash)
+            if result is not None:
+                self._results.move_to_end(content_hash)
+            return result
+
+    def put(self, content_hash, result):
+        with self._lock:
+            self._results[content_hash] = result
+            self._results.move_to_end(content_hash)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def validate_in_background(self, pool, content_hash, filename, content):
+        with self._lock:
+            if content_hash in self._results or content_hash in self._pending:
+                return
+            future = pool.submit(code_validation.validate_job, (content_hash, filename, content))
+            self._pending[content_hash] = future
+        future.add_done_callback(lambda done: self._store_background_result(content_hash, done))
+
+    def _store_background_result(self, content_hash, future):
+        with self._lock:
+            self._pending.pop(content_hash, None)
+        try:
+            self.put(*future.result())
+        except Exception:
+            pass # e.g. a crashed worker; the file stays unchecked until it is saved or validated again
+
+@st.cache_resource
+def get_validation_cache():
+    return ValidationCache()
+
+class ValidationWorkerError(RuntimeError):
+    """A validation worker process died or answered with something unreadable."""
+
+class ValidationWorkerPool:
+    """Validates files in separate interpreters running validation_worker.py.
+
+    Workers are started with subprocess rather than forked from the server, so they do not
+    inherit its listening socket, the preview pipes or its threads. Each job runs on one
+    of `max_workers` threads, which borrows an idle worker (or starts one) for the round
+    trip; a worker that fails is killed and replaced by the next job.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="geniecraft-validation")
+        self._idle_workers = []
+        self._lock = threading.Lock()
+
+    def _spawn_worker(self):
+        return subprocess.Popen(
+            [sys.executable, str(VALIDATION_WORKER_SCRIPT)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8', close_fds=True,
+        )
+
+    def _run(self, job):
+        """(key, filename, source) -> (key, result), like code_validation.validate_job."""
+        with self._lock:
+            worker = self._idle_workers.pop() if self._idle_workers else None
+        if worker is None or worker.poll() is not None:
+            worker = self._spawn_worker()
+        try:
+            worker.stdin.write(json.dumps(list(job)) + "\n")
+            worker.stdin.flush()
+            key, result = json.loads(worker.stdout.readline())
+        except (OSError, ValueError) as e: # Broken pipe, or EOF/garbage from a crashed worker
+            worker.kill()
+            raise ValidationWorkerError(f"validation worker failed: {e}") from None
+        with self._lock:
+            self._idle_workers.append(worker)
+        return key, result
+
+    def submit(self, job):
+        return self._executor.submit(self._run, job)
+
+    def map(self, jobs):
+        return self._executor.map(self._run, jobs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            workers, self._idle_workers = self._idle_workers, []
+        for worker in workers:
+            try:
+                worker.stdin.close() # Worker exits when stdin closes
+            except OSError:
+                worker.kill()
+
+@st.cache_resource
+def get_validation_pool():
+    """Worker processes for validating large files and many files at once; None if the worker script is missing."""
+    if VALIDATION_MAX_WORKERS <= 0 or not VALIDATION_WORKER_SCRIPT.is_file():
+        return None
+    pool = ValidationWorkerPool(VALIDATION_MAX_WORKERS)
+    atexit.register(pool.shutdown)
+    return pool
+
+def validate_workspace_file(filename, content):
+    """Validates one file and returns its problems.
+
+    Typical files take milliseconds and are checked in-process; large ones (parsing alone
+    takes seconds) go to a worker process and report an empty list until the result lands.
+    """
+    content_hash = _content_hash(content)
+    cache = get_validation_cache()
+    result = cache.get(content_hash)
+    if result is None:
+        pool = get_validation_pool()
+        if len(content) > VALIDATION_INLINE_MAX_BYTES and pool is not None:
+            cache.validate_in_background(pool, content_hash, filename, content)
+            return []
+        result = code_validation.validate_source(content, filename)
+        cache.put(content_hash, result)
+    return generation.effective_problems(result, get_workspace_python_files())
+
+def cached_validation_problems(filename):
+    """Problems from an earlier validation of the file's current content, or None if it was never checked."""
+    metadata = get_workspace_index(str(WORKSPACE_DIR)).metadata(filename)
+    if metadata is None:
+        return None
+    result = get_validation_cache().get(metadata["sha256"])
+    return None if result is None else generation.effective_problems(result, get_workspace_python_files())
+
+def validate_workspace():
+    """Validates every workspace file, fanning uncached ones out over the worker processes.
+
+    Returns {filename: problems}.
+    """
+    filenames = get_workspace_python_files()
+    cache = get_validation_cache()
+    jobs = []
+    for filename in filenames:
+        metadata = get_workspace_index(str(WORKSPACE_DIR)).metadata(filename)
+        if metadata is None or cache.get(metadata["sha256"]) is not None:
+            continue
+        content = read_file(filename)
+        if content is not None:
+            jobs.append((_content_hash(content), filename, content))
+    if len(jobs) > 1 and get_validation_pool() is not None:
+        try:
+            for content_hash, result in get_validation_pool().map(jobs):
+                cache.put(content_hash, result)
+            jobs = []
+        except ValidationWorkerError: # Finish the rest of this batch in-process
+            jobs = [job for job in jobs if cache.get(job[0]) is None]
+    for content_hash, filename, content in jobs:
+        cache.put(content_hash, code_validation.validate_source(content, filename))
+    return {filename: cached_validation_problems(filename) or [] for filename in filenames}
+
+# --- Workspace Symbol Index ---
+class SymbolIndex:
+    """Process-wide file outlines keyed by file content hash (LRU-bounded).
+
+    A file is only re-parsed after its hash changes; the hash itself comes from the
+    WorkspaceIndex, which recomputes it only when the file's size or mtime moved.
+    """
+
+    def __init__(self, max_entries=SYMBOL_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.parses = 0 # Files parsed, for diagnostics
+        self._lock = threading.Lock()
+        self._outlines = collections.OrderedDict()
+
+    def outline(self, root, filename, metadata):
+        """Outline of a workspace file (see symbol_index), or None if it is too large or unreadable."""
+        content_hash = metadata["sha256"]
+        with self._lock:
+            cached = self._outlines.get(content_hash)
+            if cached is not None:
+                self._outlines.move_to_end(content_hash)
+                return cached
+        if metadata["size"] > SYMBOL_INDEX_MAX_BYTES:
+            return None
+        try:
+            with open(Path(root) / filename, "r", encoding="utf-8") as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+        outline = symbol_index.extract_symbols(content, filename)
+        with self._lock:
+            self.parses += 1
+            self._outlines[content_hash] = outline
+            while len(self._outlines) > self.max_entries:
+                self._outlines.popitem(last=False)
+        return outline
+
+@st.cache_resource
+def get_symbol_index():
+    return SymbolIndex()
+
+def _latest_user_prompt(chat_history):
+    for msg in reversed(chat_history):
+        if msg["role"] == "user" and isinstance(msg["content"], str):
+            return msg["content"]
+    return ""
+
+def _symbol_label(symbol):
+    if symbol["kind"] == "widget":
+        return f"{symbol['name']}" + (f" {symbol['label']!r}" if symbol.get("label") else "") + f" L{symbol['line']}"
+    if symbol["kind"] == "import":
+        return f"import {symbol['name']} L{symbol['line']}"
+    prefix = "class" if symbol["kind"] == "class" else "def"
+    return f"{prefix} {symbol['name']} L{symbol['line']}-{symbol['end_line']}"
+
+def _ranked_context_files(prompt):
+    """Outlines of the workspace files, ranked against `prompt` by symbol_index.rank_files."""
+    workspace_index = get_workspace_index(str(WORKSPACE_DIR))
+    symbols = get_symbol_index()
+    outlines = {}
+    for filename in get_workspace_python_files():
+        metadata = workspace_index.metadata(filename)
+        outline = symbols.outline(WORKSPACE_DIR, filename, metadata) if metadata else None
+        if outline is not None:
+            outlines[filename] = outline
+    return symbol_index.rank_files(outlines, prompt, st.session_state.selected_file)
+
+def _file_excerpts(lines, symbols):
+    """Merged line spans around the matched symbols, each cut to GEMINI_CONTEXT_SNIPPET_MAX_LINES."""
+    spans = []
+    for symbol in symbols:
+        start, end = symbol["line"], symbol["end_line"] or symbol["line"]
+        if symbol["kind"] == "widget":
+            start, end = max(start - 2, 1), min(end + 2, len(lines)) # A little surrounding layout
+        spans.append((start, min(end, start + GEMINI_CONTEXT_SNIPPET_MAX_LINES - 1)))
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
         else:
-            content_str = str(content)
-        if content_str:
-            gemini_history.append({"role": api_role, "parts": [{"text": content_str}]})
-    return gemini_history
+            merged.append((start, end))
+    return [f"# lines {start}-{end}\n" + "\n".join(lines[start - 1:end]) for start, end in merged]
 
-def ask_gemini_ai(chat_history):
-    current_files = get_workspace_python_files()
-    # Dynamically update the file list in the system prompt
-    updated_system_prompt = GEMINI_SYSTEM_PROMPT.replace(
-        "Current Python files in workspace: " + GEMINI_SYSTEM_PROMPT.split("Current Python files in workspace: ")[1].split("\n")[0],
-        f"Current Python files in workspace: {', '.join(current_files) if current_files else 'None'}"
+def _relevant_workspace_context(prompt, token_budget=GEMINI_CONTEXT_TOKEN_BUDGET):
+    """Workspace code relevant to `prompt`, as a system prompt section under `token_budget`.
+
+    Files are ranked by how many prompt words match their name and symbols (functions,
+    classes, imports, widget labels). Small files go in whole; larger ones as an outline
+    plus the matching functions/classes/widgets. Returns (section text, stats).
+    """
+    stats = {"context_tokens": 0, "context_files": 0}
+    if token_budget <= 0 or not prompt:
+        return "", stats
+    heading = (
+        "\nWorkspace code relevant to the latest request (other files and parts are not shown; "
+        "\"# lines\" markers are not part of the files). Copy \"search\" text for patches from here:\n"
     )
-    gemini_api_history = _prepare_gemini_history(chat_history, updated_system_prompt)
+    remaining = token_budget - _estimate_tokens(heading)
+    sections = []
+    for _, filename, outline, matched in _ranked_context_files(prompt):
+        try:
+            with open(WORKSPACE_DIR / filename, "r", encoding="utf-8") as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        file_tokens = _estimate_tokens(content)
+        if (file_tokens <= GEMINI_CONTEXT_FULL_FILE_TOKENS or filename in prompt) and file_tokens + 20 <= remaining:
+            section = f"--- {filename} ({outline['lines']} lines, complete) ---\n{content}"
+        else:
+            outline_text = ", ".join(_symbol_label(s) for s in outline["symbols"] if s["kind"] != "import")
+            section = f"--- {filename} ({outline['lines']} lines, excerpts) ---\nOutline: {outline_text or 'no functions or widgets'}"
+            if _estimate_tokens(section) > remaining:
+                section = f"--- {filename} ({outline['lines']} lines, excerpts) ---"
+            lines = content.splitlines()
+            for excerpt in _file_excerpts(lines, matched):
+                if _estimate_tokens(section) + _estimate_tokens(excerpt) + 1 > remaining:
+                    break
+                section += "\n" + excerpt
+        section_tokens = _estimate_tokens(section) + 1
+        if section_tokens > remaining:
+            continue
+        sections.append(section)
+        remaining -= section_tokens
+        stats["context_files"] += 1
+    if not sections:
+        return "", stats
+    text = heading + "\n".join(sections)
+    stats["context_tokens"] = _estimate_tokens(text)
+    return text, stats
+
+# --- AI Interaction Functions (largely unchanged, minor logging/error improvements) ---
+def _sync_editor_after_ai_write(filename, content):
+    if st.session_state.selected_file == filename:
+        _load_editor_buffer(content) # Important to sync editor
+
+class _SessionWorkspace:
+    """This session's workspace as seen by generation.execute_command: the file functions
+    above, with their toasts, plus editor syncing after writes.
+
+    Writes and deletes are journaled in the AI job's transaction (`transaction_id`), so a
+    failed request rolls back exactly those files. `rewrite` is the Future of the full
+    file for a patch that did not apply; the AI job generates it on its worker thread (see
+    `_awaiting_rewrite`) before the patch is executed.
+    """
+
+    def __init__(self, transaction_id=None, rewrite=None):
+        self.transaction_id = transaction_id
+        self.rewrite = rewrite
+
+    def _journal(self, filename, digest):
+        if self.transaction_id is None:
+            return
+        try:
+            _workspace_snapshot_store().record_change(self.transaction_id, filename, digest)
+        except (OSError, ValueError) as e:
+            st.warning(f"Workspace snapshot failed; the change to {filename} cannot be rolled back ({e}).")
+
+    def read(self, filename):
+        return read_file(filename)
+
+    def write(self, filename, content):
+        self._journal(filename, _content_hash(content))
+        if not save_file(filename, content):
+            return False
+        _sync_editor_after_ai_write(filename, content)
+        return True
+
+    def delete(self, filename):
+        self._journal(filename, None)
+        return delete_file_from_workspace(filename)
+
+    def validation_problems(self, filename):
+        return cached_validation_problems(filename) # Validated by save_file
+
+    def request_rewrite(self, filename, current_content, hunks, conflicts):
+        if self.rewrite is None: # The file changed after the job checked the patch
+            st.error(f"Full-file fallback for '{filename}' was not prepared; the patch was not applied.")
+            return None
+        try:
+            response_text = self.rewrite.result()
+            content = generation.rewritten_content(response_text, filename) if response_text is not None else None
+        except Exception as e:
+            st.error(f"Full-file fallback for '{filename}' failed: {e}")
+            return None
+        if content is None:
+            st.error(f"Full-file fallback for '{filename}' did not return the file.")
+        return content
+
+    def notify(self, level, message):
+        (st.error if level == "error" else st.warning)(message)
+
+def _queue_response(job, response_text, skip_commands=0):
+    """Parses a complete response with generation.execute_response and queues its commands for `pump_ai_job`.
+
+    The first `skip_commands` commands are skipped; the streaming path uses this after it
+    already applied the commands that preceded a damaged part of the response. Chat
+    entries about parse problems are queued after the commands.
+    """
+    def queue_command(command_data, workspace):
+        job.pending.append(command_data)
+        return []
+
+    with job.perf.phase("json_parse"):
+        entries, repairs, job.response_error = generation.execute_response(response_text, _SessionWorkspace(), skip_commands, queue_command)
+    job.pending.extend(entries)
+    _record_json_repairs(repairs, job.perf)
+
+def _awaiting_rewrite(job, command_data):
+    """True while `command_data` is a patch whose full-file fallback is still being generated.
+
+    A patch that does not apply to the current file gets its fallback request started on
+    the job's worker thread here, so the script thread never waits on the model.
+    """
+    rewrite = job.rewrites.get(id(command_data))
+    if rewrite is not None:
+        return not rewrite[1].done()
+    if not isinstance(command_data, dict) or command_data.get("action") != "patch":
+        return False
+    filename, hunks = command_data.get("filename"), command_data.get("hunks")
+    if not isinstance(filename, str) or ".." in filename or not isinstance(hunks, list) or not hunks:
+        return False # Reported when the command is executed
+    if not (WORKSPACE_DIR / filename).is_file():
+        return False
+    current_content = read_file(filename)
+    if current_content is None:
+        return False
+    _, conflicts = generation.apply_patch_hunks(current_content, hunks)
+    if not conflicts:
+        return False
+    request = generation.full_rewrite_request(_system_prompt_with_files(), filename, current_content, hunks, conflicts)
+    job.request_rewrite(command_data, request)
+    return True
+
+def _record_json_repairs(repairs, recorder):
+    counts = st.session_state.json_repair_counts
+    for name in repairs:
+        counts[name] = counts.get(name, 0) + 1
+        recorder.count(f"json_repair_{name}")
+
+def _estimate_tokens(text):
+    return -(-len(text) // GEMINI_CHARS_PER_TOKEN) if text else 0
+
+def _compacted_payload_tokens(command):
+    chars = _command_text_size(command, "content")[0] if _command_has_text(command, "content") else 0
+    return -(-chars // GEMINI_CHARS_PER_TOKEN) if chars else _estimate_tokens(json.dumps(command.get("hunks", "")))
+
+def _compact_command(command):
+    """Replaces a past create_update payload with a short reference to the workspace file."""
+    if isinstance(command, dict) and command.get("action") == "patch":
+        return {"action": "patch", "filename": command.get("filename"), "hunks": "<patch applied; see the workspace file>"}
+    if not isinstance(command, dict) or command.get("action") != "create_update" or not _command_has_text(command, "content"):
+        return command
+    line_count = _command_text_size(command, "content")[1]
+    return {
+        "action": "create_update",
+        "filename": command.get("filename"),
+        "content": f"<{line_count} lines omitted; the current version of this file is in the workspace>",
+    }
+
+_UI_ONLY_COMMAND_KEYS = ("diff", "diff_ref", "fallback") # Added locally when commands run; never sent back to the model
+
+def _history_message_text(msg, compact):
+    content = msg["content"]
+    if msg["role"] == "assistant" and isinstance(content, list):
+        if not compact: # Drop UI-only fields such as the rendered diff of a patch
+            content = [{k: v for k, v in c.items() if k not in _UI_ONLY_COMMAND_KEYS} if isinstance(c, dict) else c for c in content]
+        try: # Code stored out of line is only loaded for the messages sent verbatim
+            return json.dumps([_hydrate_command(_compact_command(c) if compact else c) for c in content])
+        except Exception: return str(content)
+    return str(content)
+
+def _prepare_gemini_history(chat_history, system_prompt_with_context, token_budget=GEMINI_HISTORY_TOKEN_BUDGET):
+    """Builds the Gemini request history under a token budget.
+
+    The newest GEMINI_HISTORY_VERBATIM_MESSAGES messages are sent as-is; older assistant
+    messages have their file contents collapsed to references (the workspace holds the
+    current code anyway). If the prompt is still over budget, the oldest turns are dropped.
+    Size statistics are stored in `st.session_state.history_stats`.
+    """
+    gemini_history = generation.request_header(system_prompt_with_context)
+    header_tokens = sum(_estimate_tokens(entry["parts"][0]["text"]) for entry in gemini_history)
+
+    verbatim_from = len(chat_history) - GEMINI_HISTORY_VERBATIM_MESSAGES
+    turns = [] # (gemini entry, estimated tokens sent, estimated tokens without compaction)
+    for index, msg in enumerate(chat_history):
+        api_role = "model" if msg["role"] == "assistant" else "user"
+        content_str = _history_message_text(msg, compact=index < verbatim_from)
+        if not content_str:
+            continue
+        sent_tokens = _estimate_tokens(content_str)
+        full_tokens = sent_tokens
+        if index < verbatim_from and isinstance(msg["content"], list):
+            # Add back what compaction removed, without re-serializing the full payloads.
+            full_tokens += sum(_compacted_payload_tokens(c) for c in msg["content"] if _compact_command(c) is not c)
+        turns.append(({"role": api_role, "parts": [{"text": content_str}]}, sent_tokens, full_tokens))
+
+    uncompacted_tokens = header_tokens + sum(full for _, _, full in turns)
+    total_tokens = header_tokens + sum(sent for _, sent, _ in turns)
+    dropped_messages = 0
+    # Drop the oldest turns until under budget, always keeping the latest message and
+    # restarting on a user turn so roles keep alternating after the model's acknowledgement.
+    while len(turns) > 1 and (total_tokens > token_budget or turns[0][0]["role"] != "user"):
+        total_tokens -= turns.pop(0)[1]
+        dropped_messages += 1
+    gemini_history.extend(entry for entry, _, _ in turns)
+
+    if GEMINI_COUNT_TOKENS_REMOTELY:
+        try:
+            total_tokens = _generative_model().count_tokens(gemini_history).total_tokens
+        except Exception: pass # Keep the local estimate
+    st.session_state.history_stats = {
+        "prompt_tokens": total_tokens,
+        "tokens_saved": max(uncompacted_tokens - total_tokens, 0),
+        "messages_dropped": dropped_messages,
+        "token_budget": token_budget,
+    }
+    return gemini_history
+
+def _system_prompt_with_files(workspace_context=""):
+    return generation.system_prompt(get_workspace_python_files(), workspace_context)
+
+def _build_gemini_request(chat_history):
+    with perf.phase("context_index"):
+        workspace_context, context_stats = _relevant_workspace_context(_latest_user_prompt(chat_history))
+    with perf.phase("history_prep"):
+        request = _prepare_gemini_history(chat_history, _system_prompt_with_files(workspace_context))
+    st.session_state.history_stats.update(context_stats)
+    return request
+
+def _record_token_usage(recorder, response, response_text):
+    """Counts prompt/response tokens, from the API's usage metadata when it is available."""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None) or (st.session_state.history_stats or {}).get("prompt_tokens", 0)
+    response_tokens = getattr(usage, "candidates_token_count", None) or _estimate_tokens(response_text)
+    recorder.count("prompt_tokens", prompt_tokens)
+    recorder.count("response_tokens", response_tokens)
+
+def _gemini_error_content(e, response=None):
+    error_message = f"Gemini API call failed: {type(e).__name__}"
+    st.error(f"🔴 {error_message}: {e}")
+    error_content = f"AI Error: {str(e)[:150]}..."
+    if "API key not valid" in str(e): error_content = "AI Error: Invalid Google API Key."
+    elif "429" in str(e) or "quota" in str(e).lower() or "resource has been exhausted" in str(e).lower(): error_content = "AI Error: API Quota or Rate Limit Exceeded."
     try:
-        # print(f"DEBUG: Sending history:\n{json.dumps(gemini_api_history, indent=2)}") # For debugging
-        response = model.generate_content(gemini_api_history)
-        # print(f"DEBUG: Received response:\n{response.text}") # For debugging
-        return response.text
-    except Exception as e:
-        error_message = f"Gemini API call failed: {type(e).__name__}"
-        st.error(f"🔴 {error_message}: {e}")
-        error_content = f"AI Error: {str(e)[:150]}..."
-        # ... (rest of error handling from provided code)
-        if "API key not valid" in str(e): error_content = "AI Error: Invalid Google API Key."
-        elif "429" in str(e) or "quota" in str(e).lower() or "resource has been exhausted" in str(e).lower(): error_content = "AI Error: API Quota or Rate Limit Exceeded."
+         if response and response.prompt_feedback and response.prompt_feedback.block_reason:
+             error_content = f"AI Error: Input blocked by safety filters ({response.prompt_feedback.block_reason})."
+         elif response and response.candidates and response.candidates[0].finish_reason != 'STOP':
+              error_content = f"AI Error: Response stopped ({response.candidates[0].finish_reason}). May be due to safety filters or length."
+    except Exception: pass
+    return error_content
+
+def _cached_response_lookup(gemini_api_history):
+    """Returns (cache, key, cached_text); all None when the response cache is disabled."""
+    cache = get_response_cache()
+    if not cache:
+        return None, None, None
+    key = cache.make_key(generation.GEMINI_MODEL_NAME, gemini_api_history, get_workspace_python_files())
+    return cache, key, cache.get(key)
+
+# --- Background AI Requests ---
+@st.cache_resource
+def get_rate_limiter():
+    """The API quota is per key, so one limiter serves every session."""
+    return generation.RequestRateLimiter(GEMINI_REQUESTS_PER_MINUTE)
+
+class AIRequestJob:
+    """One Gemini request running on a background thread, so the script thread stays free.
+
+    The worker only talks to the model and parses: completed commands are queued in
+    `pending` and applied by the script thread (`pump_ai_job`), because executing them
+    writes files and touches session state. Full-file fallbacks for patches that did not
+    apply are model calls too, so they run on a worker thread of the job (`request_rewrite`)
+    while their patch waits in the queue. `cancel` abandons the request; a worker still
+    waiting on the network exits when its next chunk arrives and its output is ignored.
+    """
+
+    # Checked instead of isinstance: every rerun redefines these classes, so a job started
+    # in an earlier run is not an instance of this run's PlannedAIRequestJob.
+    planner_mode = False
+
+    def __init__(self, generative_model, request_history, stream, cache=None, cache_key=None, cached_text=None,
+                 rate_limiter=None, workspace_files=()):
+        self.generative_model = generative_model
+        self.request_history = request_history
+        self.stream = stream
+        self.cache = cache
+        self.cache_key = cache_key
+        self.cached_text = cached_text
+        self.rate_limiter = rate_limiter
+        self.workspace_files = list(workspace_files) # Part of the cache keys; read on the script thread
+        self.parser = generation.StreamingCommandParser()
+        self.pending = collections.deque() # Parsed commands not applied yet (append/popleft are thread-safe)
+        self.pending_texts = collections.deque() # Complete responses, parsed and applied by the script thread
+        self.planned_files = None # Planner mode: [{"filename", "description"}] once the plan is known
+        self.completed_files = 0
+        self.transaction = None # (transaction id, base snapshot id) from SnapshotStore.begin
+        self.executed_entries = []
+        self.response = None
+        self.response_text = None # Full text of a non-streamed response
+        self.error = None
+        self.received_chars = 0
+        self.model_seconds = 0.0  # Time spent waiting on the model
+        self.parse_seconds = 0.0
+        self.call_results = [] # (response, text) of every `_call`, for token accounting
+        self.cache_hits = 0
+        self.rewrites = {} # id(patch command) -> (command, Future of the full-file response)
+        self.response_queued = False # The final response was handed to `_queue_response`
+        self.response_error = None # What recover_ai_commands could not parse in it, if anything
+        self.started_at = time.time()
+        self.perf = PerfRecorder(kind="ai_request") # Applied on the script thread, flushed by finish_ai_job
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="geniecraft-ai-request", daemon=True)
+        self._rewrite_executor = None
+        self._results_lock = threading.Lock()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def finished(self):
+        return self._done.is_set() or self.cancelled
+
+    @property
+    def raw_text(self):
+        return self.parser.raw_text if self.stream else (self.response_text or "")
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _call(self, request):
+        """One non-streamed model call (or cache hit). Returns the response text, or None if cancelled."""
+        cache_key = self.cache.make_key(generation.GEMINI_MODEL_NAME, request, self.workspace_files) if self.cache else None
+        cached_text = self.cache.get(cache_key) if cache_key else None
+        if cached_text is not None:
+            with self._results_lock:
+                self.cache_hits += 1
+            return cached_text
+        if self.rate_limiter and not self.rate_limiter.acquire(self._cancelled):
+            return None
+        if self._cancelled.is_set():
+            return None
+        waited_from = time.perf_counter()
+        response = self.generative_model.generate_content(request)
+        text = response.text
+        with self._results_lock:
+            self.model_seconds += time.perf_counter() - waited_from
+            self.received_chars += len(text)
+            self.call_results.append((response, text))
+        if self.cache:
+            self.cache.put(cache_key, text)
+        return text
+
+    def request_rewrite(self, command_data, request):
+        """Starts the full-file fallback of a patch command on this job's rewrite thread."""
+        if self._rewrite_executor is None:
+            self._rewrite_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="geniecraft-ai-rewrite")
+        self.rewrites[id(command_data)] = (command_data, self._rewrite_executor.submit(self._call, request))
+
+    def take_rewrite(self, command_data):
+        """The Future started for `command_data` by `request_rewrite`, or None."""
+        return self.rewrites.pop(id(command_data), (None, None))[1]
+
+    def close(self):
+        if self._rewrite_executor is not None:
+            self._rewrite_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        try:
+            if self.cached_text is not None:
+                chunks = iter([generation.TextResponse(self.cached_text)]) # Replay the cached response as a single chunk
+            else:
+                if self.rate_limiter and not self.rate_limiter.acquire(self._cancelled):
+                    return
+                waited_from = time.perf_counter()
+                self.response = self.generative_model.generate_content(self.request_history, stream=self.stream)
+                self.model_seconds += time.perf_counter() - waited_from
+                chunks = iter(self.response) if self.stream else iter([self.response])
+            while not self._cancelled.is_set():
+                waited_from = time.perf_counter()
+                chunk = next(chunks, None) # Waits for the next streamed chunk
+                self.model_seconds += time.perf_counter() - waited_from
+                if chunk is None:
+                    break
+                try:
+                    chunk_text = chunk.text
+                except ValueError:
+                    continue # Chunk without text parts (e.g. only safety metadata)
+                self.received_chars += len(chunk_text)
+                if not self.stream:
+                    self.response_text = chunk_text # Parsed by the script thread, with recovery
+                    break
+                parse_from = time.perf_counter()
+                self.pending.extend(self.parser.feed(chunk_text))
+                self.parse_seconds += time.perf_counter() - parse_from
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+def _with_planner_instruction(request_history, instruction):
+    """Copy of the request with `instruction` appended to its last (user) message, so roles keep alternating."""
+    last_entry = request_history[-1]
+    text = "".join(part.get("text", "") for part in last_entry["parts"]) + generation.GEMINI_PLANNER_SEPARATOR + instruction
+    return request_history[:-1] + [{"role": last_entry["role"], "parts": [{"text": text}]}]
+
+def _parse_file_plan(plan_text):
+    """The [{"filename", "description"}] entries of a planner response; [] if it is not a usable plan."""
+    try:
+        plan = json.loads(generation.clean_response_text(plan_text))
+    except ValueError:
+        return []
+    if isinstance(plan, dict):
+        plan = plan.get("files")
+    files, seen = [], set()
+    for entry in plan if isinstance(plan, list) else []:
+        filename = entry.get("filename") if isinstance(entry, dict) else None
+        if not isinstance(filename, str) or not filename.endswith(".py") or filename in seen:
+            continue
+        if ".." in filename or filename.startswith(("/", "\\")):
+            continue
+        seen.add(filename)
+        files.append({"filename": filename, "description": str(entry.get("description") or "as described in the request")})
+    return files[:GEMINI_PLANNER_MAX_FILES]
+
+class PlannedAIRequestJob(AIRequestJob):
+    """Planner mode: one cheap call lists the files to produce, then each file is generated
+    by its own call on a bounded thread pool.
+
+    Complete responses are queued in `pending_texts`; the script thread parses them with
+    `_queue_response` and applies their commands. A plan with fewer than two files
+    falls back to one ordinary call. Every call waits for the shared rate limiter.
+    """
+
+    planner_mode = True
+
+    def __init__(self, generative_model, request_history, max_workers, cache=None, workspace_files=(), rate_limiter=None):
+        super().__init__(generative_model, request_history, stream=False, cache=cache, rate_limiter=rate_limiter,
+                         workspace_files=workspace_files)
+        self.max_workers = max_workers
+        self.file_errors = []  # (filename, exception) of per-file calls that failed
+
+    def _generate_file(self, file_entry):
+        other_files = ", ".join(f"`{f['filename']}` ({f['description']})" for f in self.planned_files if f is not file_entry)
+        instruction = generation.GEMINI_PLANNER_FILE_INSTRUCTION.format(
+            filename=file_entry["filename"], description=file_entry["description"], other_files=other_files,
+        )
+        return self._call(_with_planner_instruction(self.request_history, instruction))
+
+    def _run(self):
+        try:
+            plan_text = self._call(_with_planner_instruction(self.request_history, generation.GEMINI_PLANNER_INSTRUCTION))
+            if plan_text is None:
+                return
+            files = _parse_file_plan(plan_text)
+            if len(files) < 2: # Nothing to fan out; answer the request directly
+                self.planned_files = []
+                text = self._call(self.request_history)
+                if text is not None:
+                    self.pending_texts.append(text)
+                return
+            self.planned_files = files
+            executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(files)), thread_name_prefix="geniecraft-ai-file")
+            futures = {executor.submit(self._generate_file, file_entry): file_entry for file_entry in files}
+            try:
+                for future in as_completed(futures):
+                    if self._cancelled.is_set():
+                        break
+                    try:
+                        text = future.result()
+                    except Exception as e:
+                        self.file_errors.append((futures[future]["filename"], e))
+                        continue
+                    if text is not None:
+                        self.pending_texts.append(text)
+                    self.completed_files += 1
+            finally:
+                executor.shutdown(wait=not self._cancelled.is_set(), cancel_futures=True)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+def _turn_label(chat_history):
+    prompt = chat_history[-1]["content"] if chat_history else ""
+    return str(prompt)[:80]
+
+def start_ai_request(chat_history, planned=False):
+    """Prepares the request on the script thread and starts it in the background.
+
+    The commands of the response are applied as one workspace transaction (see SnapshotStore).
+    """
+    gemini_api_history = _build_gemini_request(chat_history)
+    if planned:
+        job = PlannedAIRequestJob(
+            _generative_model(), gemini_api_history, GEMINI_PLANNER_MAX_WORKERS, cache=get_response_cache(),
+            workspace_files=get_workspace_python_files(), rate_limiter=get_rate_limiter(),
+        )
+    else:
+        cache, cache_key, cached_text = _cached_response_lookup(gemini_api_history)
+        if cached_text is not None:
+            perf.count("response_cache_hits")
+        job = AIRequestJob(
+            _generative_model(), gemini_api_history, GEMINI_STREAM_RESPONSES,
+            cache=cache, cache_key=cache_key, cached_text=cached_text, rate_limiter=get_rate_limiter(),
+            workspace_files=get_workspace_python_files(),
+        )
+    with perf.phase("snapshot"):
+        try:
+            job.transaction = _workspace_snapshot_store().begin(f"Before: {_turn_label(chat_history)}")
+        except OSError as e:
+            st.warning(f"Workspace snapshot failed; this response cannot be undone ({e}).")
+    return job.start()
+
+def _end_ai_transaction(job):
+    """Commits the job's workspace transaction, or rolls it back if the request failed. Returns the base snapshot id."""
+    if job.transaction is None:
+        return None
+    transaction_id, base_id = job.transaction
+    store = _workspace_snapshot_store()
+    with job.perf.phase("snapshot"):
         try:
-             if response and response.prompt_feedback and response.prompt_feedback.block_reason:
-                 error_content = f"AI Error: Input blocked by safety filters ({response.prompt_feedback.block_reason})."
-             elif response and response.candidates and response.candidates[0].finish_reason != 'STOP':
-                  error_content = f"AI Error: Response stopped ({response.candidates[0].finish_reason}). May be due to safety filters or length."
-        except Exception: pass
-        return json.dumps([{"action": "chat", "content": error_content}])
+            if job.error is not None and not job.cancelled:
+                written, deleted = store.rollback(transaction_id, base_id)
+                if written or deleted:
+                    _sync_workspace_after_restore(written, deleted)
+                    job.executed_entries.append({"action": "chat", "content": "The request failed, so the file changes it had made were rolled back."})
+            else:
+                store.commit(transaction_id, f"After: {_turn_label(st.session_state.messages)}")
+        except (OSError, ValueError, KeyError) as e:
+            st.warning(f"Workspace snapshot failed: {e}")
+            return None
+    return base_id
+
+def pump_ai_job(job):
+    """Applies the commands the worker has parsed so far, in order. Returns how many entries were added.
+
+    Stops at a patch whose full-file fallback is still being generated; later commands
+    may depend on that file.
+    """
+    added = 0
+    while job.pending_texts and not job.cancelled:
+        _queue_response(job, job.pending_texts.popleft())
+    while job.pending and not job.cancelled:
+        command_data = job.pending[0]
+        if _awaiting_rewrite(job, command_data):
+            break
+        job.pending.popleft()
+        with job.perf.phase("file_writes"):
+            workspace = _SessionWorkspace(job.transaction[0] if job.transaction else None, job.take_rewrite(command_data))
+            entries = generation.execute_command(command_data, workspace)
+        job.executed_entries.extend(entries)
+        added += len(entries)
+    return added
 
+def finish_ai_job(job):
+    """Records the finished (or cancelled) job as the assistant's chat message.
+
+    Returns False, without finishing, while a patch still waits for its full-file fallback;
+    the progress fragment calls it again on its next poll.
+    """
+    if not job.response_queued and not job.cancelled and job.error is None and not job.planner_mode:
+        job.response_queued = True
+        if not job.stream:
+            _queue_response(job, job.raw_text)
+        elif job.parser.damaged or not job.parser.array_closed or job.parser.emitted_count == 0:
+            # Malformed, truncated or missing array, or nothing came out of the stream:
+            # salvage the rest with the tolerant parser.
+            _queue_response(job, job.raw_text, skip_commands=job.parser.emitted_count)
+    pump_ai_job(job)
+    if job.pending and not job.cancelled:
+        return False
+    job.close()
+    job.perf.add("gemini_call", job.model_seconds)
+    job.perf.add("json_parse", job.parse_seconds)
+    if job.cancelled:
+        applied = sum(1 for entry in job.executed_entries if entry.get("action") != "chat")
+        job.executed_entries.append({"action": "chat", "content": f"Request cancelled. {applied} command(s) had already been applied."})
+    elif job.error is not None:
+        job.executed_entries.append({"action": "chat", "content": _gemini_error_content(job.error, job.response)})
+    elif job.planner_mode:
+        for filename, error in job.file_errors:
+            job.executed_entries.append({"action": "chat", "content": f"{filename}: {_gemini_error_content(error)}"})
+        job.perf.count("planned_files", len(job.planned_files or []))
+        if job.planned_files:
+            job.executed_entries.append({"action": "chat", "content": (
+                f"Planned {len(job.planned_files)} files and generated them concurrently "
+                f"in {time.time() - job.started_at:.1f}s ({len(job.call_results)} model calls)."
+            )})
+    elif job.cached_text is None:
+        _record_token_usage(job.perf, job.response, job.raw_text)
+        # Only well-formed responses are cached: a truncated or damaged one would be replayed until its TTL expires
+        if job.cache and job.response_error is None and (not job.stream or (job.parser.array_closed and not job.parser.damaged)):
+            job.cache.put(job.cache_key, job.raw_text)
+    for response, text in job.call_results: # Planned files and full-file fallbacks
+        _record_token_usage(job.perf, response, text)
+    job.perf.count("response_cache_hits", job.cache_hits)
+    # End-to-end time of the request, so planned and single-call requests can be compared
+    job.perf.add("ai_request_planned" if job.planner_mode else "ai_request_single", time.time() - job.started_at)
+    snapshot_before = _end_ai_transaction(job)
+    append_chat_message({"role": "assistant", "content": job.executed_entries, "snapshot_before": snapshot_before})
+    st.session_state.ai_job = None
+    job.perf.flush()
+    return True
 
 # --- Live Preview Process Management (largely unchanged, robust subprocess approach) ---
-def _find_available_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        return s.getsockname()[1]
+class PortAllocator:
+    """Hands out preview ports from a dedicated range.
+
+    Ports are reserved in-process until released, so concurrent starts never receive the
+    same port, and allocation walks the range round-robin so a just-released port is not
+    immediately reused. Each candidate is checked by a test bind before being handed out,
+    but another program can still take the port before the preview binds it; start_preview
+    then retries on the next port.
+    """
+
+    def __init__(self, first_port, last_port):
+        self.first_port = first_port
+        self.last_port = last_port
+        self._reserved = set()
+        self._next_port = first_port
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_free(port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.bind(('', port))
+                return True
+            except OSError:
+                return False
+
+    def allocate(self):
+        with self._lock:
+            span = self.last_port - self.first_port + 1
+            for _ in range(span):
+                port = self._next_port
+                self._next_port = self.first_port + (port + 1 - self.first_port) % span
+                if port not in self._reserved and self._is_free(port):
+                    self._reserved.add(port)
+                    return port
+        raise RuntimeError(f"No free preview port in {self.first_port}-{self.last_port}.")
+
+    def release(self, port):
+        with self._lock:
+            self._reserved.discard(port)
+
+@st.cache_resource
+def get_port_allocator():
+    """Ports are a machine-wide resource, so one allocator serves every session."""
+    return PortAllocator(*PREVIEW_PORT_RANGE)
+
+def _process_rss_bytes(pid):
+    """Resident memory of a process from /proc (Linux); 0 where that is unavailable."""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+def _read_process_stats(pid):
+    """Returns (cpu_seconds, rss_bytes, open_fds) for a process from /proc, or None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split() # Skip "pid (comm)"; comm may contain spaces
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+        open_fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return cpu_seconds, _process_rss_bytes(pid), open_fds
+
+def _describe_preview_exit(returncode):
+    if returncode == -getattr(signal, "SIGXCPU", -1):
+        return f"total CPU time limit of {PREVIEW_CPU_TIME_LIMIT_SECONDS}s exceeded"
+    if returncode == -signal.SIGKILL:
+        return "killed (hard resource limit or out of memory)"
+    if returncode and returncode < 0:
+        return f"terminated by signal {-returncode}"
+    return f"exited with code {returncode}"
+
+class PreviewHandle:
+    """One running preview server and what the UI needs to show it."""
+
+    def __init__(self, filename, process, port, logs, startup_seconds):
+        self.filename = filename
+        self.process = process
+        self.port = port
+        self.url = f"http://localhost:{port}"
+        self.logs = logs
+        self.startup_seconds = startup_seconds
+        self.last_viewed = time.monotonic()
+        self.samples = collections.deque(maxlen=PREVIEW_SAMPLE_HISTORY) # (cpu %, rss MB, open fds)
+        self.stop_reason = None # Set when the resource monitor stops the preview
+
+    def is_running(self):
+        return self.process.poll() is None
+
+    def start_monitor(self):
+        threading.Thread(target=_monitor_preview_resources, args=(self,), daemon=True).start()
+
+def _monitor_preview_resources(handle):
+    """Samples CPU%, RSS and open FDs of a preview and stops it when it goes over budget."""
+    previous = _read_process_stats(handle.process.pid)
+    previous_time = time.monotonic()
+    cpu_busy_since = None
+    while previous is not None and handle.is_running():
+        time.sleep(PREVIEW_SAMPLE_INTERVAL_SECONDS)
+        stats = _read_process_stats(handle.process.pid)
+        now = time.monotonic()
+        if stats is None:
+            return
+        cpu_percent = 100 * (stats[0] - previous[0]) / max(now - previous_time, 1e-6)
+        rss_mb = stats[1] / (1024 * 1024)
+        handle.samples.append((cpu_percent, rss_mb, stats[2]))
+        previous, previous_time = stats, now
+
+        cpu_busy_since = (cpu_busy_since or now) if cpu_percent >= PREVIEW_CPU_BUDGET_PERCENT else None
+        if PREVIEW_RSS_BUDGET_MB > 0 and rss_mb > PREVIEW_RSS_BUDGET_MB:
+            handle.stop_reason = f"memory use {rss_mb:,.0f} MB exceeded the {PREVIEW_RSS_BUDGET_MB:,} MB budget"
+        elif cpu_busy_since is not None and now - cpu_busy_since >= PREVIEW_CPU_BUDGET_SECONDS:
+            handle.stop_reason = f"CPU above {PREVIEW_CPU_BUDGET_PERCENT}% for {PREVIEW_CPU_BUDGET_SECONDS}s (runaway loop?)"
+        if handle.stop_reason:
+            handle.process.terminate()
+            try:
+                handle.process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                handle.process.kill()
+            return
+
+class PreviewManager:
+    """Keeps several previews running at once, keyed by workspace file.
+
+    Holds at most `max_concurrent` servers and `max_total_rss_bytes` of combined resident
+    memory; `make_room` picks the least recently viewed previews to stop when a new one
+    would exceed either limit.
+    """
+
+    def __init__(self, port_allocator, max_concurrent, max_total_rss_bytes):
+        self.port_allocator = port_allocator
+        self.max_concurrent = max_concurrent
+        self.max_total_rss_bytes = max_total_rss_bytes
+        self.previews = {} # filename -> PreviewHandle
+        self.unexpected_exits = [] # (filename, reason) for previews that stopped on their own
+        self._lock = threading.RLock() # The supervisor's reaper thread also stops previews
+
+    def get(self, filename):
+        handle = self.previews.get(filename)
+        return handle if handle and handle.is_running() else None
+
+    def running(self):
+        """Live previews, most recently viewed first. Exited processes are forgotten."""
+        with self._lock:
+            for filename, handle in list(self.previews.items()):
+                if not handle.is_running():
+                    self.unexpected_exits.append((filename, handle.stop_reason or _describe_preview_exit(handle.process.returncode)))
+                    self.forget(filename)
+            return sorted(self.previews.values(), key=lambda h: h.last_viewed, reverse=True)
+
+    def add(self, handle):
+        with self._lock:
+            self.previews[handle.filename] = handle
+
+    def forget(self, filename):
+        with self._lock:
+            handle = self.previews.pop(filename, None)
+            if handle:
+                self.port_allocator.release(handle.port)
+                if handle.logs:
+                    handle.logs.close() # Stopped, restarted, reaped or exited: its spill file is done
+            return handle
+
+    def touch(self, filename):
+        if filename in self.previews:
+            self.previews[filename].last_viewed = time.monotonic()
+
+    def total_rss_bytes(self):
+        return sum(_process_rss_bytes(h.process.pid) for h in self.running())
+
+    def eviction_candidates(self):
+        """Filenames to stop (least recently viewed first) so one more preview fits the limits."""
+        running = self.running()
+        rss_by_file = {h.filename: _process_rss_bytes(h.process.pid) for h in running}
+        total_rss = sum(rss_by_file.values())
+        candidates = []
+        for handle in reversed(running): # Least recently viewed first
+            if len(running) - len(candidates) < self.max_concurrent and total_rss <= self.max_total_rss_bytes:
+                break
+            candidates.append(handle.filename)
+            total_rss -= rss_by_file[handle.filename]
+        return candidates
+
+def _kill_preview_process(process):
+    """Stops a preview without UI feedback (used off the script thread)."""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=3)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+class PreviewSupervisor:
+    """Owns every preview process on this server, grouped by the session that started them.
+
+    Sessions get their PreviewManager from here, so previews no longer depend on the tab
+    that started them staying open. A reaper thread stops previews whose session sent no
+    heartbeat for `heartbeat_timeout` seconds (tab closed) or that nobody viewed for
+    `idle_timeout` seconds. At most `max_total` previews run across all sessions; a start
+    reserves its slot first so concurrent starts cannot overshoot.
+    """
+
+    def __init__(self, port_allocator, max_total, heartbeat_timeout, idle_timeout, reap_interval=PREVIEW_REAP_INTERVAL_SECONDS):
+        self.port_allocator = port_allocator
+        self.max_total = max_total
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.counts = collections.Counter() # started, rejected_at_capacity, reaped_idle, reaped_orphaned, port_taken
+        self._managers = {}   # session id -> PreviewManager
+        self._heartbeats = {} # session id -> time.monotonic() of its last heartbeat
+        self._reserved_slots = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._reap_loop, name="geniecraft-preview-reaper", daemon=True).start()
+
+    def manager_for(self, session_id):
+        with self._lock:
+            manager = self._managers.get(session_id)
+            if manager is None:
+                manager = PreviewManager(self.port_allocator, PREVIEW_MAX_CONCURRENT, PREVIEW_MAX_TOTAL_RSS_MB * 1024 * 1024)
+                self._managers[session_id] = manager
+            self._heartbeats[session_id] = time.monotonic()
+            return manager
+
+    def heartbeat(self, session_id):
+        with self._lock:
+            self._heartbeats[session_id] = time.monotonic()
+
+    def record(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def session_active(self, session_id):
+        """True if the session has previews here or sent a heartbeat recently."""
+        with self._lock:
+            manager = self._managers.get(session_id)
+            seen = self._heartbeats.get(session_id)
+            return bool(manager and manager.previews) or (seen is not None and time.monotonic() - seen <= self.heartbeat_timeout)
+
+    def _managers_snapshot(self):
+        with self._lock:
+            return list(self._managers.items()), dict(self._heartbeats)
+
+    def running_count(self):
+        managers, _ = self._managers_snapshot()
+        return sum(len(manager.running()) for _, manager in managers)
+
+    def reserve_slot(self):
+        """Claims room for one more preview; False if the server is at capacity. Pair with `release_slot`."""
+        running = self.running_count()
+        with self._lock:
+            if running + self._reserved_slots >= self.max_total:
+                return False
+            self._reserved_slots += 1
+            return True
+
+    def release_slot(self):
+        with self._lock:
+            self._reserved_slots -= 1
+
+    def reap(self):
+        """Stops orphaned and idle previews. Returns how many were stopped."""
+        managers, heartbeats = self._managers_snapshot()
+        now = time.monotonic()
+        reaped = 0
+        for session_id, manager in managers:
+            orphaned = now - heartbeats.get(session_id, now) > self.heartbeat_timeout
+            for handle in manager.running():
+                if orphaned:
+                    handle.stop_reason, counter = f"its session sent no heartbeat for {self.heartbeat_timeout}s", "reaped_orphaned"
+                elif self.idle_timeout > 0 and now - handle.last_viewed > self.idle_timeout:
+                    handle.stop_reason, counter = f"not viewed for {self.idle_timeout // 60} min", "reaped_idle"
+                else:
+                    continue
+                _kill_preview_process(handle.process)
+                if manager.forget(handle.filename):
+                    manager.unexpected_exits.append((handle.filename, handle.stop_reason))
+                self.record(counter)
+                reaped += 1
+            if orphaned and not manager.previews:
+                with self._lock:
+                    if self._heartbeats.get(session_id) == heartbeats.get(session_id): # No heartbeat arrived meanwhile
+                        self._managers.pop(session_id, None)
+                        self._heartbeats.pop(session_id, None)
+        return reaped
 
-def stop_preview():
-    process_to_stop = st.session_state.get("preview_process")
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception:
+                pass # Keep reaping; a single bad handle must not stop the thread
+
+    def shutdown(self):
+        managers, _ = self._managers_snapshot()
+        for _, manager in managers:
+            for handle in list(manager.previews.values()):
+                _kill_preview_process(handle.process)
+                if handle.logs:
+                    handle.logs.close()
+
+    def stats(self):
+        """Counts for capacity planning."""
+        managers, heartbeats = self._managers_snapshot()
+        now = time.monotonic()
+        running = [handle for _, manager in managers for handle in manager.running()]
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            "running": len(running),
+            "max_total": self.max_total,
+            "sessions": len(managers),
+            "sessions_with_previews": sum(1 for _, manager in managers if manager.previews),
+            "sessions_alive": sum(1 for seen in heartbeats.values() if now - seen <= self.heartbeat_timeout),
+            "total_rss_mb": round(sum(_process_rss_bytes(handle.process.pid) for handle in running) / (1024 * 1024), 1),
+            **{name: counts.get(name, 0) for name in ("started", "rejected_at_capacity", "reaped_idle", "reaped_orphaned", "port_taken")},
+        }
+
+@st.cache_resource
+def get_preview_supervisor():
+    """The single owner of all preview processes in this server process."""
+    supervisor = PreviewSupervisor(
+        get_port_allocator(), PREVIEW_GLOBAL_MAX_CONCURRENT, PREVIEW_HEARTBEAT_TIMEOUT_SECONDS, PREVIEW_IDLE_TIMEOUT_SECONDS,
+    )
+    atexit.register(supervisor.shutdown) # Previews must not outlive the server
+    return supervisor
+
+class SessionJanitor:
+    """Deletes what sessions left behind once nobody has used them for `idle_seconds`.
+
+    That is the session's workspace directory, its snapshot history, its chat in the message
+    store and its objects in SessionResources. A session counts as used when it ran (see
+    `_record_session_use`), got a chat message, or changed a file in its workspace;
+    sessions with previews or a recent heartbeat are kept. Runs every `interval` seconds
+    on a background thread. Only started when GENIECRAFT_SESSION_TTL_HOURS is set, since
+    it deletes user data; idle previews are stopped by PreviewSupervisor either way.
+    """
+
+    def __init__(self, message_store, resources, supervisor, idle_seconds, interval=SESSION_CLEANUP_INTERVAL_SECONDS):
+        self.message_store = message_store
+        self.resources = resources
+        self.supervisor = supervisor
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.removed_sessions = 0
+        threading.Thread(target=self._loop, name="geniecraft-session-cleanup", daemon=True).start()
+
+    @staticmethod
+    def _last_modified(directory):
+        """Newest mtime of a directory and the files directly in it; 0 if it does not exist."""
+        try:
+            return max([directory.stat().st_mtime] + [entry.stat().st_mtime for entry in os.scandir(directory)])
+        except OSError:
+            return 0.0
+
+    def idle_sessions(self, now=None):
+        cutoff = (now or time.time()) - self.idle_seconds
+        last_seen = self.message_store.last_seen()
+        candidates = set(last_seen)
+        for directory in (WORKSPACE_ROOT, SNAPSHOT_DIR):
+            if directory.is_dir():
+                candidates.update(entry.name for entry in os.scandir(directory) if entry.is_dir() and SESSION_ID_RE.fullmatch(entry.name))
+        return sorted(
+            session_id for session_id in candidates
+            if last_seen.get(session_id, 0.0) < cutoff
+            and self._last_modified(WORKSPACE_ROOT / session_id) < cutoff
+            and not self.supervisor.session_active(session_id)
+        )
+
+    def run(self, now=None):
+        """Deletes every idle session. Returns their ids."""
+        session_ids = self.idle_sessions(now)
+        for session_id in session_ids:
+            workspace_dir, snapshot_dir = WORKSPACE_ROOT / session_id, SNAPSHOT_DIR / session_id
+            self.resources.forget(str(workspace_dir), str(snapshot_dir))
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+        if session_ids:
+            self.message_store.delete_sessions(session_ids)
+            self.removed_sessions += len(session_ids)
+        return session_ids
+
+    def _loop(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                pass # Try again next time; cleanup must never take the server down
+            time.sleep(self.interval)
+
+@st.cache_resource
+def get_session_janitor():
+    """Starts idle-session cleanup once per process; None when GENIECRAFT_SESSION_TTL_HOURS=0."""
+    if SESSION_IDLE_TTL_HOURS <= 0:
+        return None
+    return SessionJanitor(get_message_store(), get_session_resources(), get_preview_supervisor(), SESSION_IDLE_TTL_HOURS * 3600)
+
+def get_preview_manager():
+    # Kept in session state as well, for the benchmarks and for inspection; the supervisor owns it.
+    st.session_state.preview_manager = get_preview_supervisor().manager_for(st.session_state.session_id)
+    return st.session_state.preview_manager
+
+def _preview_rlimits():
+    limits = []
+    if PREVIEW_CPU_TIME_LIMIT_SECONDS > 0:
+        # SIGXCPU at the soft limit; the hard limit (SIGKILL) gives a few seconds of grace.
+        limits.append((resource.RLIMIT_CPU, (PREVIEW_CPU_TIME_LIMIT_SECONDS, PREVIEW_CPU_TIME_LIMIT_SECONDS + 5)))
+    if PREVIEW_ADDRESS_SPACE_LIMIT_MB > 0:
+        limit_bytes = PREVIEW_ADDRESS_SPACE_LIMIT_MB * 1024 * 1024
+        limits.append((resource.RLIMIT_AS, (limit_bytes, limit_bytes)))
+    return limits
+
+def _limit_preview_resources():
+    """preexec_fn fallback for platforms without prlimit: applies the rlimits in the child."""
+    for limit, values in _preview_rlimits():
+        resource.setrlimit(limit, values)
+
+def _preview_preexec_fn():
+    # Running Python code between fork and exec can deadlock in a multithreaded parent like
+    # the Streamlit server, so the preexec hook is only used where prlimit is missing.
+    if resource is None or hasattr(resource, "prlimit"):
+        return None
+    return _limit_preview_resources
+
+def _apply_preview_rlimits(process):
+    """Applies the rlimits to an already started preview process (Linux prlimit)."""
+    if resource is None or not hasattr(resource, "prlimit"):
+        return
+    for limit, values in _preview_rlimits():
+        try:
+            resource.prlimit(process.pid, limit, values)
+        except (OSError, ValueError):
+            pass # Process already gone, or limit above what we may set
+
+class PreviewWorkerPool:
+    """A small pool of interpreters that have already imported Streamlit and common libraries.
+
+    `launch` hands a script to an idle warm worker (see preview_worker.py) so the preview
+    skips interpreter start-up and the heavy imports. Used workers become the preview
+    process itself; `replenish` starts fresh ones to take their place.
+    """
+
+    def __init__(self, size, preload_modules):
+        self.size = size
+        self.preload_modules = list(preload_modules)
+        self._idle_workers = []
+        self._lock = threading.Lock()
+        self.replenish()
+
+    def _spawn_worker(self):
+        worker = subprocess.Popen(
+            [sys.executable, str(PREVIEW_WORKER_SCRIPT), *self.preload_modules],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8',
+            preexec_fn=_preview_preexec_fn()
+        )
+        _apply_preview_rlimits(worker) # Limits carry over to the preview the worker becomes
+        return worker
+
+    def replenish(self):
+        with self._lock:
+            self._idle_workers = [w for w in self._idle_workers if w.poll() is None]
+            while len(self._idle_workers) < self.size:
+                self._idle_workers.append(self._spawn_worker())
+
+    def launch(self, script_path, server_args):
+        """Runs `script_path` on a warm worker. Returns the worker process, or None if none is idle."""
+        request_line = json.dumps({"script": str(script_path), "args": list(server_args)}) + "\n"
+        while True:
+            with self._lock:
+                if not self._idle_workers:
+                    return None
+                worker = self._idle_workers.pop(0)
+            if worker.poll() is not None:
+                continue # Worker died while idle (e.g. a preload crashed); try the next one
+            try:
+                worker.stdin.write(request_line)
+                worker.stdin.close()
+                return worker
+            except (BrokenPipeError, OSError):
+                worker.kill()
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._idle_workers = self._idle_workers, []
+        for worker in workers:
+            try:
+                worker.stdin.close() # Worker exits when stdin closes without a request
+            except OSError:
+                worker.kill()
+
+@st.cache_resource
+def get_preview_worker_pool():
+    """Process-wide pool shared by every session; None when pre-warming is disabled."""
+    if PREVIEW_POOL_SIZE <= 0 or not PREVIEW_WORKER_SCRIPT.is_file():
+        return None
+    return PreviewWorkerPool(PREVIEW_POOL_SIZE, PREVIEW_PRELOAD_MODULES)
+
+def _preview_server_args(port):
+    return [
+        "--server.port", str(port),
+        "--server.headless", "true",
+        # With hot reload the preview server watches its script and reruns it on save,
+        # so edits show up without a new process, port or iframe.
+        "--server.runOnSave", "true" if PREVIEW_HOT_RELOAD else "false",
+        "--server.fileWatcherType", "poll" if PREVIEW_HOT_RELOAD else "none"
+    ]
+
+class PreviewLogBuffer:
+    """Thread-safe ring buffer of a preview's stdout/stderr lines, capped at `max_bytes`.
+
+    Lines get increasing sequence numbers so the UI can ask for only what is new since
+    its last rerun. When `spill_path` is set, every line is also appended to that file,
+    which is rotated to `<name>.1` once it grows past PREVIEW_LOG_SPILL_MAX_BYTES.
+    """
+
+    def __init__(self, max_bytes=PREVIEW_LOG_MAX_BYTES, spill_path=None):
+        self.max_bytes = max_bytes
+        self.dropped_lines = 0
+        self.drainer_threads = []
+        self._lines = collections.deque() # (sequence, stream name, text)
+        self._size = 0
+        self._next_sequence = 0
+        self._lock = threading.Lock()
+        self._spill_path = Path(spill_path) if spill_path else None
+        self._spill_file = None
+        if self._spill_path:
+            self._spill_path.parent.mkdir(parents=True, exist_ok=True)
+            self._spill_file = open(self._spill_path, "a", encoding="utf-8")
+
+    def append(self, stream_name, text):
+        with self._lock:
+            self._lines.append((self._next_sequence, stream_name, text))
+            self._next_sequence += 1
+            self._size += len(text)
+            while self._size > self.max_bytes and len(self._lines) > 1:
+                self._size -= len(self._lines.popleft()[2])
+                self.dropped_lines += 1
+            if self._spill_file:
+                self._spill(f"[{stream_name}] {text}\n")
+
+    def _spill(self, line):
+        try:
+            if self._spill_file.tell() > PREVIEW_LOG_SPILL_MAX_BYTES:
+                self._spill_file.close()
+                os.replace(self._spill_path, self._spill_path.with_name(self._spill_path.name + ".1"))
+                self._spill_file = open(self._spill_path, "a", encoding="utf-8")
+            self._spill_file.write(line)
+            self._spill_file.flush()
+        except OSError:
+            self._spill_file = None # Keep buffering in memory even if the disk is unavailable
+
+    def lines_since(self, sequence):
+        """Returns (lines newer than `sequence`, next sequence to ask for)."""
+        with self._lock:
+            new_lines = [(stream, text) for seq, stream, text in self._lines if seq >= sequence]
+            return new_lines, self._next_sequence
+
+    def text(self):
+        with self._lock:
+            return "\n".join(text for _, _, text in self._lines)
+
+    def wait_for_drainers(self, timeout=1.0):
+        for thread in self.drainer_threads:
+            thread.join(timeout)
+
+    def close(self):
+        """Closes the spill file; lines still arriving are kept in memory only."""
+        with self._lock:
+            if self._spill_file:
+                try:
+                    self._spill_file.close()
+                except OSError:
+                    pass
+                self._spill_file = None
+
+def _drain_stream(stream, stream_name, log_buffer):
+    """Reads a pipe until EOF so a chatty preview can never block on a full OS pipe buffer."""
+    try:
+        for line in iter(stream.readline, ""):
+            log_buffer.append(stream_name, line.rstrip("\n"))
+    except (ValueError, OSError):
+        pass # Pipe closed underneath us
+    finally:
+        try: stream.close()
+        except OSError: pass
+
+def _start_log_drainers(process, python_filename):
+    spill_path = None
+    if PREVIEW_LOG_SPILL_DIR:
+        spill_path = Path(PREVIEW_LOG_SPILL_DIR) / f"{Path(python_filename).stem}_{process.pid}.log"
+    log_buffer = PreviewLogBuffer(spill_path=spill_path)
+    for stream, stream_name in ((process.stdout, "stdout"), (process.stderr, "stderr")):
+        if stream is None:
+            continue
+        thread = threading.Thread(target=_drain_stream, args=(stream, stream_name, log_buffer), daemon=True)
+        thread.start()
+        log_buffer.drainer_threads.append(thread)
+    return log_buffer
+
+def _wait_for_preview_ready(process, port, timeout=PREVIEW_STARTUP_TIMEOUT_SECONDS):
+    """Polls the preview server's health endpoint with backoff.
+
+    Returns True once the server answers, False if the process exits or the timeout expires.
+    """
+    health_url = f"http://localhost:{port}/_stcore/health"
+    delay = PREVIEW_HEALTH_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(health_url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass # Server not listening yet
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, PREVIEW_HEALTH_POLL_MAX_DELAY)
+    return False
+
+def _terminate_preview_process(process_to_stop):
     pid = getattr(process_to_stop, 'pid', None)
     if process_to_stop and pid:
         st.info(f"Stopping preview process (PID: {pid})...")
@@ -469,135 +2708,306 @@ def stop_preview():
             else: st.warning(f"Preview process {pid} had already stopped.")
         except ProcessLookupError: st.warning(f"Preview process {pid} not found.")
         except Exception as e: st.error(f"Error stopping preview process {pid}: {e}")
-    st.session_state.preview_process = None
-    st.session_state.preview_port = None
-    st.session_state.preview_url = None
-    st.session_state.preview_file = None
-    st.rerun()
+
+def stop_preview(filename=None, rerun=True):
+    """Stops one preview (the active one by default) and frees its port."""
+    filename = filename or st.session_state.active_preview
+    handle = get_preview_manager().forget(filename) if filename else None
+    if handle:
+        _terminate_preview_process(handle.process)
+    st.session_state.preview_log_cursors.pop(filename, None)
+    if st.session_state.active_preview == filename:
+        remaining = get_preview_manager().running()
+        st.session_state.active_preview = remaining[0].filename if remaining else None
+    if rerun:
+        st.rerun()
 
 def start_preview(python_filename):
     filepath = WORKSPACE_DIR / python_filename
     if not filepath.is_file() or filepath.suffix != '.py':
         st.error(f"Cannot preview: '{python_filename}' is not a valid Python file.")
         return False
-    if st.session_state.get("preview_process"):
-        st.warning("Stopping existing preview first...")
-        stop_preview() # This reruns, so the user might need to click again.
-                       # A more complex state machine could avoid this, but adds complexity.
-        return False # Indicate that the action was to stop, not start a new one yet.
+    manager = get_preview_manager()
+    if manager.get(python_filename):
+        if PREVIEW_HOT_RELOAD:
+            # Already running: switching to it is instant, and saves reload it in place.
+            manager.touch(python_filename)
+            st.session_state.active_preview = python_filename
+            return True
+        stop_preview(python_filename, rerun=False) # Restart so the preview picks up changes
+    for filename_to_evict in manager.eviction_candidates():
+        st.toast(f"Stopping least recently viewed preview: {filename_to_evict}", icon="♻️")
+        stop_preview(filename_to_evict, rerun=False)
 
-    with st.spinner(f"Starting preview for `{python_filename}`..."):
-        try:
-            port = _find_available_port()
-            command = [
-                sys.executable, "-m", "streamlit", "run",
-                str(filepath.resolve()),
-                "--server.port", str(port),
-                "--server.headless", "true",
-                "--server.runOnSave", "false",
-                "--server.fileWatcherType", "none"
-            ]
-            preview_proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
-            time.sleep(3) # Increased sleep for slower systems
-            if preview_proc.poll() is None:
-                st.session_state.preview_process = preview_proc
-                st.session_state.preview_port = port
-                st.session_state.preview_url = f"http://localhost:{port}"
-                st.session_state.preview_file = python_filename
-                st.success(f"Preview started for `{python_filename}`. Open in new tab: {st.session_state.preview_url}")
-                st.toast(f"Preview running: {python_filename}", icon="🚀")
-                return True
-            else:
-                st.error(f"Preview failed to start for `{python_filename}`.")
-                try:
-                    stderr_output = preview_proc.stderr.read()
-                    if stderr_output: st.error("Preview Error Output:"); st.code(stderr_output, language=None)
-                    else:
-                         stdout_output = preview_proc.stdout.read()
-                         if stdout_output: st.error("Preview Output (may contain errors):"); st.code(stdout_output, language=None)
-                except Exception as read_e: st.error(f"Could not read output: {read_e}")
-                st.session_state.preview_process = None
-                return False
-        except Exception as e:
-            st.error(f"Error starting preview: {e}")
-            st.session_state.preview_process = None
+    supervisor = get_preview_supervisor()
+    if not supervisor.reserve_slot():
+        supervisor.reap() # Idle previews of other sessions may be due anyway
+        if not supervisor.reserve_slot():
+            supervisor.record("rejected_at_capacity")
+            st.error(f"All {supervisor.max_total} preview slots on this server are in use. Stop one of your previews or try again later.")
             return False
+    try:
+        with st.spinner(f"Starting preview for `{python_filename}`..."), perf.phase("preview_start"):
+            port = None
+            preview_logs = None
+            try:
+                worker_pool = get_preview_worker_pool()
+                launch_started = time.perf_counter()
+                for attempt in range(1, PREVIEW_PORT_ATTEMPTS + 1):
+                    port = manager.port_allocator.allocate()
+                    server_args = _preview_server_args(port)
+                    preview_proc = worker_pool.launch(filepath.resolve(), server_args) if worker_pool else None
+                    if preview_proc is None: # No warm worker available: cold start
+                        command = [sys.executable, "-m", "streamlit", "run", str(filepath.resolve()), *server_args]
+                        preview_proc = subprocess.Popen(
+                            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8',
+                            preexec_fn=_preview_preexec_fn()
+                        )
+                        _apply_preview_rlimits(preview_proc)
+                    preview_logs = _start_log_drainers(preview_proc, python_filename)
+                    is_ready = _wait_for_preview_ready(preview_proc, port)
+                    if worker_pool:
+                        worker_pool.replenish() # Replace the used worker once the preview is up
+                    if is_ready or preview_proc.poll() is None or PortAllocator._is_free(port) or attempt == PREVIEW_PORT_ATTEMPTS:
+                        break
+                    # The preview exited and something else now holds its port: another program
+                    # bound it between the allocator's test bind and ours. Try the next port.
+                    supervisor.record("port_taken")
+                    preview_logs.wait_for_drainers()
+                    preview_logs.close()
+                    preview_logs = None
+                    manager.port_allocator.release(port)
+                    port = None
+                startup_seconds = time.perf_counter() - launch_started
+                if not is_ready and preview_proc.poll() is None:
+                    st.error(f"Preview for `{python_filename}` did not respond within {PREVIEW_STARTUP_TIMEOUT_SECONDS}s; stopping it.")
+                    preview_proc.kill()
+                    preview_proc.wait(timeout=1)
+                if is_ready:
+                    handle = PreviewHandle(python_filename, preview_proc, port, preview_logs, startup_seconds)
+                    manager.add(handle)
+                    supervisor.record("started")
+                    handle.start_monitor()
+                    st.session_state.active_preview = python_filename
+                    st.session_state.preview_log_cursors[python_filename] = 0
+                    st.session_state.preview_startup_history.append({"file": python_filename, "seconds": startup_seconds})
+                    st.success(f"Preview started for `{python_filename}` in {startup_seconds:.2f}s. Open in new tab: {handle.url}")
+                    st.toast(f"Preview running: {python_filename}", icon="🚀")
+                    return True
+                else:
+                    st.error(f"Preview failed to start for `{python_filename}`.")
+                    preview_logs.wait_for_drainers() # The process has exited; let the drainers reach EOF
+                    preview_output = preview_logs.text()
+                    if preview_output: st.error("Preview Output (may contain errors):"); st.code(preview_output, language=None)
+                    preview_logs.close()
+                    manager.port_allocator.release(port)
+                    return False
+            except Exception as e:
+                st.error(f"Error starting preview: {e}")
+                if preview_logs:
+                    preview_logs.close()
+                if port is not None:
+                    manager.port_allocator.release(port)
+                return False
+    finally:
+        supervisor.release_slot() # A started preview is counted as running from here on
 
 # --- Streamlit App UI ---
+get_preview_worker_pool() # Warm preview interpreters in the background while the user works
+get_session_janitor()
 st.title("🎨 GenieCraft AI: Streamlit App Builder") # Using one of the suggested names
-st.caption(f"Using AI model: {GEMINI_MODEL_NAME}")
+st.caption(f"Using AI model: {generation.GEMINI_MODEL_NAME}" + (" (offline fake model)" if GEMINI_USE_FAKE_MODEL else ""))
 st.markdown("---")
 
 # --- Sidebar ---
+def _command_summary_line(command):
+    action = command.get("action")
+    filename = command.get("filename")
+    if action == "create_update":
+        return f"💾 **Saved:** `{filename}`"
+    if action == "patch":
+        return f"🩹 **Patched:** `{filename}`" + (" (full rewrite fallback)" if command.get("fallback") else "")
+    if action == "delete":
+        return f"🗑️ **Deleted:** `{filename}`"
+    if action == "chat":
+        return str(_command_text(command, "content") or "...")
+    return f"⚠️ **Unknown Action:** `{action}` for `{filename or ''}`"
+
+@st.experimental_fragment(run_every=AI_JOB_POLL_INTERVAL_SECONDS)
+def ai_job_progress():
+    """Shows the in-flight AI request and applies its commands as they arrive.
+
+    Only this fragment reruns while polling, so the rest of the app stays responsive; a
+    full rerun is triggered when files changed or the request is over.
+    """
+    job = st.session_state.ai_job
+    if job is None:
+        return
+    added = pump_ai_job(job)
+    with st.chat_message("assistant", avatar="🤖"):
+        for entry in job.executed_entries:
+            st.markdown(_command_summary_line(entry))
+        if job.planned_files:
+            st.caption(f"🗂️ {job.completed_files}/{len(job.planned_files)} planned files generated")
+        if job.rewrites:
+            st.caption(f"📝 Regenerating {len(job.rewrites)} file(s) whose patch did not apply")
+        st.caption(f"🧠 AI Thinking... {time.time() - job.started_at:.0f}s, {job.received_chars:,} characters received")
+        st.button("⏹️ Cancel", key="cancel_ai_job", on_click=job.cancel, use_container_width=True)
+    if job.finished and finish_ai_job(job):
+        st.rerun()
+    elif added:
+        st.rerun() # New or changed files must show up in the workspace views
+
+@st.experimental_fragment(run_every=PREVIEW_HEARTBEAT_INTERVAL_SECONDS)
+def preview_heartbeat(viewed_preview):
+    """Tells the preview supervisor this tab is still open, so its previews are not reaped.
+
+    Rendered only while the session has previews; `viewed_preview` counts as viewed on
+    every beat while the Live Preview tab shows it.
+    """
+    get_preview_supervisor().heartbeat(st.session_state.session_id)
+    if viewed_preview:
+        get_preview_manager().touch(viewed_preview)
+
+def _assistant_message_summary(message_index, content):
+    """Builds (and caches per message) the sidebar summary of an assistant command list.
+
+    Only references to code blocks are kept; the code itself is read from the message when
+    its toggle is switched on, so reruns do not resend every generated file.
+    """
+    cache_key = (message_index, id(content), len(content))
+    cached = st.session_state.chat_render_cache.get(message_index)
+    if cached and cached["key"] == cache_key:
+        return cached
+    file_actions_summary = ""
+    chat_responses = []
+    code_blocks = []
+    for command_index, command in enumerate(content):
+        if not isinstance(command, dict): continue
+        action = command.get("action")
+        if action == "chat":
+            chat_responses.append(str(_command_text(command, "content") or "..."))
+        else:
+            file_actions_summary += _command_summary_line(command) + "\n"
+            if action == "create_update" and _command_has_text(command, "content"):
+                code_blocks.append({"filename": command.get("filename"), "command_index": command_index, "field": "content", "language": "python"})
+            elif action == "patch" and _command_has_text(command, "diff"): # Show only what changed
+                code_blocks.append({"filename": command.get("filename"), "command_index": command_index, "field": "diff", "language": "diff"})
+    # Display summaries first, then chat
+    markdown = "\n\n".join(part for part in (file_actions_summary.strip(), "\n".join(chat_responses).strip()) if part)
+    summary = {"key": cache_key, "markdown": markdown, "code_blocks": code_blocks, "changes_files": bool(file_actions_summary)}
+    st.session_state.chat_render_cache[message_index] = summary
+    return summary
+
 with st.sidebar:
     st.header("💬 AI Chat & Controls")
     st.markdown("---")
     chat_container = st.container(height=350) # Adjusted height
-    with chat_container:
+    with chat_container, perf.phase("sidebar_chat_render"):
         if not st.session_state.messages:
             st.info("Chat history is empty. Type your instructions below.")
         else:
-            for message in st.session_state.messages:
+            all_messages = st.session_state.messages
+            first_visible = max(len(all_messages) - st.session_state.chat_visible_count, 0)
+            if first_visible > 0:
+                if st.button(f"⬆️ Load older messages ({first_visible} hidden)", use_container_width=True, key="chat_load_older"):
+                    st.session_state.chat_visible_count += CHAT_EAGER_MESSAGES
+                    st.rerun()
+            for message_index in range(first_visible, len(all_messages)):
+                message = all_messages[message_index]
                 role = message["role"]
                 content = message["content"]
                 avatar = "🧑‍💻" if role == "user" else "🤖"
                 with st.chat_message(role, avatar=avatar):
                     if role == "assistant" and isinstance(content, list):
-                        file_actions_summary = ""
-                        chat_responses = []
-                        code_blocks_to_display = [] # Store code blocks separately
-                        for command in content:
-                            if not isinstance(command, dict): continue
-                            action = command.get("action")
-                            filename = command.get("filename")
-                            cmd_content = command.get("content")
-                            if action == "create_update":
-                                file_actions_summary += f"💾 **Saved:** `{filename}`\n"
-                                if cmd_content: # Store for expander
-                                    code_blocks_to_display.append({"filename": filename, "code": cmd_content})
-                            elif action == "delete":
-                                file_actions_summary += f"🗑️ **Deleted:** `{filename}`\n"
-                            elif action == "chat":
-                                chat_responses.append(str(cmd_content or "..."))
-                            else:
-                                file_actions_summary += f"⚠️ **Unknown Action:** `{action}` for `{filename or ''}`\n"
-
-                        # Display summaries and chat first
-                        if file_actions_summary: st.markdown(file_actions_summary.strip())
-                        if chat_responses: st.markdown("\n".join(chat_responses).strip())
-                        if not file_actions_summary and not chat_responses: st.markdown("(AI performed no displayable actions)")
-
-                        # Then display code blocks in expanders
-                        for block in code_blocks_to_display:
-                            with st.expander(f"View/Hide Code for `{block['filename']}`", expanded=False):
-                                st.code(block['code'], language="python")
+                        summary = _assistant_message_summary(message_index, content)
+                        if summary["markdown"]: st.markdown(summary["markdown"])
+                        else: st.markdown("(AI performed no displayable actions)")
+
+                        # Code is only sent to the browser once its toggle is switched on
+                        for block in summary["code_blocks"]:
+                            show_code = st.toggle(
+                                f"View code for `{block['filename']}`" if block["field"] == "content" else f"View diff for `{block['filename']}`",
+                                key=f"chat_code_{message_index}_{block['command_index']}",
+                            )
+                            if show_code:
+                                st.code(_command_text(content[block["command_index"]], block["field"]), language=block["language"])
+                        if message.get("snapshot_before") and summary["changes_files"]:
+                            st.button(
+                                "↩️ Undo to before this turn", key=f"chat_undo_{message_index}", use_container_width=True,
+                                on_click=restore_workspace_snapshot,
+                                args=(message["snapshot_before"], f"the workspace from before turn {message_index}"),
+                                disabled=st.session_state.ai_job is not None,
+                            )
                     elif isinstance(content, str):
                         st.write(content)
                     else:
                         st.write(f"Unexpected message format: {content}")
 
-    user_prompt = st.chat_input("e.g., 'Create app.py with a title and a button'")
-    if user_prompt:
-        st.session_state.messages.append({"role": "user", "content": user_prompt})
-        with st.spinner("🧠 AI Thinking..."):
-            ai_response_text = ask_gemini_ai(st.session_state.messages)
-            ai_commands_executed = parse_and_execute_ai_commands(ai_response_text)
-        st.session_state.messages.append({"role": "assistant", "content": ai_commands_executed})
-        st.rerun()
+    if st.session_state.ai_job is not None:
+        with chat_container:
+            ai_job_progress()
+
+    history_stats = st.session_state.history_stats
+    if history_stats:
+        st.caption(
+            f"Last prompt: ~{history_stats['prompt_tokens']:,} tokens "
+            f"(~{history_stats['tokens_saved']:,} saved by history compaction"
+            + (f", {history_stats['messages_dropped']} old messages dropped" if history_stats['messages_dropped'] else "")
+            + (f", ~{history_stats['context_tokens']:,} of code from {history_stats['context_files']} relevant file(s)"
+               if history_stats.get('context_files') else "")
+            + ")"
+        )
+
+    response_cache = get_response_cache()
+    if response_cache:
+        st.caption(
+            f"Response cache: {response_cache.hits} hits / {response_cache.misses} misses"
+            f" ({response_cache.evictions} evicted)"
+        )
+    if st.session_state.json_repair_counts:
+        st.caption("Repaired AI responses: " + ", ".join(
+            f"{name.replace('_', ' ')} ×{count}" for name, count in sorted(st.session_state.json_repair_counts.items())
+        ))
+
+    planner_mode = st.toggle(
+        "🗂️ Plan multi-file requests", value=GEMINI_PLANNER_DEFAULT, key="planner_mode",
+        disabled=st.session_state.ai_job is not None,
+        help="Lists the files first, then generates each one in a parallel call. Costs one extra call per request.",
+    )
+    user_prompt = st.chat_input(
+        "e.g., 'Create app.py with a title and a button'", disabled=st.session_state.ai_job is not None
+    )
+    if user_prompt and st.session_state.ai_job is None:
+        append_chat_message({"role": "user", "content": user_prompt})
+        st.session_state.ai_job = start_ai_request(st.session_state.messages, planned=planner_mode)
+        st.rerun() # The progress fragment in the chat panel takes over from here
 
     st.markdown("---")
     st.subheader("⚠️ Important Notes")
     st.caption(
         "Review AI-generated code before running previews. "
-        "The `create_update` command overwrites files without warning. "
-        "Previews run as separate Streamlit apps."
+        "Each AI response is applied as one transaction and snapshotted; "
+        "use ↩️ Undo on a chat message to roll the workspace back to before that turn. "
+        "Previews run as separate Streamlit apps and reload automatically when their file is saved. "
+        f"They are stopped when this tab closes, or after {PREVIEW_IDLE_TIMEOUT_SECONDS // 60} min without being viewed. "
+        "This page's URL (its `?session=` id) is the key to this chat and workspace: anyone who has it can open and change them."
+        + (f" Sessions unused for {SESSION_IDLE_TTL_HOURS} hours are deleted." if SESSION_IDLE_TTL_HOURS > 0 else "")
     )
 
+def _file_option_label(option, broken_files):
+    return f"⚠️ {option}" if option in broken_files else option
+
 # --- Main Area Tabs ---
+main_tab_options = ["Workspace", "Live Preview"]
+main_tab_icons = ["code-square", "play-circle-fill"] # Updated icons
+if METRICS_TAB_ENABLED or st.query_params.get("metrics") == "1":
+    main_tab_options.append("Metrics")
+    main_tab_icons.append("speedometer2")
 selected_tab = option_menu(
     menu_title=None,
-    options=["Workspace", "Live Preview"],
-    icons=["code-square", "play-circle-fill"], # Updated icons
+    options=main_tab_options,
+    icons=main_tab_icons,
     orientation="horizontal",
     key="main_tab_menu"
 )
@@ -616,8 +3026,10 @@ if selected_tab == "Workspace":
             current_index = select_options.index(current_selection_in_state) if current_selection_in_state else 0
         except ValueError: current_index = 0
 
+        broken_files = {name for name in python_files if cached_validation_problems(name)}
         selected_option = st.selectbox(
             "Edit file:", options=select_options, index=current_index,
+            format_func=lambda option: _file_option_label(option, broken_files),
             key="file_selector_dropdown", label_visibility="collapsed"
         )
         newly_selected_filename = selected_option if selected_option != "--- Select a file ---" else None
@@ -626,45 +3038,57 @@ if selected_tab == "Workspace":
             file_content = read_file(newly_selected_filename) if newly_selected_filename else ""
             if file_content is None and newly_selected_filename:
                  file_content = f"# ERROR: Could not read file '{newly_selected_filename}'"
-            st.session_state.file_content_on_load = file_content
-            st.session_state.editor_unsaved_content = file_content
-            st.session_state.last_saved_content = file_content
-            st.rerun()
+            _load_editor_buffer(file_content) # Rendered below in this same run; no extra rerun
+
+        if st.button("🔎 Validate Workspace", use_container_width=True, disabled=not python_files, key="validate_workspace_btn"):
+            with st.spinner("Checking files..."):
+                workspace_problems = validate_workspace()
+            broken_count = sum(1 for problems in workspace_problems.values() if problems)
+            if broken_count:
+                st.toast(f"{broken_count} of {len(workspace_problems)} file(s) have problems", icon="⚠️")
+            else:
+                st.toast(f"All {len(workspace_problems)} file(s) passed", icon="✅")
+            st.rerun() # Refresh the ⚠️ markers in the selector
+        if newly_selected_filename:
+            selected_problems = cached_validation_problems(newly_selected_filename)
+            if selected_problems:
+                st.warning(f"`{newly_selected_filename}` has problems:\n{generation.format_validation_problems(selected_problems)}")
 
     with editor_col:
         # st.subheader("Code Editor") # Removed redundant subheader
         selected_filename = st.session_state.selected_file
         if selected_filename:
             st.markdown(f"**Editing:** `{selected_filename}`")
+            file_metadata = get_workspace_index(str(WORKSPACE_DIR)).metadata(selected_filename)
+            if file_metadata:
+                st.caption(
+                    f"{file_metadata['size']:,} bytes · modified "
+                    f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(file_metadata['mtime_ns'] / 1e9))}"
+                )
+            from streamlit_ace import st_ace
+            editor_key = _editor_widget_key(selected_filename)
             editor_current_text = st_ace(
-                value=st.session_state.get('editor_unsaved_content', ''),
+                value=st.session_state.editor_content,
                 language="python", theme=ACE_DEFAULT_THEME, keybinding=ACE_DEFAULT_KEYBINDING,
                 font_size=14, tab_size=4, wrap=True, auto_update=False,
                 height=500, # Adjusted height
-                key=f"ace_editor_{selected_filename}"
+                key=editor_key
             )
-            has_unsaved_changes = (editor_current_text != st.session_state.last_saved_content)
-            if editor_current_text != st.session_state.editor_unsaved_content:
-                st.session_state.editor_unsaved_content = editor_current_text
-                st.rerun()
+            # The editor's own rerun already delivered the new text: record it and carry on
+            # instead of rerunning again. Dirtiness is a hash comparison with the saved content.
+            st.session_state.editor_content = editor_current_text
+            has_unsaved_changes = _content_hash(editor_current_text) != st.session_state.editor_saved_hash
 
-            # Using sac.buttons for better visual grouping and icons
-            editor_buttons_items = [
-                sac.ButtonsItem(label="Save Changes", icon="save", disabled=not has_unsaved_changes),
-                sac.ButtonsItem(label="Delete File", icon="trash-fill", color="red", type="primary", danger=True),
-            ]
             # Place buttons in columns for better layout
             col_btn1, col_btn2, _ = st.columns([1,1,2]) # Adjust column ratios as needed
             with col_btn1:
-                if st.button("💾 Save Changes", use_container_width=True, disabled=not has_unsaved_changes, key="save_btn_manual"):
-                    if save_file(selected_filename, editor_current_text):
-                        st.session_state.file_content_on_load = editor_current_text
-                        st.session_state.last_saved_content = editor_current_text
-                        st.session_state.editor_unsaved_content = editor_current_text # Sync after save
-                        st.success(f"Manually saved: {selected_filename}")
-                        st.rerun()
+                st.button(
+                    "💾 Save Changes", use_container_width=True, disabled=not has_unsaved_changes, key="save_btn_manual",
+                    on_click=_save_editor_buffer, args=(selected_filename, editor_key),
+                )
             with col_btn2:
                 if st.button("🗑️ Delete File", use_container_width=True, type="primary", key="delete_btn_manual"): # Primary makes it red due to custom CSS
+                    import streamlit_antd_components as sac
                     if sac.confirm( # Using sac.confirm for a nicer confirmation
                         title=f"Delete '{selected_filename}'?",
                         content="This action cannot be undone.",
@@ -683,18 +3107,86 @@ if selected_tab == "Workspace":
 elif selected_tab == "Live Preview":
     st.header("🚀 Live Preview")
     st.markdown("---")
-    preview_file_to_run = st.session_state.get("preview_file")
-    preview_url = st.session_state.get("preview_url")
+    preview_manager = get_preview_manager()
+    running_previews = preview_manager.running()
+    running_names = [h.filename for h in running_previews]
+    for exited_filename, exit_reason in preview_manager.unexpected_exits:
+        st.warning(f"Preview `{exited_filename}` stopped: {exit_reason}.")
+    preview_manager.unexpected_exits.clear()
+    if st.session_state.active_preview not in running_names:
+        st.session_state.active_preview = running_names[0] if running_names else None
+
+    if running_previews:
+        supervisor_stats = get_preview_supervisor().stats()
+        st.caption(
+            f"{len(running_previews)}/{preview_manager.max_concurrent} previews running · "
+            f"{preview_manager.total_rss_bytes() / (1024 * 1024):,.0f} MB of {PREVIEW_MAX_TOTAL_RSS_MB:,} MB · "
+            f"server: {supervisor_stats['running']}/{supervisor_stats['max_total']} previews"
+        )
+        if len(running_previews) > 1:
+            # Every listed server keeps running, so switching only changes the iframe.
+            chosen_preview = st.radio(
+                "Running previews:", options=sorted(running_names),
+                index=sorted(running_names).index(st.session_state.active_preview),
+                horizontal=True,
+            )
+            st.session_state.active_preview = chosen_preview
 
-    if preview_file_to_run and preview_url:
-        st.success(f"**Previewing:** `{preview_file_to_run}`")
+    active_handle = preview_manager.get(st.session_state.active_preview) if st.session_state.active_preview else None
+    if active_handle:
+        preview_manager.touch(active_handle.filename)
+        preview_url = active_handle.url
+        st.success(f"**Previewing:** `{active_handle.filename}`")
+        st.caption(f"Server became ready in {active_handle.startup_seconds:.2f}s.")
         st.markdown(f"Access your app at: **[{preview_url}]({preview_url})** (opens in a new tab)")
         st.markdown(
             f'<iframe src="{preview_url}" width="100%" height="600" style="border:1px solid #ddd; border-radius:5px;"></iframe>',
             unsafe_allow_html=True
         )
-        if st.button("⏹️ Stop Preview", use_container_width=True, type="primary"):
-            stop_preview()
+        stop_col, stop_all_col = st.columns(2)
+        with stop_col:
+            if st.button("⏹️ Stop Preview", use_container_width=True, type="primary"):
+                stop_preview(active_handle.filename)
+        with stop_all_col:
+            if len(running_previews) > 1 and st.button("⏹️ Stop All Previews", use_container_width=True):
+                for handle in running_previews:
+                    stop_preview(handle.filename, rerun=False)
+                st.rerun()
+
+        st.subheader("📈 Resource Usage")
+        samples = list(active_handle.samples)
+        if samples:
+            usage_cols = st.columns(3)
+            for column, (label, unit, series_index) in zip(usage_cols, (("CPU", "%", 0), ("Memory (RSS)", " MB", 1), ("Open files", "", 2))):
+                with column:
+                    st.metric(label, f"{samples[-1][series_index]:,.0f}{unit}")
+                    st.line_chart([sample[series_index] for sample in samples], height=80)
+            st.caption(
+                f"Stopped automatically above {PREVIEW_RSS_BUDGET_MB:,} MB or after {PREVIEW_CPU_BUDGET_SECONDS}s "
+                f"above {PREVIEW_CPU_BUDGET_PERCENT}% CPU"
+                + (f"; total CPU-time limit {PREVIEW_CPU_TIME_LIMIT_SECONDS}s" if resource is not None and PREVIEW_CPU_TIME_LIMIT_SECONDS else "")
+                + "."
+            )
+        else:
+            st.caption("Collecting samples... (requires /proc; unavailable on this platform if this persists)")
+
+        preview_logs = active_handle.logs
+        if preview_logs:
+            st.subheader("📜 Preview Logs")
+            new_log_lines, next_cursor = preview_logs.lines_since(st.session_state.preview_log_cursors.get(active_handle.filename, 0))
+            st.session_state.preview_log_cursors[active_handle.filename] = next_cursor
+            log_col_info, log_col_refresh = st.columns([3, 1])
+            with log_col_info:
+                st.caption(
+                    f"{len(new_log_lines)} new line(s) since the last refresh"
+                    + (f" · {preview_logs.dropped_lines} older line(s) dropped from the buffer" if preview_logs.dropped_lines else "")
+                )
+            with log_col_refresh:
+                st.button("🔄 Refresh Logs", use_container_width=True, key="refresh_preview_logs")
+            if new_log_lines:
+                st.code("\n".join(f"[{stream}] {text}" for stream, text in new_log_lines), language=None)
+            if st.toggle("Show full buffered log", key="show_full_preview_log"):
+                st.code(preview_logs.text() or "(no output yet)", language=None)
     else:
         st.info("No app is currently being previewed. Select an app from the Workspace and start its preview.")
 
@@ -704,14 +3196,63 @@ elif selected_tab == "Live Preview":
     if not files_for_preview:
         st.warning("No Python files in workspace to preview.")
     else:
+        broken_preview_files = {name for name in files_for_preview if cached_validation_problems(name)}
         selected_file_for_preview = st.selectbox(
             "Select app to preview:",
             options=["--- Choose an app ---"] + files_for_preview,
+            format_func=lambda option: _file_option_label(option, broken_preview_files),
             key="preview_file_selector"
         )
+        if selected_file_for_preview in broken_preview_files:
+            st.warning(
+                f"`{selected_file_for_preview}` failed static checks and will likely not start:\n"
+                f"{generation.format_validation_problems(cached_validation_problems(selected_file_for_preview))}"
+            )
         if selected_file_for_preview and selected_file_for_preview != "--- Choose an app ---":
-            if st.button(f"🚀 Run Preview for `{selected_file_for_preview}`", use_container_width=True):
+            run_label = "👁️ Switch to" if preview_manager.get(selected_file_for_preview) else "🚀 Run Preview for"
+            if st.button(f"{run_label} `{selected_file_for_preview}`", use_container_width=True):
                 if start_preview(selected_file_for_preview):
                     st.rerun() # Rerun to update the iframe and status
     st.caption("Previews run the selected Streamlit app in a separate process. Ensure the app code is correct.")
 
+elif selected_tab == "Metrics":
+    st.header("⏱️ Metrics")
+    st.caption(
+        f"Timings recorded in `{METRICS_LOG_PATH}`, one record per script run and one per AI request "
+        "(model calls, parsing, file writes, tokens). Phases are seconds per record; counters are per record."
+    )
+    metrics_records = load_metrics_records()
+    if not metrics_records:
+        st.info("No runs recorded yet." if METRICS_ENABLED else "Metrics recording is disabled (GENIECRAFT_METRICS=0).")
+    else:
+        run_seconds = sorted(record.get("run_seconds", 0.0) for record in metrics_records if record.get("kind", "run") == "run") or [0.0]
+        metric_cols = st.columns(4)
+        metric_cols[0].metric("Runs", len(run_seconds))
+        metric_cols[1].metric("Run p50", f"{_percentile(run_seconds, 0.50) * 1000:.0f} ms")
+        metric_cols[2].metric("Run p90", f"{_percentile(run_seconds, 0.90) * 1000:.0f} ms")
+        metric_cols[3].metric("Run p99", f"{_percentile(run_seconds, 0.99) * 1000:.0f} ms")
+        st.subheader("Phases")
+        st.dataframe(summarize_metrics(metrics_records, "phases"), use_container_width=True, hide_index=True)
+        counter_rows = summarize_metrics(metrics_records, "counters")
+        if counter_rows:
+            st.subheader("Tokens & Counters")
+            st.dataframe(counter_rows, use_container_width=True, hide_index=True)
+        if st.session_state.get("perf_last_record"):
+            with st.expander("Previous run"):
+                st.json(st.session_state.perf_last_record)
+    st.subheader("Preview Capacity")
+    capacity_stats = get_preview_supervisor().stats()
+    capacity_cols = st.columns(4)
+    capacity_cols[0].metric("Previews running", f"{capacity_stats['running']}/{capacity_stats['max_total']}")
+    capacity_cols[1].metric("Sessions alive", capacity_stats["sessions_alive"])
+    capacity_cols[2].metric("Preview memory", f"{capacity_stats['total_rss_mb']:,.0f} MB")
+    capacity_cols[3].metric("Rejected (at capacity)", capacity_stats["rejected_at_capacity"])
+    st.caption(
+        f"Since start: {capacity_stats['started']} started, {capacity_stats['reaped_idle']} reaped when idle, "
+        f"{capacity_stats['reaped_orphaned']} reaped after their tab closed."
+    )
+
+if get_preview_manager().previews:
+    preview_heartbeat(st.session_state.active_preview if selected_tab == "Live Preview" else None)
+
+st.session_state.perf_last_record = perf.flush()
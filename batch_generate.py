@@ -0,0 +1,217 @@
+# batch_generate.py - Generates apps from a list of prompts, without the UI
+#
+# Reads prompts from a JSONL file, one per line: {"prompt": "...", "id": "optional-name"}
+# (a bare JSON string works too). Each prompt runs on a bounded thread pool, through the
+# same core as the chat UI (generation.py), into its own workspace directory under --output.
+# Model calls share one rate limiter. A report line is appended to <output>/report.jsonl as
+# each prompt finishes; a summary is printed at the end.
+#
+# With --fake (or GENIECRAFT_FAKE_MODEL=1) the offline stand-in model is used, so batches can
+# be tried without an API key; GENIECRAFT_FAKE_SECONDS_PER_KB simulates generation time.
+#
+# Usage: python batch_generate.py prompts.jsonl [--output batch_output] [--workers 4] [--fake]
+# Exits with 1 if any prompt failed.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import generation
+
+BATCH_MAX_WORKERS = int(os.getenv("GENIECRAFT_BATCH_WORKERS", "4")) # Prompts generated at the same time
+BATCH_RETRIES = 2 # Further attempts after a failed model call (quota errors, timeouts)
+BATCH_RETRY_BACKOFF_SECONDS = 5.0 # Doubled after each failed attempt
+
+
+def load_prompts(path):
+    """[{"id", "prompt", "line"}] from a JSONL file; ids are made unique and safe as directory names."""
+    entries, seen = [], set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: not valid JSON ({e.msg})") from None
+            if isinstance(entry, str):
+                entry = {"prompt": entry}
+            if not isinstance(entry, dict) or not isinstance(entry.get("prompt"), str) or not entry["prompt"].strip():
+                raise ValueError(f"{path}:{line_number}: expected a string or an object with a \"prompt\"")
+            base_id = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(entry.get("id") or f"prompt_{line_number:04d}")).strip("._") or "prompt"
+            prompt_id, suffix = base_id, 2
+            while prompt_id in seen:
+                prompt_id, suffix = f"{base_id}_{suffix}", suffix + 1
+            seen.add(prompt_id)
+            entries.append({"id": prompt_id, "prompt": entry["prompt"], "line": line_number})
+    return entries
+
+
+def _generate(generative_model, request, rate_limiter, retries):
+    """Response text of one model call, retried with backoff. Returns (text, attempts, model seconds)."""
+    model_seconds = 0.0
+    for attempt in range(1, retries + 2):
+        rate_limiter.acquire()
+        waited_from = time.perf_counter()
+        try:
+            text = generative_model.generate_content(request).text
+            return text, attempt, model_seconds + time.perf_counter() - waited_from
+        except Exception:
+            model_seconds += time.perf_counter() - waited_from
+            if attempt > retries:
+                raise
+            time.sleep(BATCH_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+def run_prompt(entry, workspace_dir, generative_model, rate_limiter, retries=BATCH_RETRIES):
+    """Generates one prompt into `workspace_dir` and returns its report record."""
+    started = time.perf_counter()
+    record = {"id": entry["id"], "line": entry["line"], "prompt": entry["prompt"], "workspace": str(workspace_dir)}
+    workspace = generation.DirectoryWorkspace(workspace_dir, generative_model, rate_limiter)
+    request = generation.request_header(generation.system_prompt(workspace.file_names()))
+    request.append({"role": "user", "parts": [{"text": entry["prompt"]}]})
+    try:
+        response_text, attempts, model_seconds = _generate(generative_model, request, rate_limiter, retries)
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}", attempts=retries + 1,
+                      timing={"total_seconds": round(time.perf_counter() - started, 3)})
+        return record
+
+    applied_from = time.perf_counter()
+    entries, repairs, error = generation.execute_response(response_text, workspace)
+    apply_seconds = time.perf_counter() - applied_from - workspace.model_seconds
+    files = [{
+        "filename": filename,
+        "bytes": (workspace.root / filename).stat().st_size,
+        "problems": workspace.validation_problems(filename) or [],
+    } for filename in workspace.written]
+    if error and not files:
+        status = "failed"
+    elif error or any(level == "error" for level, _ in workspace.messages):
+        status = "partial"
+    else:
+        status = "ok" if files else "no_files"
+    record.update(
+        status=status,
+        error=error,
+        files=files,
+        deleted=workspace.deleted,
+        chat=[e["content"] for e in entries if isinstance(e, dict) and e.get("action") == "chat"],
+        notices=[{"level": level, "message": message} for level, message in workspace.messages],
+        json_repairs=dict(repairs),
+        attempts=attempts,
+        response_chars=len(response_text),
+        timing={
+            "model_seconds": round(model_seconds + workspace.model_seconds, 3),
+            "apply_seconds": round(apply_seconds, 3),
+            "total_seconds": round(time.perf_counter() - started, 3),
+        },
+    )
+    return record
+
+
+def run_batch(entries, output_dir, generative_model, workers, requests_per_minute, overwrite=False, retries=BATCH_RETRIES, log=None):
+    """Runs every prompt on a pool of `workers` threads; returns the records in completion order."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rate_limiter = generation.RequestRateLimiter(requests_per_minute)
+    report_lock = threading.Lock()
+    records = []
+
+    def finish(record):
+        record["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with report_lock:
+            records.append(record)
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+            if log:
+                log(f"[{len(records)}/{len(entries)}] {record['id']}: {record['status']}"
+                    f" ({record['timing']['total_seconds']:.1f}s, {len(record.get('files', []))} file(s))")
+
+    with open(output_dir / "report.jsonl", "a", encoding="utf-8") as report: # Earlier runs' records are kept
+        executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="geniecraft-batch")
+        futures = {}
+        try:
+            for entry in entries:
+                workspace_dir = output_dir / entry["id"]
+                if workspace_dir.exists() and any(workspace_dir.iterdir()):
+                    if not overwrite:
+                        finish({"id": entry["id"], "line": entry["line"], "prompt": entry["prompt"], "workspace": str(workspace_dir),
+                                "status": "skipped", "error": "workspace already exists (use --overwrite)", "timing": {"total_seconds": 0.0}})
+                        continue
+                    shutil.rmtree(workspace_dir)
+                futures[executor.submit(run_prompt, entry, workspace_dir, generative_model, rate_limiter, retries)] = entry
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    finish(future.result())
+                except Exception as e: # A bug rather than a model error; keep the rest of the batch going
+                    finish({"id": entry["id"], "line": entry["line"], "prompt": entry["prompt"], "status": "error",
+                            "error": f"{type(e).__name__}: {e}", "timing": {"total_seconds": 0.0}})
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return records
+
+
+def summarize(records, wall_seconds):
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+    totals = [record["timing"]["total_seconds"] for record in records if record["status"] not in ("skipped",)]
+    return {
+        "prompts": len(records),
+        "statuses": statuses,
+        "files_written": sum(len(record.get("files", [])) for record in records),
+        "files_with_problems": sum(1 for record in records for f in record.get("files", []) if f["problems"]),
+        "wall_seconds": round(wall_seconds, 3),
+        "prompt_seconds_p50": round(statistics.median(totals), 3) if totals else None,
+        "prompt_seconds_max": round(max(totals), 3) if totals else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Streamlit apps from a JSONL file of prompts.")
+    parser.add_argument("prompts", type=Path, help="JSONL file: one {\"prompt\": ..., \"id\": ...} object or string per line")
+    parser.add_argument("--output", type=Path, default=Path("batch_output"), help="One workspace per prompt, plus report.jsonl")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="Prompts generated at the same time")
+    parser.add_argument("--requests-per-minute", type=int, default=int(os.getenv("GENIECRAFT_REQUESTS_PER_MINUTE", "60")),
+                        help="Model calls across all workers (0 = no limit)")
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES, help="Further attempts after a failed model call")
+    parser.add_argument("--fake", action="store_true", default=os.getenv("GENIECRAFT_FAKE_MODEL", "0") == "1",
+                        help="Use the offline stand-in model")
+    parser.add_argument("--overwrite", action="store_true", help="Replace workspaces left by an earlier run")
+    args = parser.parse_args()
+
+    try:
+        from dotenv import load_dotenv # Same .env as the app
+        load_dotenv()
+    except ImportError:
+        pass
+    if not args.fake and not os.getenv("GOOGLE_API_KEY"):
+        parser.error("GOOGLE_API_KEY is not set (use a .env file or the environment), or pass --fake.")
+    try:
+        entries = load_prompts(args.prompts)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    records = run_batch(
+        entries, args.output, generation.create_generative_model(fake=args.fake), args.workers,
+        args.requests_per_minute, overwrite=args.overwrite, retries=args.retries,
+        log=lambda line: print(line, file=sys.stderr),
+    )
+    summary = summarize(records, time.perf_counter() - started)
+    print(json.dumps(summary, indent=2))
+    sys.exit(1 if any(record["status"] in ("error", "failed") for record in records) else 0)
+
+
+if __name__ == "__main__":
+    main()
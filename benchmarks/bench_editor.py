@@ -0,0 +1,114 @@
+# bench_editor.py - Rerun count and payload size of the Workspace editor flow
+#
+# Runs app.py headless through Streamlit's AppTest with the offline fake model, opens a
+# 5,000-line file in the editor, applies a series of edits and saves. The ace editor is a
+# browser component, so it is replaced by a recorder that returns the "typed" text and logs
+# what the script sends to it on each execution.
+#
+# Usage: python benchmarks/bench_editor.py [--lines 5000] [--edits 5] [--app path/to/app.py]
+# Prints one JSON object with per-action script executions and bytes sent to the editor.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+class AceRecorder:
+    """Stand-in for streamlit_ace.st_ace that records every call made by the script."""
+
+    def __init__(self):
+        self.calls = []         # Length of the `value` payload sent to the editor per script execution
+        self.typed_text = None  # Text the simulated user has typed into the editor, if any
+
+    def st_ace(self, value="", key=None, **kwargs):
+        self.calls.append(len(value.encode("utf-8")))
+        return self.typed_text if self.typed_text is not None else value
+
+
+def _session_text_bytes(app_test):
+    state = app_test.session_state
+    total = 0
+    for key in state.filtered_state:
+        value = state[key]
+        if isinstance(value, str):
+            total += len(value.encode("utf-8"))
+    return total
+
+
+def _measure(app_test, recorder, action):
+    calls_before = len(recorder.calls)
+    started = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - started
+    calls = recorder.calls[calls_before:]
+    return {
+        "script_executions": len(calls),
+        "editor_payload_bytes": sum(calls),
+        "session_state_text_bytes": _session_text_bytes(app_test),
+        "seconds": round(elapsed, 4),
+        "exception": bool(app_test.exception),
+    }
+
+
+def run(app_path, line_count, edit_count):
+    from streamlit.testing.v1 import AppTest
+
+    recorder = AceRecorder()
+    sys.modules["streamlit_ace"] = types.SimpleNamespace(st_ace=recorder.st_ace)
+    os.environ["GENIECRAFT_FAKE_MODEL"] = "1"
+    os.environ["GENIECRAFT_PREVIEW_POOL_SIZE"] = "0"
+    os.environ["GENIECRAFT_SESSION_WORKSPACES"] = "0" # Scenarios seed files directly into workspace_st_apps
+
+    workdir = tempfile.mkdtemp(prefix="geniecraft_bench_")
+    os.chdir(workdir)
+    workspace = Path(workdir, "workspace_st_apps")
+    workspace.mkdir()
+    source = "import streamlit as st\n" + "".join(f"st.write('line {i}')\n" for i in range(line_count - 1))
+    (workspace / "big_app.py").write_text(source, encoding="utf-8")
+
+    sys.path.insert(0, str(app_path.parent)) # `streamlit run` puts the script's directory on sys.path
+    app_test = AppTest.from_file(str(app_path), default_timeout=120)
+    results = {"file_lines": line_count, "file_bytes": len(source.encode("utf-8"))}
+    results["initial_load"] = _measure(app_test, recorder, app_test.run)
+    results["select_file"] = _measure(
+        app_test, recorder, lambda: app_test.selectbox(key="file_selector_dropdown").select("big_app.py").run()
+    )
+
+    edits = []
+    text = source
+    for edit_number in range(edit_count):
+        text += f"st.write('edit {edit_number}')\n"
+
+        def type_and_rerun(new_text=text):
+            recorder.typed_text = new_text # The component reports the edit, which triggers one rerun
+            app_test.run()
+        edits.append(_measure(app_test, recorder, type_and_rerun))
+    results["edits"] = edits
+    try:
+        save_button = app_test.button(key="save_btn_manual")
+    except KeyError:
+        save_button = None # The script failed before rendering the editor buttons
+    if save_button is not None:
+        results["save"] = _measure(app_test, recorder, lambda: save_button.click().run())
+    results["saved_correctly"] = (workspace / "big_app.py").read_text(encoding="utf-8") == text
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Workspace editor rerun flow.")
+    parser.add_argument("--app", default=str(REPO_ROOT / "app.py"))
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--edits", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(Path(args.app).resolve(), args.lines, args.edits), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+# bench_suite.py - Offline benchmarks for GenieCraft's main code paths
+#
+# Runs app.py headless through Streamlit's AppTest with the offline fake model
+# (GENIECRAFT_FAKE_MODEL=1), so no API key or network access is needed. Scenarios:
+#   rerun    - script rerun latency against chat history length
+#   history  - _prepare_gemini_history cost when sending a prompt on top of that history
+#   parse    - execute_response (via _queue_response) / streaming parser throughput on multi-MB responses
+#   preview  - live preview start-up time, cold and with pre-warmed workers
+#   planner  - end-to-end time of a multi-file request, single call vs. planner mode
+#   startup  - cold-start (first run in a fresh interpreter) and per-rerun time, per tab
+#   context  - workspace code selected for an edit request vs. the whole workspace, and index cost
+#   batch    - batch_generate.py throughput on a prompt file, per worker count
+# Phase timings come from the per-run records app.py appends to GENIECRAFT_METRICS_LOG;
+# wall-clock time around each AppTest action is reported as well, so older commits
+# without instrumentation can still be compared.
+#
+# Every scenario/configuration runs in its own interpreter, because st.cache_resource
+# singletons (worker pool, caches) would otherwise leak from one configuration to the next.
+#
+# Usage: python benchmarks/bench_suite.py [--scenario all] [--app path/to/app.py] [--output results.json]
+# Prints (or writes) one JSON object keyed by scenario.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("rerun", "history", "parse", "preview", "planner", "startup", "context", "batch")
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "n": len(values),
+        "min": round(values[0], 6),
+        "p50": round(statistics.median(values), 6),
+        "max": round(values[-1], 6),
+    }
+
+
+class MetricsLog:
+    """Reads the run records app.py appended since the last call."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offset = 0
+
+    def new_records(self):
+        if not self.path.exists():
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+            self.offset = f.tell()
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def _prepare_environment(workdir, tab="Workspace", **env):
+    os.chdir(workdir)
+    os.environ["GENIECRAFT_FAKE_MODEL"] = "1"
+    os.environ["GENIECRAFT_RESPONSE_CACHE"] = "0" # Every request must reach the (fake) model
+    os.environ["GENIECRAFT_PREVIEW_POOL_SIZE"] = "0"
+    os.environ["GENIECRAFT_SESSION_WORKSPACES"] = "0" # Scenarios seed files directly into workspace_st_apps
+    os.environ["GENIECRAFT_METRICS_LOG"] = str(Path(workdir, "metrics.jsonl"))
+    os.environ.pop("GOOGLE_API_KEY", None)
+    os.environ.update({key: str(value) for key, value in env.items()})
+    # The tab menu is a browser component; pin it to the tab the scenario exercises.
+    sys.modules["streamlit_option_menu"] = types.SimpleNamespace(option_menu=lambda *args, **kwargs: tab)
+    Path(workdir, "workspace_st_apps").mkdir(exist_ok=True)
+    return MetricsLog(os.environ["GENIECRAFT_METRICS_LOG"])
+
+
+def _synthetic_history(message_count, code_kb=2):
+    code = "import streamlit as st\n" + "st.write('generated line')\n" * (code_kb * 1024 // 26)
+    messages = []
+    for turn in range(message_count // 2):
+        messages.append({"role": "user", "content": f"Request {turn}: add a chart and a sidebar filter"})
+        messages.append({"role": "assistant", "content": [
+            {"action": "create_update", "filename": f"app_{turn % 5}.py", "content": code},
+            {"action": "chat", "content": f"Updated app_{turn % 5}.py for request {turn}."},
+        ]})
+    return messages
+
+
+def _new_app_test(app_path, messages=None):
+    from streamlit.testing.v1 import AppTest
+
+    if str(app_path.parent) not in sys.path:
+        sys.path.insert(0, str(app_path.parent)) # `streamlit run` puts the script's directory on sys.path
+    app_test = AppTest.from_file(str(app_path), default_timeout=300)
+    if messages is not None:
+        app_test.session_state["messages"] = messages
+    return app_test
+
+
+def _timed(action):
+    started = time.perf_counter()
+    action()
+    return time.perf_counter() - started
+
+
+def _send_prompt(app_test, prompt):
+    """Submits a chat prompt and reruns until the background AI request has been applied."""
+    app_test.chat_input[0].set_value(prompt).run()
+    while "ai_job" in app_test.session_state and app_test.session_state["ai_job"] is not None:
+        time.sleep(0.01)
+        app_test.run()
+
+
+def _ai_request_record(records):
+    """The record finish_ai_job flushed for the request just sent; raises if it never reached the log.
+
+    AppTest runs fragments inline, but in a browser session the request is finished by a
+    fragment rerun, after the full run flushed its own recorder, so the app must flush this one itself.
+    """
+    for record in records:
+        if record.get("kind") == "ai_request":
+            return record
+    raise RuntimeError("no ai_request record in the metrics log after the request finished")
+
+
+def _phase_total(records, phase):
+    return sum(record.get("phases", {}).get(phase, 0.0) for record in records)
+
+
+def bench_rerun(app_path, history_lengths, reruns):
+    results = []
+    for message_count in history_lengths:
+        metrics = _prepare_environment(tempfile.mkdtemp(prefix="geniecraft_bench_"))
+        app_test = _new_app_test(app_path, _synthetic_history(message_count))
+        app_test.run() # Warm-up: imports, CSS, cache_resource singletons
+        metrics.new_records()
+        wall_seconds = [_timed(app_test.run) for _ in range(reruns)]
+        records = metrics.new_records()
+        results.append({
+            "history_messages": message_count,
+            "wall_seconds": _summary(wall_seconds),
+            "run_seconds": _summary([record["run_seconds"] for record in records]),
+            "sidebar_chat_render_seconds": _summary(
+                [record["phases"].get("sidebar_chat_render", 0.0) for record in records]
+            ),
+            "exception": bool(app_test.exception),
+        })
+    return results
+
+
+def bench_history(app_path, history_lengths):
+    results = []
+    for message_count in history_lengths:
+        metrics = _prepare_environment(tempfile.mkdtemp(prefix="geniecraft_bench_"))
+        app_test = _new_app_test(app_path, _synthetic_history(message_count))
+        app_test.run()
+        metrics.new_records()
+        wall = _timed(lambda: _send_prompt(app_test, "Add a download button"))
+        records = metrics.new_records()
+        request_record = _ai_request_record(records)
+        stats = app_test.session_state["history_stats"] if "history_stats" in app_test.session_state else None
+        results.append({
+            "history_messages": message_count,
+            "wall_seconds": round(wall, 6),
+            "history_prep_seconds": round(_phase_total(records, "history_prep"), 6),
+            "prompt_tokens": (stats or {}).get("prompt_tokens"),
+            "ai_request_record_seconds": request_record["run_seconds"],
+            "exception": bool(app_test.exception),
+        })
+    return results
+
+
+def bench_parse(app_path, response_mbs, stream):
+    results = []
+    for response_mb in response_mbs:
+        workdir = tempfile.mkdtemp(prefix="geniecraft_bench_")
+        metrics = _prepare_environment(
+            workdir,
+            GENIECRAFT_FAKE_RESPONSE_KB=int(response_mb * 1024),
+            GENIECRAFT_STREAM_RESPONSES="1" if stream else "0",
+        )
+        app_test = _new_app_test(app_path)
+        app_test.run()
+        metrics.new_records()
+        wall = _timed(lambda: _send_prompt(app_test, "Build a large dashboard"))
+        records = metrics.new_records()
+        _ai_request_record(records) # Fails the scenario if the request's metrics were lost
+        parse_seconds = _phase_total(records, "json_parse")
+        write_seconds = _phase_total(records, "file_writes")
+        written = sum(path.stat().st_size for path in Path(workdir, "workspace_st_apps").glob("*.py"))
+        results.append({
+            "response_mb": response_mb,
+            "stream": stream,
+            "wall_seconds": round(wall, 6),
+            "json_parse_seconds": round(parse_seconds, 6),
+            "file_writes_seconds": round(write_seconds, 6),
+            "parse_mb_per_second": round(response_mb / parse_seconds, 2) if parse_seconds else None,
+            "bytes_written": written,
+            "exception": bool(app_test.exception),
+        })
+    return results
+
+
+def bench_preview(app_path, pool_size, starts, warmup_seconds):
+    workdir = tempfile.mkdtemp(prefix="geniecraft_bench_")
+    metrics = _prepare_environment(
+        workdir, tab="Live Preview",
+        GENIECRAFT_PREVIEW_POOL_SIZE=pool_size,
+        GENIECRAFT_PREVIEW_MAX_CONCURRENT=starts + 1, # Keep eviction out of the measurement
+    )
+    for index in range(starts):
+        Path(workdir, "workspace_st_apps", f"preview_{index}.py").write_text(
+            f"import streamlit as st\nst.title('Preview {index}')\n", encoding="utf-8"
+        )
+    app_test = _new_app_test(app_path)
+    app_test.run()
+    time.sleep(warmup_seconds) # Lets the pool finish pre-warming its workers
+    timings = []
+    for index in range(starts):
+        app_test.selectbox(key="preview_file_selector").select(f"preview_{index}.py").run()
+        start_button = next(button for button in app_test.button if "Preview for" in button.label)
+        metrics.new_records()
+        wall = _timed(lambda: start_button.click().run())
+        timings.append({
+            "wall_seconds": round(wall, 6),
+            "preview_start_seconds": round(_phase_total(metrics.new_records(), "preview_start"), 6),
+        })
+        if pool_size:
+            time.sleep(warmup_seconds) # Give the pool time to replace the worker just used
+    manager = app_test.session_state["preview_manager"] if "preview_manager" in app_test.session_state else None
+    for handle in (manager.running() if manager else []):
+        handle.process.terminate()
+    return {
+        "pool_size": pool_size,
+        "starts": timings,
+        "preview_start_seconds": _summary([timing["preview_start_seconds"] for timing in timings]),
+        "exception": bool(app_test.exception),
+    }
+
+
+def bench_planner(app_path, files, seconds_per_kb, workers):
+    """Same multi-file request with and without planner mode; the fake model simulates generation time."""
+    results = []
+    for planned in (False, True):
+        workdir = tempfile.mkdtemp(prefix="geniecraft_bench_")
+        metrics = _prepare_environment(
+            workdir,
+            GENIECRAFT_PLANNER="1" if planned else "0",
+            GENIECRAFT_PLANNER_WORKERS=workers,
+            GENIECRAFT_FAKE_FILES=files,
+            GENIECRAFT_FAKE_SECONDS_PER_KB=seconds_per_kb,
+            GENIECRAFT_REQUESTS_PER_MINUTE=0,
+        )
+        app_test = _new_app_test(app_path)
+        app_test.run()
+        metrics.new_records()
+        wall = _timed(lambda: _send_prompt(app_test, "Create a dashboard app, a data-loader module and a settings page"))
+        records = metrics.new_records()
+        _ai_request_record(records) # Fails the scenario if the request's metrics were lost
+        results.append({
+            "planned": planned,
+            "files": files,
+            "wall_seconds": round(wall, 6),
+            "ai_request_seconds": round(_phase_total(records, "ai_request_planned" if planned else "ai_request_single"), 6),
+            "gemini_call_seconds": round(_phase_total(records, "gemini_call"), 6),
+            "files_written": len(list(Path(workdir, "workspace_st_apps").glob("*.py"))),
+            "exception": bool(app_test.exception),
+        })
+    return results
+
+
+HEAVY_MODULES = ("google.generativeai", "streamlit_ace", "streamlit_antd_components", "dotenv")
+
+
+def bench_startup(app_path, tab, reruns):
+    """First run in a fresh interpreter (imports, cached resources) and the reruns after it."""
+    metrics = _prepare_environment(tempfile.mkdtemp(prefix="geniecraft_bench_"), tab=tab)
+    app_test = _new_app_test(app_path)
+    cold = _timed(app_test.run)
+    cold_records = metrics.new_records()
+    wall_seconds = [_timed(app_test.run) for _ in range(reruns)]
+    records = metrics.new_records()
+    return {
+        "tab": tab,
+        "cold_start_seconds": round(cold, 6),
+        "cold_run_seconds": cold_records[-1]["run_seconds"] if cold_records else None,
+        "rerun_wall_seconds": _summary(wall_seconds),
+        "rerun_run_seconds": _summary([record["run_seconds"] for record in records]),
+        "modules_loaded": {name: name in sys.modules for name in HEAVY_MODULES},
+        "exception": bool(app_test.exception),
+    }
+
+
+def _synthetic_module(index, functions=12):
+    parts = ["import streamlit as st", "import pandas as pd", ""]
+    for number in range(functions):
+        parts += [
+            f"def step_{index}_{number}(df):",
+            *[f"    df = df.assign(col_{line}=df.index * {line})" for line in range(15)],
+            "    return df",
+            "",
+            f"if st.button('Run step {index}.{number}'):",
+            f"    st.dataframe(step_{index}_{number}(pd.DataFrame({{'a': range(10)}})))",
+            "",
+        ]
+    return "\n".join(parts)
+
+
+def bench_context(app_path, file_count):
+    """An edit request naming one function and one widget in a workspace of `file_count` files."""
+    workdir = tempfile.mkdtemp(prefix="geniecraft_bench_")
+    metrics = _prepare_environment(workdir)
+    workspace = Path(workdir, "workspace_st_apps")
+    for index in range(file_count):
+        (workspace / f"module_{index}.py").write_text(_synthetic_module(index), encoding="utf-8")
+    (workspace / "sales.py").write_text(
+        "import streamlit as st\n\n"
+        "def plot_sales_chart(df):\n    st.line_chart(df)\n\n"
+        "if st.button('Export CSV'):\n    st.download_button('Download', 'a,b', 'sales.csv')\n",
+        encoding="utf-8",
+    )
+    workspace_bytes = sum(path.stat().st_size for path in workspace.glob("*.py"))
+    app_test = _new_app_test(app_path)
+    app_test.run()
+    results = []
+    for attempt in ("cold", "warm"): # Warm: every outline comes from the symbol index
+        metrics.new_records()
+        wall = _timed(lambda: _send_prompt(app_test, "Make the Export CSV button also plot the sales chart"))
+        records = metrics.new_records()
+        _ai_request_record(records) # Fails the scenario if the request's metrics were lost
+        stats = app_test.session_state["history_stats"] if "history_stats" in app_test.session_state else None
+        results.append({
+            "index": attempt,
+            "workspace_files": file_count + 1,
+            "workspace_tokens": workspace_bytes // 4,
+            "context_tokens": (stats or {}).get("context_tokens"),
+            "context_files": (stats or {}).get("context_files"),
+            "context_index_seconds": round(_phase_total(records, "context_index"), 6),
+            "wall_seconds": round(wall, 6),
+            "exception": bool(app_test.exception),
+        })
+    return results
+
+
+def bench_batch(prompt_count, worker_counts, seconds_per_kb):
+    """The same prompt file through batch_generate.py (offline model, no rate limit) with each worker count."""
+    workdir = Path(tempfile.mkdtemp(prefix="geniecraft_bench_"))
+    prompts = workdir / "prompts.jsonl"
+    prompts.write_text("".join(json.dumps({"prompt": f"Template app number {i}"}) + "\n" for i in range(prompt_count)), encoding="utf-8")
+    env = dict(os.environ, GENIECRAFT_FAKE_SECONDS_PER_KB=str(seconds_per_kb))
+    results = []
+    for workers in worker_counts:
+        command = [sys.executable, str(REPO_ROOT / "batch_generate.py"), str(prompts), "--fake", "--requests-per-minute", "0",
+                   "--workers", str(workers), "--output", str(workdir / f"workers_{workers}")]
+        completed = subprocess.run(command, capture_output=True, text=True, env=env)
+        summary = json.loads(completed.stdout) if completed.stdout.strip() else {"error": completed.stderr.strip().splitlines()[-5:]}
+        results.append({"workers": workers, **summary})
+    return results
+
+
+def _run_child(args, scenario, extra):
+    command = [sys.executable, str(Path(__file__).resolve()), "--scenario", scenario, "--app", str(args.app), *extra]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-20:]}
+    return json.loads(completed.stdout)
+
+
+def run_all(args):
+    shared = [
+        "--history", ",".join(map(str, args.history)),
+        "--reruns", str(args.reruns),
+        "--response-mb", ",".join(map(str, args.response_mb)),
+        "--preview-starts", str(args.preview_starts),
+        "--preview-warmup", str(args.preview_warmup),
+        "--planner-files", str(args.planner_files),
+        "--fake-seconds-per-kb", str(args.fake_seconds_per_kb),
+        "--planner-workers", str(args.planner_workers),
+        "--context-files", str(args.context_files),
+        "--batch-prompts", str(args.batch_prompts),
+        "--batch-workers", ",".join(map(str, args.batch_workers)),
+    ]
+    return {
+        "rerun": _run_child(args, "rerun", shared),
+        "history": _run_child(args, "history", shared),
+        "parse": _run_child(args, "parse", shared) + _run_child(args, "parse", shared + ["--no-stream"]),
+        "preview": [
+            _run_child(args, "preview", shared + ["--pool-size", "0"]),
+            _run_child(args, "preview", shared + ["--pool-size", "2"]),
+        ],
+        "planner": _run_child(args, "planner", shared),
+        "startup": [
+            _run_child(args, "startup", shared + ["--tab", "Workspace"]),
+            _run_child(args, "startup", shared + ["--tab", "Live Preview"]),
+        ],
+        "context": _run_child(args, "context", shared),
+        "batch": _run_child(args, "batch", shared),
+    }
+
+
+def _number_list(value):
+    return [float(item) if "." in item else int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline GenieCraft benchmark suite.")
+    parser.add_argument("--scenario", choices=("all",) + SCENARIOS, default="all")
+    parser.add_argument("--app", type=Path, default=REPO_ROOT / "app.py")
+    parser.add_argument("--history", type=_number_list, default=[0, 50, 200, 800], help="Chat history lengths")
+    parser.add_argument("--reruns", type=int, default=5)
+    parser.add_argument("--response-mb", type=_number_list, default=[1, 4], help="Fake response sizes in MB")
+    parser.add_argument("--no-stream", action="store_true", help="Parse scenario: use the non-streaming path")
+    parser.add_argument("--pool-size", type=int, default=0, help="Preview scenario: pre-warmed workers")
+    parser.add_argument("--preview-starts", type=int, default=3)
+    parser.add_argument("--preview-warmup", type=float, default=3.0)
+    parser.add_argument("--planner-files", type=int, default=3, help="Planner scenario: files per request")
+    parser.add_argument("--fake-seconds-per-kb", type=float, default=0.05, help="Planner scenario: simulated generation time")
+    parser.add_argument("--planner-workers", type=int, default=4, help="Planner scenario: concurrent per-file calls")
+    parser.add_argument("--tab", default="Workspace", help="Startup scenario: tab shown by the app")
+    parser.add_argument("--context-files", type=int, default=40, help="Context scenario: unrelated files in the workspace")
+    parser.add_argument("--batch-prompts", type=int, default=8, help="Batch scenario: prompts in the file")
+    parser.add_argument("--batch-workers", type=_number_list, default=[1, 4], help="Batch scenario: worker counts")
+    parser.add_argument("--output", type=Path, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.app = args.app.resolve()
+
+    if args.scenario == "all":
+        results = {"app": str(args.app), "python": sys.version.split()[0], "scenarios": run_all(args)}
+    elif args.scenario == "rerun":
+        results = bench_rerun(args.app, args.history, args.reruns)
+    elif args.scenario == "history":
+        results = bench_history(args.app, args.history)
+    elif args.scenario == "parse":
+        results = bench_parse(args.app, args.response_mb, stream=not args.no_stream)
+    elif args.scenario == "startup":
+        results = bench_startup(args.app, args.tab, args.reruns)
+    elif args.scenario == "batch":
+        results = bench_batch(args.batch_prompts, args.batch_workers, args.fake_seconds_per_kb)
+    elif args.scenario == "context":
+        results = bench_context(args.app, args.context_files)
+    elif args.scenario == "planner":
+        results = bench_planner(args.app, args.planner_files, args.fake_seconds_per_kb, args.planner_workers)
+    else:
+        results = bench_preview(args.app, args.pool_size, args.preview_starts, args.preview_warmup)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# code_validation.py - Static checks for generated Streamlit apps
+#
+# Validates a file without running it:
+#   - byte-compiles it (syntax errors),
+#   - reports names that are read but never bound anywhere in the module,
+#   - resolves every absolute import against the current environment.
+# Lives in its own module so app.py can hand files to worker processes (validation_worker.py),
+# which import this module instead of the Streamlit script.
+#
+# Results are plain dicts: {"problems": [{"kind", "line", "message", "module"?}, ...]}.
+# Import problems carry the top-level module name, so the app can drop the ones satisfied
+# by a sibling file in the workspace (that set changes more often than the file itself).
+
+import ast
+import builtins
+import importlib.util
+import sys
+
+_MODULE_GLOBALS = {"__file__", "__name__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__", "__path__", "__annotations__"}
+_KNOWN_NAMES = frozenset(dir(builtins)) | _MODULE_GLOBALS
+_IMPORT_ERROR_NAMES = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+
+
+def _caught_names(try_node):
+    caught = set()
+    for handler in try_node.handlers:
+        if handler.type is None:
+            caught.add("BaseException")
+            continue
+        caught.update(node.id for node in ast.walk(handler.type) if isinstance(node, ast.Name))
+    return caught
+
+
+def _scan_module(tree):
+    """One pass over the tree: (bound names, {loaded name: first line}, import nodes, optional import ids).
+
+    Bound names are collected from every scope (deliberately generous); imports inside
+    `try: ... except ImportError:` are optional dependencies.
+    """
+    bound, loaded, imports, guarded = set(), {}, [], set()
+    for node in ast.walk(tree):
+        node_type = type(node)
+        if node_type is ast.Name:
+            if type(node.ctx) is ast.Load:
+                loaded.setdefault(node.id, node.lineno)
+            else:
+                bound.add(node.id)
+        elif node_type is ast.arg:
+            bound.add(node.arg)
+        elif node_type in (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef):
+            bound.add(node.name)
+        elif node_type in (ast.Import, ast.ImportFrom):
+            imports.append(node)
+            for alias in node.names:
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif node_type is ast.ExceptHandler:
+            if node.name:
+                bound.add(node.name)
+        elif node_type in (ast.Global, ast.Nonlocal):
+            bound.update(node.names)
+        elif node_type in (ast.MatchAs, ast.MatchStar):
+            if node.name:
+                bound.add(node.name)
+        elif node_type is ast.MatchMapping:
+            if node.rest:
+                bound.add(node.rest)
+        elif node_type is ast.Try or node_type.__name__ == "TryStar":
+            if _caught_names(node) & _IMPORT_ERROR_NAMES:
+                for statement in node.body:
+                    guarded.update(id(child) for child in ast.walk(statement) if isinstance(child, (ast.Import, ast.ImportFrom)))
+    return bound, loaded, imports, guarded
+
+
+def _module_available(module_name):
+    if module_name in sys.builtin_module_names:
+        return True
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def validate_source(source, filename="<workspace>"):
+    problems = []
+    try:
+        tree = ast.parse(source, filename=filename)
+        compile(tree, filename, "exec") # Catches what the parser accepts but the compiler does not (e.g. misplaced return)
+    except SyntaxError as e:
+        problems.append({"kind": "syntax", "line": e.lineno or 0, "message": f"Syntax error: {e.msg}"})
+        return {"problems": problems}
+    except ValueError as e: # e.g. null bytes in the source
+        problems.append({"kind": "syntax", "line": 0, "message": f"Cannot compile: {e}"})
+        return {"problems": problems}
+
+    bound, loaded, imports, guarded = _scan_module(tree)
+    star_import = False
+    checked_modules = set()
+    for node in imports:
+        if isinstance(node, ast.ImportFrom):
+            star_import = star_import or any(alias.name == "*" for alias in node.names)
+            module_names = [node.module] if node.level == 0 and node.module else []
+        else:
+            module_names = [alias.name for alias in node.names]
+        if id(node) in guarded:
+            continue
+        for module_name in module_names:
+            top_level = module_name.split(".")[0]
+            if top_level in checked_modules:
+                continue
+            checked_modules.add(top_level)
+            if not _module_available(top_level):
+                problems.append({
+                    "kind": "import", "line": node.lineno, "module": top_level,
+                    "message": f"Module '{top_level}' is not installed",
+                })
+
+    if not star_import: # Names pulled in by `import *` cannot be known statically
+        for name, line in loaded.items():
+            if name not in bound and name not in _KNOWN_NAMES:
+                problems.append({"kind": "undefined_name", "line": line, "message": f"Undefined name '{name}'"})
+
+    problems.sort(key=lambda problem: problem["line"])
+    return {"problems": problems}
+
+
+def validate_job(job):
+    """Worker entry point: (key, filename, source) -> (key, result)."""
+    key, filename, source = job
+    return key, validate_source(source, filename)
@@ -0,0 +1,772 @@
+# generation.py - UI-independent core of GenieCraft
+#
+# Everything needed to turn a prompt into workspace files without Streamlit:
+#   - the system prompt and request layout sent to the model,
+#   - the offline stand-in model (GENIECRAFT_FAKE_MODEL=1) and a shared rate limiter,
+#   - tolerant and streaming parsing of the model's JSON command array,
+#   - execution of the commands against a workspace (write, patch, delete, validation).
+# app.py drives it from the chat UI; batch_generate.py from the command line.
+#
+# Commands run against a workspace object (read, write, delete, validation_problems,
+# request_rewrite, notify). DirectoryWorkspace is the headless one; app.py adapts its
+# session workspace, so toasts and editor syncing stay in the UI.
+
+import collections
+import difflib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import code_validation
+
+# --- Model and Prompts ---
+GEMINI_MODEL_NAME = "gemini-1.5-pro-latest" # Using a generally available and capable model
+
+# Instructions for the Google AI model; system_prompt() fills in {workspace_files} and {workspace_context}.
+GEMINI_SYSTEM_PROMPT = """
+You are an AI assistant helping create Streamlit applications.
+Your goal is to manage Python files in a workspace based on user requests.
+Respond *only* with a valid JSON array containing commands. Do not add any explanations before or after the JSON array.
+
+Available commands:
+1.  `{"action": "create_update", "filename": "app_name.py", "content": "FULL_PYTHON_CODE_HERE"}`
+    - Use this to create a new Python file or completely overwrite an existing one.
+    - The "content" MUST be a complete, runnable Streamlit Python script.
+    - ALWAYS include necessary import statements (e.g., `import streamlit as st`, `import pandas as pd`, `import plotly.express as px`, `from PIL import Image`).
+    - If the generated app needs its own API keys (e.g., for a weather API), it should ask the user for them using `st.text_input(type='password')` within its own code.
+    - For Pygame, generate code that draws to a Pygame surface, then converts it to bytes (`io.BytesIO()`) and displays it using `st.image()`. Avoid `pygame.display.set_mode()` or `pygame.display.flip()` for direct display.
+    - Ensure newlines in "content" are `\\n`, and escape backslashes (`\\\\`) and double quotes (`\\"`).
+    - Do *not* include ```python markdown blocks or shebangs (`#!/usr/bin/env python`) in the "content".
+2.  `{"action": "patch", "filename": "existing_app.py", "hunks": [{"search": "EXACT_EXISTING_LINES", "replace": "NEW_LINES"}]}`
+    - Prefer this over `create_update` for small edits to an existing file; do not resend the whole file.
+    - Each "search" must be copied exactly from the current file (including indentation) and must occur only once in it; include a few neighbouring lines if needed to make it unique.
+    - Hunks are applied in order. Use the same escaping rules as for "content".
+3.  `{"action": "delete", "filename": "old_app.py"}`
+    - Use this to delete a Python file from the workspace.
+4.  `{"action": "chat", "content": "Your message here."}`
+    - Use this *only* if you need to ask for clarification, report an issue you can't fix with file actions, or confirm understanding.
+
+Current Python files in workspace: {workspace_files}
+{workspace_context}
+
+Example Interaction:
+User: Create a simple hello world app called hello.py that also imports pandas.
+AI: `[{"action": "create_update", "filename": "hello.py", "content": "import streamlit as st\\nimport pandas as pd\\n\\nst.title('Hello World!')\\nst.write('This is a simple app with pandas imported.')\\ndf = pd.DataFrame({'col1': [1, 2], 'col2': [3, 4]})\\nst.write(df)"}]`
+
+Ensure your entire response is *only* the JSON array `[...]`.
+"""
+
+# Planner mode: appended to the latest user message, after GEMINI_PLANNER_SEPARATOR.
+GEMINI_PLANNER_SEPARATOR = "\n\n---\n"
+GEMINI_PLANNER_INSTRUCTION = """Do not write any code yet. First plan which Python files this request needs.
+Respond *only* with a JSON array of the files to create or update, in the form
+`[{"filename": "name.py", "description": "what this file contains and how it uses the other files"}]`.
+If the request needs a single file, list just that file; if it needs no file changes, respond with `[]`."""
+GEMINI_PLANNER_FILE_INSTRUCTION = """Generate only `{filename}`: {description}
+The other files of this request are generated separately: {other_files}. Import from them by module name where needed.
+Respond with a JSON array containing a single `create_update` (or `patch`) command for `{filename}`."""
+
+def system_prompt(workspace_files, workspace_context=""):
+    """The system prompt for a workspace holding `workspace_files`, plus optional code context."""
+    return (GEMINI_SYSTEM_PROMPT
+            .replace("{workspace_files}", ', '.join(workspace_files) if workspace_files else 'None')
+            .replace("{workspace_context}", workspace_context))
+
+def request_header(system_prompt_text):
+    """First two entries of every request: the system prompt and the model's acknowledgement."""
+    return [
+        {"role": "user", "parts": [{"text": system_prompt_text}]},
+        {"role": "model", "parts": [{"text": json.dumps([{"action": "chat", "content": "Understood. I will respond only with JSON commands."}])}]},
+    ]
+
+# --- Offline Stand-in Model ---
+FAKE_MODEL_RESPONSE_KB = int(os.getenv("GENIECRAFT_FAKE_RESPONSE_KB", "4"))   # Size of each fake file
+FAKE_MODEL_FILES = int(os.getenv("GENIECRAFT_FAKE_FILES", "1"))               # Files written per fake request
+FAKE_MODEL_SECONDS_PER_KB = float(os.getenv("GENIECRAFT_FAKE_SECONDS_PER_KB", "0")) # Simulated generation time
+
+class TextResponse:
+    def __init__(self, text):
+        self.text = text
+        self.prompt_feedback = None
+        self.candidates = []
+
+class _FakeTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+class FakeGenerativeModel:
+    """Deterministic drop-in for `genai.GenerativeModel`, for offline runs and benchmarks.
+
+    Each request answers with a `create_update` for each of `files` files named after a hash
+    of the last user message (about `response_kb` KB of valid Streamlit code each) plus a
+    chat message. Planner requests get the same file names back as a plan, and per-file
+    requests a single `create_update`. The same history always yields the same response;
+    `seconds_per_kb` simulates generation time.
+    """
+
+    _FILE_REQUEST_RE = re.compile(r"Generate only `([^`]+)`")
+
+    def __init__(self, model_name, response_kb=FAKE_MODEL_RESPONSE_KB, chunk_size=512,
+                 files=FAKE_MODEL_FILES, seconds_per_kb=FAKE_MODEL_SECONDS_PER_KB):
+        self.model_name = model_name
+        self.response_kb = response_kb
+        self.chunk_size = chunk_size
+        self.files = max(files, 1)
+        self.seconds_per_kb = seconds_per_kb
+
+    @staticmethod
+    def _last_user_text(contents):
+        for entry in reversed(contents):
+            if entry.get("role") == "user":
+                return "".join(part.get("text", "") for part in entry.get("parts", []))
+        return ""
+
+    def _source(self, title, digest):
+        lines = ["import streamlit as st", "", f"st.title({title[:60]!r})"]
+        target_size = self.response_kb * 1024
+        size, row = sum(len(line) + 1 for line in lines), 0
+        while size < target_size:
+            line = f"st.write('Row {row} generated offline for request {digest}.')"
+            lines.append(line)
+            size += len(line) + 1
+            row += 1
+        return "\n".join(lines) + "\n"
+
+    def _response_text(self, contents):
+        prompt, _, instruction = self._last_user_text(contents).partition(GEMINI_PLANNER_SEPARATOR)
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+        filenames = [f"fake_{digest}.py"] if self.files == 1 else [f"fake_{digest}_{i}.py" for i in range(self.files)]
+        if instruction.startswith(GEMINI_PLANNER_INSTRUCTION):
+            return json.dumps([{"filename": name, "description": f"Part {i + 1} of the request."} for i, name in enumerate(filenames)])
+        file_request = self._FILE_REQUEST_RE.search(instruction)
+        if file_request:
+            filenames = [file_request.group(1)]
+        commands = [{"action": "create_update", "filename": name, "content": self._source(prompt, digest)} for name in filenames]
+        size = sum(len(command["content"]) for command in commands)
+        commands.append({"action": "chat", "content": f"Created {', '.join(filenames)} ({size:,} bytes) with the offline model."})
+        return json.dumps(commands)
+
+    def _chunks(self, text):
+        for i in range(0, len(text), self.chunk_size):
+            chunk = text[i:i + self.chunk_size]
+            time.sleep(self.seconds_per_kb * len(chunk) / 1024)
+            yield TextResponse(chunk)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        text = self._response_text(contents)
+        if not stream:
+            time.sleep(self.seconds_per_kb * len(text) / 1024)
+            return TextResponse(text)
+        return self._chunks(text)
+
+    def count_tokens(self, contents):
+        text = "".join(part.get("text", "") for entry in contents for part in entry.get("parts", []))
+        return _FakeTokenCount(-(-len(text) // 4))
+
+def create_generative_model(fake=False, model_name=GEMINI_MODEL_NAME):
+    """The offline stand-in, or a `genai.GenerativeModel` configured from GOOGLE_API_KEY.
+
+    google.generativeai is imported here rather than at the top, so callers that never
+    talk to the model do not pay for it.
+    """
+    if fake:
+        return FakeGenerativeModel(model_name)
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel(model_name)
+
+# --- Rate Limiting ---
+class RequestRateLimiter:
+    """Spaces model calls at least 60/`requests_per_minute` seconds apart, across threads and sessions."""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, cancelled=None):
+        """Waits for this call's slot. Returns False if `cancelled` (an Event) is set meanwhile."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay <= 0:
+            return True
+        if cancelled is None:
+            time.sleep(delay)
+            return True
+        return not cancelled.wait(delay)
+
+# --- Tolerant JSON Recovery ---
+def clean_response_text(ai_response_text):
+    text = ai_response_text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else "" # Drop the ```json line
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+_JSON_ARRAY_START_RE = re.compile(r"\[\s*[{\]]") # Opening of the command array, not a "[" in surrounding prose
+_JSON_STRING_RUN_RE = re.compile(r'[^"\\\n\r\t]*') # String characters that never need repairing
+_JSON_UNICODE_ESCAPE_RE = re.compile(r"[0-9a-fA-F]{4}")
+_JSON_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+# A quote only closes a string when what follows fits the JSON around it; otherwise it is a
+# quote inside the code that the model forgot to escape.
+_JSON_KEY_END_RE = re.compile(r"\s*:")
+_JSON_OBJECT_VALUE_END_RE = re.compile(r'\s*(?:,\s*(?:"(?:[^"\\\n]|\\.)*"\s*:|\})|\}|\Z)')
+_JSON_ARRAY_VALUE_END_RE = re.compile(r"\s*(?:,|\]|\Z)")
+# Keys each action may carry. A repaired command with any other key had a string closed
+# too early, so the rest of its text was read as extra keys.
+COMMAND_KEYS = {
+    "create_update": {"action", "filename", "content"},
+    "patch": {"action", "filename", "hunks"},
+    "delete": {"action", "filename"},
+    "chat": {"action", "content"},
+}
+_BRACKET_PAIRS = {")": "(", "]": "[", "}": "{"}
+
+def _scan_json_string(text, pos, end_re, repairs):
+    """Reads the string literal opening at text[pos]; returns (valid JSON literal, end) or (None, end) if cut off."""
+    pieces = ['"']
+    fired = set()
+    pos += 1
+    while True:
+        run = _JSON_STRING_RUN_RE.match(text, pos)
+        pieces.append(run.group())
+        pos = run.end()
+        if pos >= len(text):
+            return None, pos
+        char = text[pos]
+        if char == "\\":
+            escaped = text[pos + 1:pos + 2]
+            if not escaped:
+                return None, pos
+            if escaped in '"\\/bfnrt' or (escaped == "u" and _JSON_UNICODE_ESCAPE_RE.match(text, pos + 2)):
+                pieces.append(text[pos:pos + 2])
+                pos += 2
+            else: # e.g. a regex "\d" copied verbatim into the code
+                pieces.append("\\\\")
+                pos += 1
+                fired.add("invalid_escape")
+        elif char == '"':
+            pos += 1
+            if end_re.match(text, pos):
+                pieces.append('"')
+                repairs.update(fired)
+                return "".join(pieces), pos
+            pieces.append('\\"')
+            fired.add("unescaped_quote")
+        else: # Raw newline/tab inside the string
+            pieces.append(_JSON_CONTROL_ESCAPES[char])
+            pos += 1
+            fired.add("control_character")
+
+def _scan_command_array(text, pos, repairs):
+    """Splits the array opening at text[pos] into repaired top-level object texts.
+
+    Returns (objects, closed, end), where objects are (text, names of the repairs made in
+    it). Scanning stops at the first structural damage it cannot repair; `closed` is False
+    if the array never ended (truncated or damaged response).
+    """
+    object_texts = []
+    repairs_before = None # Counts when the current top-level object began
+    parts = None # Pieces of the top-level object being scanned
+    stack = []   # Containers open inside the current top-level object
+    expect_key = False
+    pos += 1
+    while pos < len(text):
+        char = text[pos]
+        if not stack:
+            if char == "{":
+                stack.append("{")
+                parts = ["{"]
+                expect_key = True
+                repairs_before = repairs.copy()
+            elif char == "]":
+                return object_texts, True, pos + 1
+            pos += 1 # Commas, whitespace and stray text between commands
+            continue
+        if char == '"':
+            if expect_key:
+                end_re = _JSON_KEY_END_RE
+            else:
+                end_re = _JSON_OBJECT_VALUE_END_RE if stack[-1] == "{" else _JSON_ARRAY_VALUE_END_RE
+            literal, pos = _scan_json_string(text, pos, end_re, repairs)
+            if literal is None:
+                return object_texts, False, pos
+            parts.append(literal)
+            continue
+        if char in "{[":
+            stack.append(char)
+            expect_key = char == "{"
+        elif char in "}]":
+            if stack.pop() != ("{" if char == "}" else "["):
+                return object_texts, False, pos # Mismatched brackets: nothing after this is trustworthy
+            if parts[-1] == ",":
+                parts.pop()
+                repairs["trailing_comma"] += 1
+            if not stack:
+                object_texts.append(("".join(parts + [char]), set(repairs - repairs_before)))
+                parts = None
+                pos += 1
+                continue
+        elif char == ",":
+            expect_key = stack[-1] == "{"
+        elif char == ":":
+            expect_key = False
+        if not char.isspace():
+            parts.append(char)
+        pos += 1
+    return object_texts, False, pos
+
+def _unbalanced_brackets(text):
+    """True if `text` closes a bracket it did not open, or ends with one still open."""
+    stack = []
+    for char in text:
+        if char in "([{":
+            stack.append(char)
+        elif char in _BRACKET_PAIRS and (not stack or stack.pop() != _BRACKET_PAIRS[char]):
+            return True
+    return bool(stack)
+
+def _repaired_command_problem(command, repairs_made):
+    """Why a command rebuilt by the repairs in `repairs_made` cannot be trusted; None if it can.
+
+    Telling an unescaped quote inside code from the end of a string is a guess. When the
+    guess is wrong, the string is cut short and the rest is read as keys. Such a command
+    either carries keys its action does not have, or has a string that stops inside an
+    open bracket.
+    """
+    if not repairs_made or not isinstance(command, dict):
+        return None
+    allowed_keys = COMMAND_KEYS.get(command.get("action"))
+    if allowed_keys and not set(command) <= allowed_keys:
+        return f"unexpected key(s) {', '.join(sorted(map(str, set(command) - allowed_keys)))} after repairing it"
+    if "unescaped_quote" in repairs_made:
+        strings = [command.get("content")]
+        if isinstance(command.get("hunks"), list):
+            strings += [hunk.get(key) for hunk in command["hunks"] if isinstance(hunk, dict) for key in ("search", "replace")]
+        if any(isinstance(value, str) and _unbalanced_brackets(value) for value in strings):
+            return "a repaired string ends inside an unbalanced bracket"
+    return None
+
+def recover_ai_commands(ai_response_text):
+    """Extracts the command list from a model response, tolerating common JSON mistakes.
+
+    Returns (commands, repairs, error). `repairs` counts the fixes that were needed:
+    surrounding prose, unescaped quotes, invalid escapes and raw control characters in
+    strings, trailing commas, a bare object instead of a list. When part of the response is
+    beyond repair, the well-formed commands before the damage are returned together with
+    an error message. So are commands whose repair looks wrong (see
+    `_repaired_command_problem`): applying half a file is worse than not applying it.
+    """
+    repairs = collections.Counter()
+    text = clean_response_text(ai_response_text)
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    else:
+        if isinstance(parsed, list):
+            return parsed, repairs, None
+        if isinstance(parsed, dict) and "action" in parsed:
+            repairs["single_object"] += 1
+            return [parsed], repairs, None
+        return [], repairs, "response was valid JSON, but not a list of commands"
+
+    start = _JSON_ARRAY_START_RE.search(text)
+    if not start:
+        return [], repairs, "no JSON command array found in the response"
+    object_texts, closed, end = _scan_command_array(text, start.start(), repairs)
+    if text[:start.start()].strip() or (closed and text[end:].strip()):
+        repairs["surrounding_text"] += 1
+
+    commands = []
+    for object_text, repairs_made in object_texts:
+        try:
+            command = json.loads(object_text)
+        except json.JSONDecodeError as e:
+            return commands, repairs, f"command {len(commands) + 1} could not be repaired ({e.msg})"
+        problem = _repaired_command_problem(command, repairs_made)
+        if problem:
+            repairs["rejected_repair"] += 1
+            return commands, repairs, f"command {len(commands) + 1} could not be repaired safely ({problem})"
+        commands.append(command)
+    if not closed:
+        return commands, repairs, "the response ended or broke off before the command array was closed"
+    return commands, repairs, None
+
+# --- Streaming Response Parsing ---
+_STREAM_STRUCTURE_RE = re.compile(r'["{}\[\]]') # Characters that change nesting outside strings
+_STREAM_STRING_BODY_RE = re.compile(r'(?:[^"\\]+|\\.)*', re.DOTALL) # Rest of a string up to its closing quote
+
+class StreamingCommandParser:
+    """Incrementally extracts command objects from a streamed JSON array.
+
+    Text chunks are fed as they arrive; `feed` returns every top-level object whose
+    closing brace has been seen. Anything before the opening of the array (e.g. a ```json
+    fence, or prose with a "[" of its own) is skipped; the opening is found with the same
+    pattern as `recover_ai_commands`, even when it is split across chunks. Each chunk is
+    scanned once, jumping between structural characters with a regex, so parsing stays
+    linear even for multi-megabyte `content` strings.
+
+    The first object that is not valid JSON marks the stream as `damaged` and nothing after
+    it is emitted; the caller re-reads `raw_text` with `recover_ai_commands` once the
+    response is complete, skipping the `emitted_count` commands already returned.
+    """
+
+    def __init__(self):
+        self._object_parts = []  # Pieces of the object currently being received
+        self._depth = 0          # Nesting depth inside the top-level array
+        self._in_string = False
+        self._escape_pending = False # Chunk ended right after a backslash inside a string
+        self._array_started = False
+        self._array_closed = False
+        self._prefix = ""        # Text before the array that may still be the start of its opening
+        self._chunks = []        # Full raw response, kept for fallbacks and error messages
+        self.invalid_objects = []
+        self.damaged = False
+        self.emitted_count = 0
+
+    @property
+    def raw_text(self):
+        return "".join(self._chunks)
+
+    @property
+    def array_closed(self):
+        return self._array_closed
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        if self._array_closed or self.damaged:
+            return []
+        pos = 0
+        if not self._array_started:
+            self._prefix += chunk
+            start = _JSON_ARRAY_START_RE.search(self._prefix)
+            if not start:
+                bracket = self._prefix.rfind("[")
+                # Only a "[" followed by nothing but whitespace can still become the opening
+                self._prefix = self._prefix[bracket:] if bracket != -1 and not self._prefix[bracket + 1:].strip() else ""
+                return []
+            self._array_started = True
+            chunk, self._prefix = self._prefix, ""
+            pos = start.start() + 1
+
+        completed = []
+        object_start = 0 if self._depth > 0 else None
+        if self._escape_pending:
+            self._escape_pending = False
+            pos += 1
+        while pos < len(chunk):
+            if self._in_string:
+                pos = _STREAM_STRING_BODY_RE.match(chunk, pos).end()
+                if pos >= len(chunk):
+                    break
+                if chunk[pos] == "\\": # Lone backslash at the end of the chunk
+                    self._escape_pending = True # Escaped character arrives with the next chunk
+                    break
+                self._in_string = False # Closing quote
+                pos += 1
+                continue
+
+            match = _STREAM_STRUCTURE_RE.search(chunk, pos)
+            if not match:
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 0:
+                    object_start = match.start()
+                self._depth += 1
+            elif self._depth == 0:
+                if char == "]":
+                    self._array_closed = True
+                    break
+            else:
+                self._depth -= 1
+                if self._depth == 0 and object_start is not None:
+                    self._object_parts.append(chunk[object_start:pos])
+                    command = self._decode_object("".join(self._object_parts))
+                    self._object_parts = []
+                    object_start = None
+                    if self.damaged:
+                        return completed
+                    completed.append(command)
+                    self.emitted_count += 1
+
+        if self._depth > 0 and object_start is not None:
+            self._object_parts.append(chunk[object_start:])
+        return completed
+
+    def _decode_object(self, object_text):
+        try:
+            return json.loads(object_text)
+        except json.JSONDecodeError:
+            self.invalid_objects.append(object_text)
+            self.damaged = True
+            return None
+
+# --- Command Execution ---
+def atomic_write_bytes(path, data):
+    """Writes via a temp file in the same directory and os.replace, so readers never see a partial file."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def apply_patch_hunks(original, hunks):
+    """Applies search/replace hunks in order. Returns (patched_text, conflicts).
+
+    A hunk conflicts when its search text is missing or ambiguous in the file as patched so
+    far; callers must not save a result that has conflicts.
+    """
+    patched = original
+    conflicts = []
+    for number, hunk in enumerate(hunks, start=1):
+        if not isinstance(hunk, dict) or not isinstance(hunk.get("search"), str) or not isinstance(hunk.get("replace"), str):
+            conflicts.append(f"hunk {number} is malformed")
+            continue
+        occurrences = patched.count(hunk["search"]) if hunk["search"] else 0
+        if occurrences != 1:
+            conflicts.append(f"hunk {number} search text {'not found' if occurrences == 0 else f'matches {occurrences} places'}")
+            continue
+        patched = patched.replace(hunk["search"], hunk["replace"], 1)
+    return patched, conflicts
+
+def effective_problems(result, filenames):
+    """Drops import problems satisfied by a sibling module in the workspace."""
+    local_modules = {name[:-3] for name in filenames}
+    return [p for p in result["problems"] if not (p["kind"] == "import" and p.get("module") in local_modules)]
+
+def format_validation_problems(problems):
+    return "\n".join(f"- line {p['line']}: {p['message']}" for p in problems)
+
+def full_rewrite_request(system_prompt_text, filename, current_content, hunks, conflicts):
+    """Request asking the model for the complete file after its patch did not apply."""
+    request_text = (
+        f"Your patch for `{filename}` could not be applied: {'; '.join(conflicts)}.\n\n"
+        f"Current content of `{filename}`:\n{current_content}\n\n"
+        f"Intended patch hunks:\n{json.dumps(hunks)}\n\n"
+        f"Respond with a single create_update command containing the complete updated `{filename}`."
+    )
+    return [{"role": "user", "parts": [{"text": system_prompt_text + "\n\n" + request_text}]}]
+
+def rewritten_content(response_text, filename):
+    """Content of the create_update for `filename` in a full-rewrite response, or None.
+
+    The response is read with recover_ai_commands, so a bare object or a slightly
+    malformed reply still counts.
+    """
+    commands, _, _ = recover_ai_commands(response_text)
+    for command in commands:
+        if isinstance(command, dict) and command.get("action") == "create_update" and command.get("filename") == filename:
+            content = command.get("content")
+            return content if isinstance(content, str) else None
+    return None
+
+def validation_entries(workspace, filename):
+    """Chat entry listing static problems in a file just written, so the model sees them next turn."""
+    problems = workspace.validation_problems(filename)
+    if not problems:
+        return []
+    return [{"action": "chat", "content": f"Validation: `{filename}` has problems:\n{format_validation_problems(problems)}"}]
+
+def execute_command(command_data, workspace):
+    """Applies a single AI command to `workspace` and returns the entries to record in the chat history."""
+    if not isinstance(command_data, dict):
+        workspace.notify("warning", f"AI sent an invalid command format (not a dict): {command_data}")
+        return [{"action": "chat", "content": f"AI Error: Invalid command format: {command_data}"}]
+    executed_entries = [command_data]
+    action = command_data.get("action")
+    filename = command_data.get("filename")
+    content = command_data.get("content")
+
+    if action == "create_update":
+        if filename and content is not None:
+            if workspace.write(filename, content):
+                executed_entries.extend(validation_entries(workspace, filename))
+            else:
+                # Error already reported by the workspace
+                executed_entries.append({"action": "chat", "content": f"Error: Failed saving {filename}"})
+        else:
+            workspace.notify("warning", "AI 'create_update' command missing filename or content.")
+            executed_entries.append({"action": "chat", "content": "AI Warning: Invalid create_update"})
+    elif action == "patch":
+        hunks = command_data.get("hunks")
+        original = workspace.read(filename) if filename else None
+        if not filename or not isinstance(hunks, list) or not hunks:
+            workspace.notify("warning", "AI 'patch' command missing filename or hunks.")
+            executed_entries.append({"action": "chat", "content": "AI Warning: Invalid patch"})
+        elif original is None:
+            # Error already reported by the workspace
+            executed_entries.append({"action": "chat", "content": f"Error: Cannot patch missing file {filename}"})
+        else:
+            patched, conflicts = apply_patch_hunks(original, hunks)
+            if conflicts:
+                workspace.notify("warning", f"Patch for '{filename}' did not apply cleanly ({'; '.join(conflicts)}). Requesting the full file instead...")
+                patched = workspace.request_rewrite(filename, original, hunks, conflicts)
+            if patched is not None and workspace.write(filename, patched):
+                if conflicts:
+                    command_data["fallback"] = "full_rewrite" # Only once the rewritten file is saved
+                command_data["diff"] = "".join(difflib.unified_diff(
+                    original.splitlines(keepends=True), patched.splitlines(keepends=True),
+                    fromfile=f"a/{filename}", tofile=f"b/{filename}"
+                ))
+                executed_entries.extend(validation_entries(workspace, filename))
+            else:
+                executed_entries.append({"action": "chat", "content": f"Error: Failed patching {filename}"})
+    elif action == "delete":
+        if filename:
+            if not workspace.delete(filename):
+                executed_entries.append({"action": "chat", "content": f"Error: Failed deleting {filename}"})
+        else:
+            workspace.notify("warning", "AI 'delete' command missing filename.")
+            executed_entries.append({"action": "chat", "content": "AI Warning: Invalid delete"})
+    elif action == "chat":
+        pass # Chat message already in list
+    else:
+        workspace.notify("warning", f"AI sent unknown action: '{action}'.")
+        executed_entries.append({"action": "chat", "content": f"AI Warning: Unknown action '{action}'"})
+    return executed_entries
+
+def execute_response(response_text, workspace, skip_commands=0, run_command=execute_command):
+    """Parses a complete response (repairing it if needed) and executes its commands.
+
+    The first `skip_commands` commands are not executed again (a streamed response whose
+    leading commands were already applied). Each command goes through
+    `run_command(command_data, workspace)`, which returns its chat entries; callers wrap
+    it to time or defer commands. Returns (executed entries, repairs, error); see
+    recover_ai_commands for the last two.
+    """
+    commands, repairs, error = recover_ai_commands(response_text)
+    if error and not commands and not skip_commands:
+        workspace.notify("error", f"AI response was not valid JSON ({error}).")
+        return [{"action": "chat", "content": f"AI Error: Invalid JSON received. Response: {response_text}"}], repairs, error
+    executed_entries = []
+    try:
+        for command_data in commands[skip_commands:]:
+            executed_entries.extend(run_command(command_data, workspace))
+    except Exception as e:
+        workspace.notify("error", f"Error processing AI commands: {e}")
+        executed_entries.append({"action": "chat", "content": f"Error processing commands: {e}"})
+        return executed_entries, repairs, f"error processing commands: {e}"
+    if error:
+        workspace.notify("warning", f"Part of the AI response could not be parsed ({error}); the {len(commands)} command(s) before it were applied.")
+        executed_entries.append({"action": "chat", "content": f"AI Warning: {error}. Commands before that point were applied."})
+    return executed_entries, repairs, error
+
+# --- Headless Workspace ---
+class DirectoryWorkspace:
+    """A workspace directory without a UI: notices are collected in `messages` instead of shown.
+
+    Every written file is validated with code_validation. `request_rewrite` asks
+    `generative_model` for the full file when a patch does not apply (None disables it).
+    """
+
+    def __init__(self, root, generative_model=None, rate_limiter=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.generative_model = generative_model
+        self.rate_limiter = rate_limiter
+        self.messages = []  # (level, text)
+        self.written = []   # Filenames in the order they were last written
+        self.deleted = []
+        self.model_seconds = 0.0 # Spent on full-file fallbacks
+        self._results = {}  # filename -> code_validation result of its last write
+
+    def notify(self, level, message):
+        self.messages.append((level, message))
+
+    def file_names(self):
+        return sorted(entry.name for entry in os.scandir(self.root) if entry.name.endswith(".py") and entry.is_file())
+
+    def _path(self, filename):
+        if ".." in filename or filename.startswith(("/", "\\")):
+            self.notify("error", f"Invalid file path: {filename}")
+            return None
+        return self.root / filename
+
+    def read(self, filename):
+        path = self._path(filename)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            self.notify("warning", f"File not found during read: {filename}")
+        except Exception as e:
+            self.notify("error", f"Error reading file '{filename}': {e}")
+        return None
+
+    def write(self, filename, content):
+        path = self._path(filename)
+        if path is None:
+            return False
+        try:
+            atomic_write_bytes(path, content.encode("utf-8"))
+        except Exception as e:
+            self.notify("error", f"Error saving file '{filename}': {e}")
+            return False
+        self._results[filename] = code_validation.validate_source(content, filename)
+        if filename in self.written:
+            self.written.remove(filename)
+        self.written.append(filename)
+        return True
+
+    def delete(self, filename):
+        path = self._path(filename)
+        if path is None:
+            return False
+        if not path.is_file():
+            self.notify("warning", f"Could not delete: File '{filename}' not found.")
+            return False
+        try:
+            os.remove(path)
+        except Exception as e:
+            self.notify("error", f"Error deleting file '{filename}': {e}")
+            return False
+        self._results.pop(filename, None)
+        if filename in self.written:
+            self.written.remove(filename)
+        self.deleted.append(filename)
+        return True
+
+    def validation_problems(self, filename):
+        result = self._results.get(filename)
+        return None if result is None else effective_problems(result, self.file_names())
+
+    def request_rewrite(self, filename, current_content, hunks, conflicts):
+        if self.generative_model is None:
+            return None
+        request = full_rewrite_request(system_prompt(self.file_names()), filename, current_content, hunks, conflicts)
+        try:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            waited_from = time.perf_counter()
+            response_text = self.generative_model.generate_content(request).text
+            self.model_seconds += time.perf_counter() - waited_from
+            content = rewritten_content(response_text, filename)
+            if content is None:
+                self.notify("error", f"Full-file fallback for '{filename}' did not return the file.")
+            return content
+        except Exception as e:
+            self.notify("error", f"Full-file fallback for '{filename}' failed: {e}")
+            return None
@@ -0,0 +1,35 @@
+# preview_worker.py - Pre-warmed interpreter for GenieCraft live previews
+#
+# app.py keeps a few of these running ahead of time. Each worker imports Streamlit and the
+# configured data libraries up front, then waits for a single launch request on stdin:
+#     {"script": "/abs/path/app.py", "args": ["--server.port", "8502", ...]}
+# and runs that script through Streamlit's CLI inside the already-warm process.
+# Closing stdin without sending a request makes the worker exit quietly.
+
+import importlib
+import json
+import sys
+
+
+def preload(module_names):
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e: # A missing optional library must not kill the worker
+            print(f"preview_worker: could not preload '{module_name}': {e}", file=sys.stderr, flush=True)
+
+
+def main():
+    preload(["streamlit.web.cli", *sys.argv[1:]])
+    from streamlit.web import cli as streamlit_cli
+
+    request_line = sys.stdin.readline()
+    if not request_line.strip():
+        return 0 # Pool shut down before this worker was used
+    request = json.loads(request_line)
+    sys.argv = ["streamlit", "run", request["script"], *request.get("args", [])]
+    return streamlit_cli.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# symbol_index.py - Outline of a workspace file for relevant-context prompting
+#
+# Parses a file once and records what a prompt is likely to refer to, with line spans:
+#   - functions and classes (methods as "Class.method"),
+#   - imported modules,
+#   - Streamlit input widgets (st.button, st.sidebar.slider, ...) with their label.
+# app.py caches the result per content hash and ranks files and symbols against the
+# user's prompt (rank_files), so only relevant snippets are sent to the model.
+#
+# Results are plain dicts: {"symbols": [{"kind", "name", "line", "end_line", "label"?}, ...],
+# "lines": int, "error": str | None}.
+
+import ast
+import re
+
+WIDGET_NAMES = frozenset({
+    "button", "checkbox", "toggle", "radio", "selectbox", "multiselect", "slider", "select_slider",
+    "text_input", "number_input", "text_area", "date_input", "time_input", "file_uploader",
+    "camera_input", "color_picker", "download_button", "form_submit_button", "chat_input", "data_editor",
+})
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z0-9]*")
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_.]*[A-Za-z0-9_]")
+EXACT_MATCH_SCORE = 5.0 # A symbol named (or widget labelled) exactly as in the prompt
+_STOP_WORDS = frozenset({
+    "the", "and", "for", "with", "that", "this", "from", "into", "add", "make", "use", "app", "file",
+    "please", "can", "you", "should", "when", "all", "new", "but", "not", "are", "its", "then", "also",
+})
+
+
+def _widget_call(node):
+    """('st.sidebar.slider', label) for a Streamlit widget call, else None."""
+    parts = []
+    target = node.func
+    while isinstance(target, ast.Attribute):
+        parts.append(target.attr)
+        target = target.value
+    if not isinstance(target, ast.Name) or target.id != "st" or not parts or parts[0] not in WIDGET_NAMES:
+        return None
+    label = None
+    if node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+        label = node.args[0].value[:80]
+    return ".".join(["st", *reversed(parts)]), label
+
+
+def extract_symbols(source, filename="<workspace>"):
+    try:
+        tree = ast.parse(source, filename=filename)
+    except (SyntaxError, ValueError) as e:
+        return {"symbols": [], "lines": source.count("\n") + 1, "error": str(e)}
+
+    symbols = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.append({"kind": "function", "name": node.name, "line": node.lineno, "end_line": node.end_lineno})
+        elif isinstance(node, ast.ClassDef):
+            symbols.append({"kind": "class", "name": node.name, "line": node.lineno, "end_line": node.end_lineno})
+            for member in node.body:
+                if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    symbols.append({
+                        "kind": "function", "name": f"{node.name}.{member.name}",
+                        "line": member.lineno, "end_line": member.end_lineno,
+                    })
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                symbols.append({"kind": "import", "name": alias.name, "line": node.lineno, "end_line": node.lineno})
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            symbols.append({"kind": "import", "name": node.module, "line": node.lineno, "end_line": node.lineno})
+        elif isinstance(node, ast.Call):
+            widget = _widget_call(node)
+            if widget:
+                symbol = {"kind": "widget", "name": widget[0], "line": node.lineno, "end_line": node.end_lineno}
+                if widget[1]:
+                    symbol["label"] = widget[1]
+                symbols.append(symbol)
+    symbols.sort(key=lambda symbol: symbol["line"])
+    return {"symbols": symbols, "lines": source.count("\n") + 1, "error": None}
+
+
+def words(text):
+    """Lower-case words of `text`, splitting snake_case and camelCase; stop words are dropped."""
+    found = set()
+    for word in _WORD_RE.findall(re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "")):
+        word = word.lower()
+        if len(word) >= 3 and word not in _STOP_WORDS:
+            found.add(word)
+    return found
+
+
+def prompt_terms(prompt):
+    """What symbols are matched against: the prompt's words, its identifiers and its lower-cased text."""
+    return {
+        "text": prompt.lower(),
+        "words": words(prompt),
+        "identifiers": {name.lower() for name in _IDENTIFIER_RE.findall(prompt)},
+    }
+
+
+def word_weights(outlines, prompt_words):
+    """1 / (number of symbols containing the word), so "data" in every function counts for little."""
+    counts = dict.fromkeys(prompt_words, 0)
+    for outline in outlines:
+        for symbol in outline["symbols"]:
+            for word in prompt_words & (words(symbol["name"]) | words(symbol.get("label", ""))):
+                counts[word] += 1
+    return {word: 1.0 / max(count, 1) for word, count in counts.items()}
+
+
+def symbol_score(symbol, terms, weights):
+    """How strongly the prompt refers to a symbol: an exact name or label, plus weighted shared words.
+
+    A widget's type ("button", "slider") only counts along with its label; on its own it
+    would match every widget of that type in the workspace.
+    """
+    if symbol["kind"] == "widget":
+        label = symbol.get("label", "")
+        exact = len(label) >= 3 and label.lower() in terms["text"]
+        matched = terms["words"] & words(label)
+        if matched:
+            matched |= terms["words"] & words(symbol["name"][3:])
+    else:
+        name = symbol["name"].lower()
+        exact = name in terms["identifiers"] or name.rsplit(".", 1)[-1] in terms["identifiers"]
+        matched = terms["words"] & words(symbol["name"])
+    return (EXACT_MATCH_SCORE if exact else 0.0) + sum(weights.get(word, 1.0) for word in matched)
+
+
+def rank_files(outlines, prompt, selected_file=None):
+    """Files the prompt seems to refer to, best first: [(score, filename, outline, matched symbols)].
+
+    `outlines` maps filenames to extract_symbols results. A file scores for being named in
+    the prompt, for words shared with its name and for its matching symbols; the file the
+    user has open (`selected_file`) gets a small bonus.
+    """
+    terms = prompt_terms(prompt)
+    weights = word_weights(outlines.values(), terms["words"])
+
+    ranked = []
+    for filename, outline in outlines.items():
+        if filename.lower() in terms["text"]:
+            score = 2 * EXACT_MATCH_SCORE
+        else:
+            score = len(terms["words"] & words(filename[:-3]))
+        if filename == selected_file:
+            score += 1 # What the user has open is the likeliest target of "this" or "it"
+        matched = [(symbol_score(symbol, terms, weights), symbol) for symbol in outline["symbols"]]
+        matched = [(points, symbol) for points, symbol in matched if points]
+        if matched:
+            best = max(points for points, _ in matched)
+            matched = [(points, symbol) for points, symbol in matched if points >= best / 2]
+            score += sum(points for points, _ in matched)
+        if score:
+            matched.sort(key=lambda item: -item[0])
+            ranked.append((score, filename, outline, [symbol for _, symbol in matched]))
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    # Files scoring far below the best one only matched incidental words
+    return [entry for entry in ranked if entry[0] >= ranked[0][0] / 5]
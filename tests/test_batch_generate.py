@@ -0,0 +1,109 @@
+# Tests for the headless batch CLI (batch_generate.py) on the offline model. Run with: python -m pytest tests
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import batch_generate
+import generation
+
+BATCH_SCRIPT = Path(__file__).resolve().parent.parent / "batch_generate.py"
+
+
+def write_prompts(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return path
+
+
+def fake_model():
+    return generation.FakeGenerativeModel(generation.GEMINI_MODEL_NAME, response_kb=1, seconds_per_kb=0)
+
+
+def test_load_prompts_accepts_strings_and_makes_ids_unique(tmp_path):
+    prompts = write_prompts(tmp_path / "prompts.jsonl", [
+        '{"prompt": "A todo list", "id": "todo app"}',
+        "",
+        '"A unit converter"',
+        '{"prompt": "Another todo list", "id": "todo app"}',
+    ])
+    assert batch_generate.load_prompts(prompts) == [
+        {"id": "todo_app", "prompt": "A todo list", "line": 1},
+        {"id": "prompt_0003", "prompt": "A unit converter", "line": 3},
+        {"id": "todo_app_2", "prompt": "Another todo list", "line": 4},
+    ]
+
+
+@pytest.mark.parametrize("line, message", [
+    ('{"prompt": "unterminated', "not valid JSON"),
+    ('{"id": "no-prompt"}', 'expected a string or an object with a "prompt"'),
+    ('{"prompt": "   "}', 'expected a string or an object with a "prompt"'),
+])
+def test_load_prompts_reports_malformed_line(tmp_path, line, message):
+    prompts = write_prompts(tmp_path / "prompts.jsonl", ['"A timer"', line])
+    with pytest.raises(ValueError, match=f"prompts.jsonl:2: {message}"):
+        batch_generate.load_prompts(prompts)
+
+
+def test_run_batch_writes_each_prompt_into_its_own_workspace(tmp_path):
+    entries = batch_generate.load_prompts(write_prompts(tmp_path / "prompts.jsonl", [
+        '{"prompt": "A todo list", "id": "todo"}',
+        '{"prompt": "A unit converter", "id": "units"}',
+    ]))
+    output = tmp_path / "out"
+    records = batch_generate.run_batch(entries, output, fake_model(), workers=2, requests_per_minute=0)
+
+    assert sorted(record["id"] for record in records) == ["todo", "units"]
+    for record in records:
+        workspace = output / record["id"]
+        assert record["status"] == "ok" and record["error"] is None and record["attempts"] == 1
+        assert record["workspace"] == str(workspace)
+        assert sorted(path.name for path in workspace.iterdir()) == [f["filename"] for f in record["files"]]
+        assert len(record["files"]) == 1 and record["files"][0]["bytes"] >= 1024
+        assert any("with the offline model" in message for message in record["chat"]) # After any validation notes
+        assert set(record["timing"]) == {"model_seconds", "apply_seconds", "total_seconds"}
+    report = [json.loads(line) for line in (output / "report.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert sorted(record["id"] for record in report) == ["todo", "units"]
+
+    summary = batch_generate.summarize(records, 1.0)
+    assert summary["prompts"] == 2 and summary["statuses"] == {"ok": 2} and summary["files_written"] == 2
+
+
+def test_run_batch_skips_existing_workspace_unless_overwriting(tmp_path):
+    entries = [{"id": "todo", "prompt": "A todo list", "line": 1}]
+    output = tmp_path / "out"
+    (output / "todo").mkdir(parents=True)
+    (output / "todo" / "keep.py").write_text("x = 1\n", encoding="utf-8")
+
+    skipped = batch_generate.run_batch(entries, output, fake_model(), workers=1, requests_per_minute=0)
+    assert [record["status"] for record in skipped] == ["skipped"]
+    assert [path.name for path in (output / "todo").iterdir()] == ["keep.py"]
+
+    rerun = batch_generate.run_batch(entries, output, fake_model(), workers=1, requests_per_minute=0, overwrite=True)
+    assert [record["status"] for record in rerun] == ["ok"]
+    assert [path.name for path in (output / "todo").iterdir()] == [rerun[0]["files"][0]["filename"]]
+
+
+def test_run_prompt_reports_a_failed_model_call(tmp_path):
+    class FailingModel:
+        def generate_content(self, request):
+            raise RuntimeError("quota exceeded")
+
+    record = batch_generate.run_prompt({"id": "x", "prompt": "A timer", "line": 1}, tmp_path / "x", FailingModel(),
+                                       generation.RequestRateLimiter(0), retries=0)
+    assert record["status"] == "error" and record["error"] == "RuntimeError: quota exceeded" and record["attempts"] == 1
+
+
+def test_cli_rejects_malformed_prompts_file(tmp_path):
+    prompts = write_prompts(tmp_path / "prompts.jsonl", ['"A timer"', "{not json"])
+    completed = subprocess.run(
+        [sys.executable, str(BATCH_SCRIPT), str(prompts), "--output", str(tmp_path / "out"), "--fake"],
+        capture_output=True, text=True, timeout=60, cwd=tmp_path,
+    )
+    assert completed.returncode == 2
+    assert "prompts.jsonl:2: not valid JSON" in completed.stderr
+    assert not (tmp_path / "out").exists()
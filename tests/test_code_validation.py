@@ -0,0 +1,89 @@
+# Tests for the static checks (code_validation.py) and the validation worker's protocol. Run with: python -m pytest tests
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import code_validation
+import generation
+
+WORKER_SCRIPT = Path(__file__).resolve().parent.parent / "validation_worker.py"
+
+
+def problems(source):
+    return [(p["kind"], p["line"]) for p in code_validation.validate_source(source)["problems"]]
+
+
+def test_clean_module():
+    assert problems("import json\nfrom os import path as p\n\nprint(json.dumps(p.sep))\n") == []
+
+
+def test_names_bound_in_class_and_function_scopes():
+    source = (
+        "class Config:\n"
+        "    limit = 10\n"
+        "    doubled = limit * 2\n"
+        "\n"
+        "def total(values, start=0):\n"
+        "    result = start\n"
+        "    for value in values:\n"
+        "        result += value\n"
+        "    return result\n"
+        "\n"
+        "print(total([Config.doubled]), missing)\n"
+    )
+    assert problems(source) == [("undefined_name", 11)]
+
+
+def test_comprehension_variable():
+    assert problems("squares = [n * n for n in range(3)]\npairs = {k: v for k, v in zip('ab', squares)}\n") == []
+    assert problems("squares = [n * n for n in range(3)]\nprint(m)\n") == [("undefined_name", 2)]
+
+
+def test_guarded_import_is_optional():
+    source = (
+        "try:\n"
+        "    import surely_not_installed_module\n"
+        "except ImportError:\n"
+        "    surely_not_installed_module = None\n"
+        "import another_missing_module\n"
+    )
+    result = code_validation.validate_source(source)
+    assert [(p["kind"], p["line"], p.get("module")) for p in result["problems"]] == [("import", 5, "another_missing_module")]
+
+
+def test_sibling_workspace_module_satisfies_import():
+    result = code_validation.validate_source("import helpers\nimport not_a_real_dependency\n\nhelpers.run()\n", "app.py")
+    assert [p["module"] for p in result["problems"]] == ["helpers", "not_a_real_dependency"]
+    remaining = generation.effective_problems(result, ["app.py", "helpers.py"])
+    assert [p["module"] for p in remaining] == ["not_a_real_dependency"]
+
+
+def test_syntax_error_stops_other_checks():
+    assert problems("import not_installed_either\nif True\n    print(undefined)\n") == [("syntax", 2)]
+    assert problems("def f():\n    pass\nreturn 1\n") == [("syntax", 3)]
+
+
+def test_star_import_disables_undefined_names():
+    assert problems("from os.path import *\nprint(join('a', 'b'))\n") == []
+
+
+def test_validate_job_keeps_key():
+    key, result = code_validation.validate_job(["k1", "a.py", "print(x)\n"])
+    assert key == "k1" and [p["kind"] for p in result["problems"]] == ["undefined_name"]
+
+
+def test_worker_answers_one_line_per_request_and_exits_on_eof():
+    requests = [["a", "a.py", "import json\n"], ["b", "b.py", "if True\n"]]
+    completed = subprocess.run(
+        [sys.executable, str(WORKER_SCRIPT)], input="".join(json.dumps(r) + "\n" for r in requests) + "\n",
+        capture_output=True, text=True, timeout=60, cwd=WORKER_SCRIPT.parent,
+    )
+    assert completed.returncode == 0, completed.stderr
+    answers = [json.loads(line) for line in completed.stdout.splitlines()]
+    assert [key for key, _ in answers] == ["a", "b"]
+    assert answers[0][1] == {"problems": []}
+    assert [p["kind"] for p in answers[1][1]["problems"]] == ["syntax"]
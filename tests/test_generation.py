@@ -0,0 +1,167 @@
+# Tests for the UI-independent core (generation.py). Run with: python -m pytest tests
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import generation
+
+
+def feed_all(chunks):
+    parser = generation.StreamingCommandParser()
+    commands = []
+    for chunk in chunks:
+        commands.extend(parser.feed(chunk))
+    return commands, parser
+
+
+STREAMED_RESPONSE = (
+    'Sure, see [the docs] for details:\n```json\n[ \n'
+    ' {"action": "chat", "content": "a ] and a { in a string"},\n'
+    ' {"action": "delete", "filename": "old.py"}]\n```'
+)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(STREAMED_RESPONSE)])
+def test_stream_skips_prose_brackets_in_any_chunking(size):
+    chunks = [STREAMED_RESPONSE[i:i + size] for i in range(0, len(STREAMED_RESPONSE), size)]
+    commands, parser = feed_all(chunks)
+    assert commands == [
+        {"action": "chat", "content": "a ] and a { in a string"},
+        {"action": "delete", "filename": "old.py"},
+    ]
+    assert parser.array_closed and not parser.damaged
+    assert parser.raw_text == STREAMED_RESPONSE
+
+
+def test_stream_finds_opening_split_across_chunks():
+    commands, parser = feed_all(['Notes [1] and [', '  ', '\n{"action": "chat", "content": "hi"}]'])
+    assert commands == [{"action": "chat", "content": "hi"}]
+    assert parser.array_closed
+
+
+def test_stream_stops_at_first_invalid_object():
+    commands, parser = feed_all(['[{"action": "chat", "content": "ok"}, {"action": chat}, {"action": "chat", "content": "late"}]'])
+    assert commands == [{"action": "chat", "content": "ok"}]
+    assert parser.damaged and parser.emitted_count == 1
+
+
+def test_stream_without_array_emits_nothing():
+    commands, parser = feed_all(["I could not generate code [sorry]."])
+    assert commands == [] and not parser.array_closed and parser.emitted_count == 0
+
+
+def test_recover_accepts_valid_json_unchanged():
+    commands, repairs, error = generation.recover_ai_commands('```json\n[{"action": "delete", "filename": "a.py"}]\n```')
+    assert commands == [{"action": "delete", "filename": "a.py"}]
+    assert not repairs and error is None
+
+
+def test_recover_repairs_quotes_and_newlines_in_code():
+    text = '[{"action": "create_update", "filename": "a.py", "content": "x = "hi"\nprint(x, "\\d")"},]'
+    commands, repairs, error = generation.recover_ai_commands(text)
+    assert commands == [{"action": "create_update", "filename": "a.py", "content": 'x = "hi"\nprint(x, "\\d")'}]
+    assert {"unescaped_quote", "control_character", "invalid_escape"} <= set(repairs)
+    assert error is None
+
+
+def test_recover_rejects_repair_that_invents_keys():
+    text = '[{"action": "chat", "content": "ok"}, {"action": "create_update", "filename": "a.py", "content": "d = {"k": "v", "z": 2}\nprint(d)"}]'
+    commands, repairs, error = generation.recover_ai_commands(text)
+    assert commands == [{"action": "chat", "content": "ok"}]
+    assert repairs["rejected_repair"] == 1
+    assert "command 2" in error and "z" in error
+
+
+def test_recover_rejects_repair_that_cuts_code_inside_a_bracket():
+    text = '[{"action": "create_update", "filename": "a.py", "content": "d = {"k": "v"}"}]'
+    commands, _, error = generation.recover_ai_commands(text)
+    assert commands == [] and "unbalanced bracket" in error
+
+
+def test_recover_keeps_commands_before_truncation():
+    text = 'Here you go: [{"action": "chat", "content": "one"}, {"action": "create_update", "filename": "a.py", "content": "import st'
+    commands, repairs, error = generation.recover_ai_commands(text)
+    assert commands == [{"action": "chat", "content": "one"}]
+    assert repairs["surrounding_text"] == 1 and "closed" in error
+
+
+def test_recover_without_array():
+    assert generation.recover_ai_commands("No code this time.") == ([], {}, "no JSON command array found in the response")
+
+
+def test_patch_hunks_apply_in_order():
+    patched, conflicts = generation.apply_patch_hunks("a = 1\nb = 2\n", [
+        {"search": "a = 1", "replace": "a = 10"},
+        {"search": "a = 10\nb = 2", "replace": "a = 10\nb = 20"},
+    ])
+    assert patched == "a = 10\nb = 20\n" and conflicts == []
+
+
+@pytest.mark.parametrize("hunk, conflict", [
+    ({"search": "missing", "replace": "x"}, "hunk 1 search text not found"),
+    ({"search": "x = 1", "replace": "x = 2"}, "hunk 1 search text matches 2 places"),
+    ({"search": "", "replace": "x"}, "hunk 1 search text not found"),
+    ({"search": "x = 1"}, "hunk 1 is malformed"),
+    ("x = 1", "hunk 1 is malformed"),
+])
+def test_patch_hunk_conflicts(hunk, conflict):
+    original = "x = 1\nx = 1\n"
+    patched, conflicts = generation.apply_patch_hunks(original, [hunk])
+    assert conflicts == [conflict]
+
+
+class RewriteWorkspace:
+    """Minimal workspace whose full-file fallback returns `rewrite` (None = the fallback failed)."""
+
+    def __init__(self, files, rewrite):
+        self.files = dict(files)
+        self.rewrite = rewrite
+        self.messages = []
+
+    def read(self, filename):
+        return self.files.get(filename)
+
+    def write(self, filename, content):
+        self.files[filename] = content
+        return True
+
+    def request_rewrite(self, filename, current_content, hunks, conflicts):
+        return self.rewrite
+
+    def validation_problems(self, filename):
+        return []
+
+    def notify(self, level, message):
+        self.messages.append((level, message))
+
+
+@pytest.mark.parametrize("rewrite, fallback", [("x = 2\n", "full_rewrite"), (None, None)])
+def test_patch_fallback_recorded_only_when_rewrite_saved(rewrite, fallback):
+    workspace = RewriteWorkspace({"a.py": "x = 1\n"}, rewrite)
+    command = {"action": "patch", "filename": "a.py", "hunks": [{"search": "missing", "replace": "y"}]}
+    entries = generation.execute_command(command, workspace)
+    assert command.get("fallback") == fallback
+    assert workspace.files["a.py"] == (rewrite or "x = 1\n")
+    assert (entries[-1] == {"action": "chat", "content": "Error: Failed patching a.py"}) == (rewrite is None)
+
+
+@pytest.mark.parametrize("response", [
+    '[{"action": "create_update", "filename": "a.py", "content": "x = 2"}]',
+    '{"action": "create_update", "filename": "a.py", "content": "x = 2"}',
+    'Here it is:\n[{"action": "create_update", "filename": "a.py", "content": "x = 2",},]',
+])
+def test_rewritten_content_tolerates_bare_object_and_repairs(response):
+    assert generation.rewritten_content(response, "a.py") == "x = 2"
+
+
+@pytest.mark.parametrize("response", [
+    '{"action": "create_update", "filename": "b.py", "content": "x = 2"}',
+    "I cannot rewrite this file.",
+    '[{"action": "create_update", "filename": "a.py", "content": null}]',
+])
+def test_rewritten_content_without_the_file(response):
+    assert generation.rewritten_content(response, "a.py") is None
@@ -0,0 +1,103 @@
+# Tests for the workspace outline and relevance ranking (symbol_index.py). Run with: python -m pytest tests
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import symbol_index
+
+APP_SOURCE = '''import streamlit as st
+from pandas import DataFrame
+
+
+class Report:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def to_frame(self):
+        return DataFrame(self.rows)
+
+
+def load_rows(path):
+    import json
+    with open(path) as f:
+        return json.load(f)
+
+
+if st.sidebar.button("Refresh data"):
+    st.dataframe(Report(load_rows("rows.json")).to_frame())
+limit = st.slider("Row limit", 1, 100)
+'''
+
+CHART_SOURCE = '''import streamlit as st
+
+
+def draw_chart(values):
+    st.line_chart(values)
+
+
+color = st.color_picker("Line color")
+'''
+
+
+def outlines():
+    return {
+        "app.py": symbol_index.extract_symbols(APP_SOURCE, "app.py"),
+        "charts.py": symbol_index.extract_symbols(CHART_SOURCE, "charts.py"),
+    }
+
+
+def test_outline_of_classes_functions_imports_and_widgets():
+    outline = symbol_index.extract_symbols(APP_SOURCE, "app.py")
+    assert outline["error"] is None and outline["lines"] == APP_SOURCE.count("\n") + 1
+    assert [(s["kind"], s["name"], s["line"], s["end_line"]) for s in outline["symbols"]] == [
+        ("import", "streamlit", 1, 1),
+        ("import", "pandas", 2, 2),
+        ("class", "Report", 5, 10),
+        ("function", "Report.__init__", 6, 7),
+        ("function", "Report.to_frame", 9, 10),
+        ("function", "load_rows", 13, 16),
+        ("import", "json", 14, 14),
+        ("widget", "st.sidebar.button", 19, 19),
+        ("widget", "st.slider", 21, 21),
+    ]
+    assert [s.get("label") for s in outline["symbols"] if s["kind"] == "widget"] == ["Refresh data", "Row limit"]
+
+
+def test_outline_of_invalid_source():
+    outline = symbol_index.extract_symbols("def broken(:\n", "broken.py")
+    assert outline["symbols"] == [] and outline["error"]
+
+
+def test_words_split_identifiers_and_drop_stop_words():
+    assert symbol_index.words("load_rows and drawChart for the app") == {"load", "rows", "draw", "chart"}
+
+
+def test_rank_prompt_naming_a_symbol():
+    ranked = symbol_index.rank_files(outlines(), "Make load_rows skip empty lines")
+    assert [filename for _, filename, _, _ in ranked] == ["app.py"]
+    assert [s["name"] for s in ranked[0][3]] == ["load_rows"]
+
+
+def test_rank_prompt_naming_a_widget_label():
+    ranked = symbol_index.rank_files(outlines(), 'Default the "Line color" picker to red')
+    assert ranked[0][1] == "charts.py"
+    assert [s["name"] for s in ranked[0][3]] == ["st.color_picker"]
+
+
+def test_rank_prompt_naming_a_filename():
+    ranked = symbol_index.rank_files(outlines(), "Add a title to charts.py")
+    assert ranked[0][1] == "charts.py"
+    assert ranked[0][0] >= 2 * symbol_index.EXACT_MATCH_SCORE
+    assert ranked[0][3] == [] # Named as a whole; no symbol matched
+
+
+def test_rank_selected_file_breaks_ties():
+    assert [entry[1] for entry in symbol_index.rank_files(outlines(), "Fix it", selected_file="charts.py")] == ["charts.py"]
+    assert symbol_index.rank_files(outlines(), "Fix it") == []
+
+
+def test_rank_empty_workspace():
+    assert symbol_index.rank_files({}, "Add a chart of load_rows") == []
+    assert symbol_index.rank_files({}, "Fix it", selected_file="app.py") == []
@@ -0,0 +1,29 @@
+# validation_worker.py - Separate interpreter for GenieCraft's static validation
+#
+# app.py runs a few of these to validate large files and whole workspaces without blocking
+# the script thread. They are started as fresh processes rather than forked from the
+# server, so they hold none of its sockets, preview pipes or threads, and they import
+# only code_validation, never the Streamlit script.
+#
+# Protocol: one JSON array per line on stdin, [key, filename, source]; one line back per
+# request on stdout, [key, result] (see code_validation.validate_job). The worker exits
+# when stdin is closed.
+
+import json
+import sys
+
+import code_validation
+
+
+def main():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        key, result = code_validation.validate_job(json.loads(line))
+        sys.stdout.write(json.dumps([key, result]) + "\n")
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())